@@ -0,0 +1,243 @@
+# app/admission.py
+"""
+Admission control for render submissions (/generate, /render,
+/generate/batch, /generate/{template_id}), so a misbehaving upstream
+cannot grow the backlog until Redis or the blob store runs out of room.
+
+- Backlog caps: every admitted job is recorded with its size (body bytes)
+  until a worker starts it. A submission is refused while the backlog
+  would exceed ADMISSION_MAX_QUEUED_JOBS jobs or ADMISSION_MAX_QUEUED_BYTES.
+- Per-client quotas: token buckets (app/ratelimit.py) of CLIENT_RATE_LIMIT
+  documents/second, burst CLIENT_RATE_BURST, with per-client overrides in
+  CLIENT_RATE_LIMITS ("billing=200,portal=5"). The client is the
+  ADMISSION_CLIENT_HEADER request header, or the peer address.
+- Refusals are 429 with Retry-After: the time the measured drain rate
+  (jobs started per second over DRAIN_WINDOW seconds) needs to make room,
+  or the time until the client's bucket has refilled.
+- GET /ready reports the backlog and answers 503 above READY_MAX_FILL of a
+  cap, for load balancers and the billing scheduler to back off.
+
+Workers release a job's record when it starts (started()); records of jobs
+that will never start (failed enqueues, purged queues, lost messages; at the
+latest after ADMISSION_MAX_PENDING_AGE seconds) are dropped by the
+reconcile_admission task. A cap or rate of 0 disables that check.
+"""
+import os
+import time
+import math
+
+from .events import get_job_states
+from .ratelimit import TAKE_TOKENS
+
+ADMISSION_MAX_QUEUED_JOBS = int(os.getenv("ADMISSION_MAX_QUEUED_JOBS", "200000"))
+ADMISSION_MAX_QUEUED_BYTES = int(os.getenv("ADMISSION_MAX_QUEUED_BYTES", str(8 * 1024 ** 3)))
+ADMISSION_CLIENT_HEADER = os.getenv("ADMISSION_CLIENT_HEADER", "X-Client-Id")
+ADMISSION_RETRY_AFTER_MAX = int(os.getenv("ADMISSION_RETRY_AFTER_MAX", "300"))
+ADMISSION_RECONCILE_INTERVAL = int(os.getenv("ADMISSION_RECONCILE_INTERVAL", "300"))
+ADMISSION_MAX_PENDING_AGE = int(os.getenv("ADMISSION_MAX_PENDING_AGE", str(24 * 3600)))
+CLIENT_RATE_LIMIT = float(os.getenv("CLIENT_RATE_LIMIT", "0"))
+CLIENT_RATE_BURST = float(os.getenv("CLIENT_RATE_BURST", "100"))
+CLIENT_RATE_LIMITS = {
+    name.strip(): float(rate)
+    for name, _, rate in (
+        item.partition("=") for item in os.getenv("CLIENT_RATE_LIMITS", "").split(",") if "=" in item
+    )
+}
+READY_MAX_FILL = float(os.getenv("READY_MAX_FILL", "0.9"))
+DRAIN_WINDOW = int(os.getenv("DRAIN_WINDOW", "60"))
+
+PENDING_KEY = "admission:pending"  # hash: job_id -> "{bytes}:{admitted at}"
+BYTES_KEY = "admission:bytes"
+DRAINED_PREFIX = "admission:drained:"  # jobs started per DRAIN_BUCKET seconds
+CLIENT_PREFIX = "admission:client:"
+DRAIN_BUCKET = 10
+# A job's state record is written right after it is admitted
+_STATE_GRACE = 60
+
+# Record jobs (ARGV[4..]: job_id, bytes pairs) unless the backlog would pass
+# ARGV[1] jobs / ARGV[2] bytes; ARGV[3] = now. Returns {refused cap or '',
+# jobs, bytes}.
+_RESERVE = """
+local jobs = redis.call('HLEN', KEYS[1])
+local bytes = tonumber(redis.call('GET', KEYS[2]) or '0')
+local n, add = 0, 0
+for i = 4, #ARGV, 2 do
+  n = n + 1
+  add = add + tonumber(ARGV[i + 1])
+end
+local max_jobs, max_bytes = tonumber(ARGV[1]), tonumber(ARGV[2])
+if max_jobs > 0 and jobs + n > max_jobs then return {'jobs', jobs, tostring(bytes)} end
+if max_bytes > 0 and bytes + add > max_bytes then return {'bytes', jobs, tostring(bytes)} end
+for i = 4, #ARGV, 2 do redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1] .. ':' .. ARGV[3]) end
+redis.call('INCRBY', KEYS[2], add)
+return {'', jobs + n, tostring(bytes + add)}
+"""
+
+# Forget jobs (ARGV[2..]); with ARGV[1] > 0, count them as drained in
+# KEYS[3] (expiring after ARGV[1] seconds). Returns the number forgotten.
+_RELEASE = """
+local n, freed = 0, 0
+for i = 2, #ARGV do
+  local size = redis.call('HGET', KEYS[1], ARGV[i])
+  if size then
+    redis.call('HDEL', KEYS[1], ARGV[i])
+    freed = freed + tonumber(string.match(size, '^%d+'))
+    n = n + 1
+  end
+end
+if freed > 0 then redis.call('DECRBY', KEYS[2], freed) end
+if n > 0 and tonumber(ARGV[1]) > 0 then
+  redis.call('INCRBY', KEYS[3], n)
+  redis.call('EXPIRE', KEYS[3], ARGV[1])
+end
+return n
+"""
+
+
+class AdmissionError(Exception):
+    def __init__(self, message: str, reason: str, retry_after: int):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def client_id(request) -> str:
+    client = request.headers.get(ADMISSION_CLIENT_HEADER)
+    if not client and request.client is not None:
+        client = request.client.host
+    return (client or "unknown")[:64]
+
+
+def client_rate(client: str) -> float:
+    return CLIENT_RATE_LIMITS.get(client, CLIENT_RATE_LIMIT)
+
+
+def _retry_after(seconds: float) -> int:
+    return max(1, min(ADMISSION_RETRY_AFTER_MAX, math.ceil(seconds)))
+
+
+def _drained_key(now: float) -> str:
+    return f"{DRAINED_PREFIX}{int(now // DRAIN_BUCKET)}"
+
+
+async def check_client(ar, client: str, cost: int = 1):
+    """
+    Take cost documents from the client's quota; AdmissionError if empty.
+    """
+    rate = client_rate(client)
+    if rate <= 0:
+        return
+    burst = max(CLIENT_RATE_BURST, 1.0)
+    wait = float(await ar.eval(TAKE_TOKENS, 1, CLIENT_PREFIX + client, rate, burst, min(cost, burst)))
+    if wait > 0:
+        raise AdmissionError(f"Rate limit of client {client!r} exceeded ({rate:g} documents/s)",
+                             "client", _retry_after(wait))
+
+
+async def backlog(ar) -> dict:
+    """
+    Admitted jobs not started yet, their bytes, the drain rate (jobs started
+    per second over DRAIN_WINDOW) and the fill level of the fuller cap.
+    """
+    now = time.time()
+    buckets = [_drained_key(now - i * DRAIN_BUCKET) for i in range(DRAIN_WINDOW // DRAIN_BUCKET + 1)]
+    pipe = ar.pipeline(transaction=False)
+    pipe.hlen(PENDING_KEY)
+    pipe.get(BYTES_KEY)
+    pipe.mget(buckets)
+    jobs, size, drained = await pipe.execute()
+    elapsed = (len(buckets) - 1) * DRAIN_BUCKET + now % DRAIN_BUCKET
+    fill = 0.0
+    if ADMISSION_MAX_QUEUED_JOBS > 0:
+        fill = jobs / ADMISSION_MAX_QUEUED_JOBS
+    if ADMISSION_MAX_QUEUED_BYTES > 0:
+        fill = max(fill, int(size or 0) / ADMISSION_MAX_QUEUED_BYTES)
+    return {
+        "queued_jobs": jobs,
+        "queued_bytes": int(size or 0),
+        "drain_rate": round(sum(int(n or 0) for n in drained) / elapsed, 3),
+        "fill": round(fill, 4),
+    }
+
+
+async def reserve(ar, sizes: dict):
+    """
+    Admit jobs ({job_id: bytes}) into the backlog; AdmissionError if a cap
+    would be passed. Retry-After is the time the current drain rate needs
+    to make room.
+    """
+    if not sizes:
+        return
+    args = [ADMISSION_MAX_QUEUED_JOBS, ADMISSION_MAX_QUEUED_BYTES, int(time.time())]
+    for job_id, size in sizes.items():
+        args += [job_id, int(size)]
+    refused, jobs, size = await ar.eval(_RESERVE, 2, PENDING_KEY, BYTES_KEY, *args)
+    if not refused:
+        return
+    rate = (await backlog(ar))["drain_rate"]
+    if refused == "jobs":
+        excess = jobs + len(sizes) - ADMISSION_MAX_QUEUED_JOBS
+        message = f"Backlog full ({jobs} jobs queued, limit {ADMISSION_MAX_QUEUED_JOBS})"
+    else:
+        # In jobs of the backlog's average size
+        average = int(size) / jobs if jobs else 1
+        excess = (int(size) + sum(sizes.values()) - ADMISSION_MAX_QUEUED_BYTES) / max(average, 1)
+        message = f"Backlog full ({size} bytes queued, limit {ADMISSION_MAX_QUEUED_BYTES})"
+    wait = excess / rate if rate > 0 else ADMISSION_RETRY_AFTER_MAX
+    raise AdmissionError(message, f"queue_{refused}", _retry_after(wait))
+
+
+async def release(ar, job_ids: list):
+    """
+    Take jobs that were admitted but not enqueued back out of the backlog.
+    """
+    if job_ids:
+        await ar.eval(_RELEASE, 3, PENDING_KEY, BYTES_KEY, _drained_key(time.time()), 0, *job_ids)
+
+
+def started(r, job_ids: list) -> int:
+    """
+    Worker side: jobs leave the backlog (and count towards the drain rate).
+    """
+    if not job_ids:
+        return 0
+    ttl = DRAIN_WINDOW + 2 * DRAIN_BUCKET
+    return r.eval(_RELEASE, 3, PENDING_KEY, BYTES_KEY, _drained_key(time.time()), ttl, *job_ids)
+
+
+def reconcile(r) -> dict:
+    """
+    Drop backlog records of jobs that will never be started: no longer
+    PENDING (failed enqueue), without state record, or admitted more than
+    ADMISSION_MAX_PENDING_AGE seconds ago.
+    """
+    now = time.time()
+    dropped = checked = 0
+    cursor = 0
+    while True:
+        cursor, entries = r.hscan(PENDING_KEY, cursor, count=1000)
+        job_ids = list(entries)
+        checked += len(job_ids)
+        stale = []
+        for job_id, state in zip(job_ids, get_job_states(r, job_ids)):
+            age = now - float(entries[job_id].partition(":")[2] or 0)
+            if (age > ADMISSION_MAX_PENDING_AGE
+                    or (state is None and age > _STATE_GRACE)
+                    or (state is not None and state.get("status") != "PENDING")):
+                stale.append(job_id)
+        if stale:
+            dropped += r.eval(_RELEASE, 3, PENDING_KEY, BYTES_KEY, _drained_key(time.time()), 0, *stale)
+        if cursor == 0:
+            break
+    return {"checked": checked, "dropped": dropped}
+
+
+def busy_retry_after(state: dict) -> int:
+    """
+    Seconds until a backlog (backlog()) has drained below READY_MAX_FILL.
+    """
+    if state["fill"] <= 0:
+        return 1
+    over = state["queued_jobs"] * (state["fill"] - READY_MAX_FILL) / state["fill"]
+    rate = state["drain_rate"]
+    return _retry_after(over / rate if rate > 0 else ADMISSION_RETRY_AFTER_MAX)
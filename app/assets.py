@@ -0,0 +1,185 @@
+# app/assets.py
+"""
+Shared, content-addressed asset store for images used by bills (logos, QR
+codes, ...).
+
+Assets are stored once in ASSET_DIR as {sha256}{ext} and referenced from HTML
+as "asset://{sha256}". Before rendering, workers rewrite those references to
+local file:// URLs, so wkhtmltopdf reads a file instead of decoding the same
+base64 data URI for every document.
+
+AssetRewriter works on a byte stream, so it can run inside the streaming
+ingest (extracting inline data:image URIs into the store) and when the
+worker writes the HTML for the renderer (resolving asset:// references).
+"""
+import os
+import re
+import sys
+import base64
+import binascii
+import hashlib
+
+ASSET_DIR = os.getenv("ASSET_DIR", "/data/assets")
+ASSET_EXTRACT_INLINE = os.getenv("ASSET_EXTRACT_INLINE", "0") == "1"
+# Smaller data URIs are left inline; not worth a file
+ASSET_MIN_INLINE_BYTES = int(os.getenv("ASSET_MIN_INLINE_BYTES", "1024"))
+ASSET_MAX_BYTES = int(os.getenv("ASSET_MAX_BYTES", str(10 * 1024 * 1024)))
+
+MIME_EXT = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/jpg": ".jpg",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    "image/svg+xml": ".svg",
+}
+
+ASSET_SCHEME = b"asset://"
+DATA_IMAGE = b"data:image/"
+_ASSET_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+_DATA_URI_RE = re.compile(rb"^data:(image/[A-Za-z0-9.+-]+);base64,(.*)$", re.DOTALL)
+_URI_END = re.compile(rb"[\"'()<>]")
+
+os.makedirs(ASSET_DIR, exist_ok=True)
+
+
+class AssetError(ValueError):
+    pass
+
+
+def put_asset(data: bytes, mime: str) -> str:
+    """
+    Store data (idempotent) and return its asset id (sha256 hex).
+    """
+    ext = MIME_EXT.get((mime or "").split(";")[0].strip().lower())
+    if ext is None:
+        raise AssetError(f"Unsupported asset type {mime!r}")
+    if not data:
+        raise AssetError("Empty asset")
+    if len(data) > ASSET_MAX_BYTES:
+        raise AssetError(f"Asset exceeds {ASSET_MAX_BYTES} bytes")
+
+    asset_id = hashlib.sha256(data).hexdigest()
+    path = os.path.join(ASSET_DIR, asset_id + ext)
+    if not os.path.exists(path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return asset_id
+
+
+def asset_path(asset_id: str):
+    """
+    Local path of an asset, or None if it is not in the store.
+    """
+    if not _ASSET_ID_RE.match(asset_id or ""):
+        return None
+    for ext in set(MIME_EXT.values()):
+        path = os.path.join(ASSET_DIR, asset_id + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+class AssetRewriter:
+    """
+    Streaming rewriter for URIs inside HTML bytes:
+    - extract_inline: data:image/...;base64,... -> stored, replaced by asset://{id}
+    - resolve_refs:   asset://{id} -> file:///path/in/ASSET_DIR
+
+        rw = AssetRewriter(extract_inline=True)
+        for chunk in chunks:
+            out.write(rw.feed(chunk))
+        out.write(rw.flush())
+
+    A URI split across chunks is held back until its end is seen (bounded
+    by ASSET_MAX_BYTES, past which it is passed through untouched).
+    """
+
+    def __init__(self, extract_inline: bool = False, resolve_refs: bool = False):
+        self.tokens = []
+        if extract_inline:
+            self.tokens.append(DATA_IMAGE)
+        if resolve_refs:
+            self.tokens.append(ASSET_SCHEME)
+        self._keep = max((len(t) for t in self.tokens), default=1) - 1
+        self._buf = b""
+        self.extracted = 0
+        self.resolved = 0
+        self.missing = []
+
+    def feed(self, chunk: bytes) -> bytes:
+        if not self.tokens:
+            return chunk
+        self._buf += chunk
+        return self._drain(final=False)
+
+    def flush(self) -> bytes:
+        out = self._drain(final=True) if self.tokens else b""
+        out += self._buf
+        self._buf = b""
+        return out
+
+    def _drain(self, final: bool) -> bytes:
+        buf, out, pos = self._buf, [], 0
+        while True:
+            start = min((i for i in (buf.find(t, pos) for t in self.tokens) if i >= 0), default=-1)
+            if start < 0:
+                # Hold back a possible partial token at the end of the buffer
+                cut = len(buf) if final else max(pos, len(buf) - self._keep)
+                out.append(buf[pos:cut])
+                pos = cut
+                break
+
+            out.append(buf[pos:start])
+            m = _URI_END.search(buf, start)
+            if m is None:
+                if final or len(buf) - start > ASSET_MAX_BYTES * 2:
+                    out.append(buf[start:])
+                    pos = len(buf)
+                else:
+                    pos = start
+                break
+
+            out.append(self._replace(buf[start:m.start()]))
+            pos = m.start()
+
+        self._buf = buf[pos:]
+        return b"".join(out)
+
+    def _replace(self, uri: bytes) -> bytes:
+        if uri.startswith(ASSET_SCHEME):
+            asset_id = uri[len(ASSET_SCHEME):].decode("ascii", "ignore").strip()
+            path = asset_path(asset_id)
+            if path is None:
+                self.missing.append(asset_id)
+                return uri
+            self.resolved += 1
+            return f"file://{path}".encode("utf-8")
+
+        m = _DATA_URI_RE.match(uri)
+        if m is None:
+            return uri
+        try:
+            data = base64.b64decode(b"".join(m.group(2).split()), validate=True)
+        except (binascii.Error, ValueError):
+            return uri
+        if len(data) < ASSET_MIN_INLINE_BYTES:
+            return uri
+        try:
+            asset_id = put_asset(data, m.group(1).decode("ascii"))
+        except AssetError:
+            return uri
+        self.extracted += 1
+        return ASSET_SCHEME + asset_id.encode("ascii")
+
+
+if __name__ == "__main__":
+    # Register files once, e.g.: python -m app.assets bill/wzlogo.png bill/mpgov.png
+    import mimetypes
+
+    for file_path in sys.argv[1:]:
+        mime, _ = mimetypes.guess_type(file_path)
+        with open(file_path, "rb") as f:
+            print(f"asset://{put_asset(f.read(), mime)}  {file_path}")
@@ -0,0 +1,114 @@
+# app/blobstore.py
+"""
+Local blob store for request bodies, so tasks carry a short reference instead
+of the full HTML through the Celery broker.
+
+Blobs live in BLOB_DIR (a volume shared by API and workers), compressed with
+zstd when the zstandard package is installed and gzip otherwise. The
+compression is part of the reference ("<id>.html.zst" / "<id>.html.gz"), so
+API and workers with different settings still read each other's blobs.
+"""
+import os
+import re
+import gzip
+import uuid
+
+try:
+    import zstandard
+except ImportError:  # optional: gzip is used instead
+    zstandard = None
+
+BLOB_DIR = os.getenv("BLOB_DIR", "/data/blobs")
+BLOB_COMPRESSION = os.getenv("BLOB_COMPRESSION", "zstd" if zstandard else "gzip")
+BLOB_ZSTD_LEVEL = int(os.getenv("BLOB_ZSTD_LEVEL", "3"))
+
+_REF_RE = re.compile(r"^[0-9a-f]{32}\.html\.(gz|zst)$")
+
+os.makedirs(BLOB_DIR, exist_ok=True)
+
+
+class BlobError(ValueError):
+    pass
+
+
+def _path(ref: str) -> str:
+    if not _REF_RE.match(ref or ""):
+        raise BlobError(f"Invalid blob reference {ref!r}")
+    return os.path.join(BLOB_DIR, ref)
+
+
+class BlobWriter:
+    """
+    Streaming, compressed, atomic blob write:
+
+        with BlobWriter() as w:
+            w.write(chunk)
+        ref = w.ref
+
+    The blob becomes visible only when the block exits cleanly; on error the
+    partial file is removed.
+    """
+
+    def __init__(self, compression: str = BLOB_COMPRESSION):
+        if compression == "zstd" and zstandard is None:
+            compression = "gzip"
+        ext = "zst" if compression == "zstd" else "gz"
+        self.ref = f"{uuid.uuid4().hex}.html.{ext}"
+        self.path = _path(self.ref)
+        self.size = 0
+        self._tmp_path = f"{self.path}.tmp"
+        self._raw = open(self._tmp_path, "wb")
+        if ext == "zst":
+            self._out = zstandard.ZstdCompressor(level=BLOB_ZSTD_LEVEL).stream_writer(self._raw, closefd=False)
+        else:
+            self._out = gzip.GzipFile(fileobj=self._raw, mode="wb", compresslevel=6)
+
+    def write(self, data: bytes):
+        self._out.write(data)
+        self.size += len(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self._out.close()
+            self._raw.close()
+        finally:
+            if exc_type is None:
+                os.replace(self._tmp_path, self.path)
+            elif os.path.exists(self._tmp_path):
+                os.remove(self._tmp_path)
+        return False
+
+
+def put(data: bytes) -> str:
+    with BlobWriter() as w:
+        w.write(data)
+    return w.ref
+
+
+def open_blob(ref: str):
+    """
+    Binary file-like object streaming the decompressed blob.
+    """
+    path = _path(ref)
+    if not os.path.exists(path):
+        raise BlobError(f"Blob {ref} not found")
+    if ref.endswith(".zst"):
+        if zstandard is None:
+            raise BlobError("zstd blob but zstandard is not installed")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    return gzip.open(path, "rb")
+
+
+def read(ref: str) -> bytes:
+    with open_blob(ref) as f:
+        return f.read()
+
+
+def delete(ref: str):
+    try:
+        os.remove(_path(ref))
+    except FileNotFoundError:
+        pass
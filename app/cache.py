@@ -0,0 +1,135 @@
+# app/cache.py
+"""
+Content-addressed PDF result cache with in-flight coalescing.
+
+Each entry is a Redis hash  pdf_hash:{key} -> {job_id, state, pdf_path,
+sha256, size}  where key = sha256(body hash + render options).
+
+- The first request for a key claims it (state=PENDING) and enqueues a job.
+- Identical requests while that job runs get the same job_id (coalescing).
+- The worker marks the entry DONE with the PDF's path, hash and size, or
+  deletes it on failure so the next request renders again instead of
+  returning a cached error. A hit on a DONE entry outlives the job's own
+  records, which the API rebuilds from it (events.keep_done_job).
+- DONE entries expire after PDF_CACHE_TTL (refreshed on every hit), PENDING
+  ones after PDF_CACHE_PENDING_TTL, and the least-recently-used entries are
+  evicted beyond PDF_CACHE_MAX_ENTRIES.
+"""
+import os
+import json
+import time
+import hashlib
+
+from . import storage
+
+PDF_CACHE_TTL = int(os.getenv("PDF_CACHE_TTL", str(7 * 24 * 3600)))
+# In-flight entries live shorter, so a job lost with its worker stops
+# attracting identical requests after this long
+PDF_CACHE_PENDING_TTL = int(os.getenv("PDF_CACHE_PENDING_TTL", "3600"))
+PDF_CACHE_MAX_ENTRIES = int(os.getenv("PDF_CACHE_MAX_ENTRIES", "200000"))
+# Bump to invalidate every entry after a renderer / page-setup change
+PDF_CACHE_NAMESPACE = os.getenv("PDF_CACHE_NAMESPACE", "v1")
+
+CACHE_PREFIX = "pdf_hash:"
+CACHE_INDEX = "pdf_cache:lru"  # zset: cache key -> last use (unix time)
+
+# Claim the key for ARGV[1] (returns no fields) or return the existing entry,
+# in one step so a claim never exists without its state and TTL. DONE
+# entries get their TTL refreshed; in-flight ones left without one (by a
+# client that died mid-claim before claims were atomic) get the pending TTL.
+_CLAIM = """
+if redis.call('HSETNX', KEYS[1], 'job_id', ARGV[1]) == 1 then
+    redis.call('HSET', KEYS[1], 'state', 'PENDING')
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return {}
+end
+if redis.call('HGET', KEYS[1], 'state') == 'DONE' then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+elseif redis.call('TTL', KEYS[1]) == -1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return redis.call('HGETALL', KEYS[1])
+"""
+# Compare-and-set / compare-and-delete on the owning job_id, so a late worker
+# never overwrites or drops an entry that was re-claimed by a newer job.
+_MARK_DONE = """
+if redis.call('HGET', KEYS[1], 'job_id') == ARGV[1] then
+    redis.call('HSET', KEYS[1], 'state', 'DONE', 'pdf_path', ARGV[2], 'sha256', ARGV[4], 'size', ARGV[5])
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    return 1
+end
+return 0
+"""
+_INVALIDATE = """
+if redis.call('HGET', KEYS[1], 'job_id') == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    redis.call('ZREM', KEYS[2], KEYS[1])
+    return 1
+end
+return 0
+"""
+
+
+def cache_key(body_hash: str, options: dict = None) -> str:
+    """
+    Cache key for a document hash plus the options that affect its rendering.
+    """
+    material = json.dumps(
+        {"ns": PDF_CACHE_NAMESPACE, "body": body_hash, "options": options or {}},
+        sort_keys=True,
+    )
+    return CACHE_PREFIX + hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def claim(r, key: str, job_id: str):
+    """
+    Look up key; if absent, claim it for job_id.
+    Returns (job_id, entry) where entry is None when the caller now owns the
+    key and must enqueue job_id, or the existing entry dict on a hit:
+      {"job_id": ..., "state": "PENDING" | "DONE", "pdf_path": ...}
+    """
+    for _ in range(3):
+        fields = r.eval(_CLAIM, 1, key, job_id, PDF_CACHE_PENDING_TTL, PDF_CACHE_TTL)
+        if not fields:
+            _touch(r, key)
+            return job_id, None
+
+        entry = dict(zip(fields[::2], fields[1::2]))
+        existing = entry["job_id"]
+        if entry.get("state") == "DONE" and not storage.exists(entry.get("pdf_path") or ""):
+            # PDF was removed from storage (e.g. retention GC): drop the entry and render again
+            invalidate(r, key, existing)
+            continue
+
+        entry.setdefault("state", "PENDING")
+        _touch(r, key)
+        return existing, entry
+
+    # Persistent races are not worth failing the request for: just don't cache
+    return job_id, None
+
+
+def mark_done(r, key: str, job_id: str, pdf_path: str, sha256: str = "", size: int = 0) -> bool:
+    return bool(r.eval(_MARK_DONE, 1, key, job_id, pdf_path, PDF_CACHE_TTL, sha256 or "", size or 0))
+
+
+def invalidate(r, key: str, job_id: str) -> bool:
+    return bool(r.eval(_INVALIDATE, 2, key, CACHE_INDEX, job_id))
+
+
+def _touch(r, key: str):
+    """
+    Record use of key and evict least-recently-used entries beyond the cap.
+    """
+    now = time.time()
+    pipe = r.pipeline()
+    pipe.zadd(CACHE_INDEX, {key: now})
+    pipe.zremrangebyscore(CACHE_INDEX, "-inf", now - PDF_CACHE_TTL)
+    pipe.zcard(CACHE_INDEX)
+    size = pipe.execute()[-1]
+
+    excess = size - PDF_CACHE_MAX_ENTRIES
+    if excess > 0:
+        evicted = [k for k, _ in r.zpopmin(CACHE_INDEX, excess)]
+        if evicted:
+            r.delete(*evicted)
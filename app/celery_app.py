@@ -1,17 +1,48 @@
 # app/celery_app.py
 import os
+import time
+import random
+import hashlib
 import tempfile
 import subprocess
-import shutil
+from contextlib import contextmanager
 
-from celery import Celery
+import redis
+from celery import Celery, signals
+
+from . import admission, cache, blobstore, events, metrics, pages, ratelimit, storage, webhooks
+from .renderer import render_pdf, render_pdf_batch, batch_supported, count_pages, RenderError
+from .templates import render_template
+from .assets import AssetRewriter
+from .resolver import resolve_file
+from .pdfopt import optimize_pdf
+from .export import write_export
 
 CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://redis:6379/0")
 CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", "redis://redis:6379/1")
-PDF_OUTPUT_DIR = os.getenv("PDF_OUTPUT_DIR", "/data/pdfs")
-WKHTML_BIN = os.getenv("WKHTML_BIN", "/usr/bin/wkhtmltopdf")
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_DB_HASH = int(os.getenv("REDIS_DB_HASH", "2"))  # result cache (see app/cache.py)
+RESOURCE_RESOLVER = os.getenv("RESOURCE_RESOLVER", "1") == "1"  # see app/resolver.py
+BATCH_RENDER_SIZE = int(os.getenv("BATCH_RENDER_SIZE", "50"))  # documents per batch task
+
+# Job classes -> queues, each consumed by its own workers (docker-compose.yml),
+# so a bulk billing run never sits in front of a customer reprint
+INTERACTIVE_QUEUE = os.getenv("CELERY_INTERACTIVE_QUEUE", "interactive")
+STANDARD_QUEUE = os.getenv("CELERY_STANDARD_QUEUE", "celery")
+BULK_QUEUE = os.getenv("CELERY_BULK_QUEUE", "bulk")
+PRIORITY_QUEUES = {"interactive": INTERACTIVE_QUEUE, "standard": STANDARD_QUEUE, "bulk": BULK_QUEUE}
+# Webhook deliveries (and their retries) wait on clients, not on renders
+WEBHOOK_QUEUE = os.getenv("CELERY_WEBHOOK_QUEUE", "webhooks")
+# Must exceed the longest render: unacknowledged tasks are redelivered after it
+BROKER_VISIBILITY_TIMEOUT = int(os.getenv("BROKER_VISIBILITY_TIMEOUT", "3600"))
+# Worker processes are replaced after this many tasks, or once their resident
+# memory passes WORKER_MAX_MEMORY_PER_CHILD_MB (checked after each task);
+# 0 = never. Renderer processes have their own limits (app/renderer.py).
+WORKER_MAX_TASKS_PER_CHILD = int(os.getenv("WORKER_MAX_TASKS_PER_CHILD", "500"))
+WORKER_MAX_MEMORY_PER_CHILD_MB = int(os.getenv("WORKER_MAX_MEMORY_PER_CHILD_MB", "1024"))
 
-os.makedirs(PDF_OUTPUT_DIR, exist_ok=True)
+cache_r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB_HASH, decode_responses=True)
 
 celery = Celery(
     "pdf_tasks",
@@ -25,59 +56,446 @@ celery.conf.update(
     accept_content=["json"],
     timezone="UTC",
     enable_utc=True,
+    task_default_queue=STANDARD_QUEUE,
+    task_routes={
+        "generate_pdf_batch": {"queue": BULK_QUEUE},
+        "export_pdfs": {"queue": BULK_QUEUE},
+        "gc_storage": {"queue": BULK_QUEUE},
+        "reconcile_admission": {"queue": BULK_QUEUE},
+        "deliver_webhook": {"queue": WEBHOOK_QUEUE},
+    },
+    # Renders take seconds: a worker process reserves one task at a time and
+    # acknowledges it when done, so idle workers (not busy ones) get the next job
+    worker_prefetch_multiplier=1,
+    task_acks_late=True,
+    worker_max_tasks_per_child=WORKER_MAX_TASKS_PER_CHILD or None,
+    worker_max_memory_per_child=WORKER_MAX_MEMORY_PER_CHILD_MB * 1024 or None,  # KiB
+    broker_transport_options={"visibility_timeout": BROKER_VISIBILITY_TIMEOUT},
+    # Run by `celery beat` (docker-compose.yml)
+    beat_schedule={
+        "gc-storage": {"task": "gc_storage", "schedule": storage.PDF_GC_INTERVAL},
+        "reconcile-admission": {"task": "reconcile_admission",
+                                "schedule": admission.ADMISSION_RECONCILE_INTERVAL},
+    },
 )
 
 
-@celery.task(name="generate_pdf")
-def generate_pdf(html: str, job_id: str) -> dict:
+@celery.task(name="generate_pdf", bind=True)
+def generate_pdf(self, blob_ref: str, job_id: str, cache_key: str = None, division: str = None,
+                 profile: str = None) -> dict:
+    """
+    Celery task: HTML -> PDF using the configured render engine (app.renderer).
+    The HTML is read (streaming) from the blob store; the blob is deleted once
+    the job has finished, successfully or not.
+    Stores the PDF as {job_id}.pdf (app/storage.py).
+    Returns {"pdf_path": "..."} (its storage location) for the API to read.
+    """
+    throttle(self, division)
+    try:
+        with job_outcome(cache_key, job_id) as result:
+            with blobstore.open_blob(blob_ref) as src:
+                result.update(render_html_job(src, job_id, profile))
+        return result
+    finally:
+        blobstore.delete(blob_ref)
+
+
+@celery.task(name="generate_pdf_from_template", bind=True)
+def generate_pdf_from_template(self, template_id: str, data: dict, job_id: str, cache_key: str = None,
+                               division: str = None, profile: str = None) -> dict:
+    """
+    Celery task: registered template + per-consumer JSON -> HTML -> PDF.
+    Only template_id and the (small) data dict travel through the broker.
+    """
+    throttle(self, division)
+    with job_outcome(cache_key, job_id) as result:
+        with metrics.stage("template"):
+            html = render_template(template_id, data)
+        result.update(render_html_job(html, job_id, profile))
+    return result
+
+
+def throttle(task, division: str, cost: int = 1):
+    """
+    Apply the division's rate limit (app/ratelimit.py): if its bucket is
+    empty, retry the task at its slot in the division's retry schedule
+    instead of rendering now.
+    """
+    wait = ratelimit.acquire(cache_r, division, cost)
+    if wait > 0:
+        metrics.THROTTLED.labels(division).inc()
+        delay = ratelimit.retry_delay(cache_r, division, wait, cost)
+        raise task.retry(countdown=delay + random.uniform(0, 0.5), max_retries=None)
+
+
+def failure_state(e: BaseException) -> dict:
+    """
+    FAILED state fields for e: the message, plus RenderError.details (reason,
+    timeout, limits, CPU / memory used) under "failure".
+    """
+    fields = {"error": str(e)[:1000]}
+    details = getattr(e, "details", None)
+    if details:
+        fields["failure"] = details
+    return fields
+
+
+@contextmanager
+def job_outcome(cache_key: str, job_id: str):
+    """
+    Track one job: RUNNING on entry, then publish the outcome to the job state
+    record (see app/events.py), its webhook and its result cache entry:
+    DONE with pdf_path on success; FAILED / cache entry invalidated otherwise.
+    The job leaves the API's admission backlog (app/admission.py).
+    """
+    admission.started(cache_r, [job_id])
+    events.set_job_state(cache_r, job_id, "RUNNING")
+    result = {}
+    try:
+        yield result
+    except BaseException as e:
+        metrics.JOBS.labels("failed").inc()
+        metrics.FAILURES.labels(type(e).__name__).inc()
+        if cache_key:
+            cache.invalidate(cache_r, cache_key, job_id)
+        notify(events.set_job_state(cache_r, job_id, "FAILED", **failure_state(e)))
+        raise
+    metrics.JOBS.labels("done").inc()
+    if cache_key:
+        cache.mark_done(cache_r, cache_key, job_id, result["pdf_path"], result.get("sha256"), result.get("size"))
+    notify(events.set_job_state(cache_r, job_id, "DONE"))
+
+
+def notify(state: dict):
+    for url in events.pop_webhooks(cache_r, state["job_id"]):
+        deliver_webhook.delay(url, state)
+
+
+@celery.task(
+    name="deliver_webhook",
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    retry_backoff_max=300,
+    max_retries=8,
+)
+def deliver_webhook(url: str, payload: dict):
     """
-    Celery task: HTML -> PDF using wkhtmltopdf.
-    Saves PDF as /data/pdfs/{job_id}.pdf (inside container).
-    Returns {"pdf_path": "..."} for the API to read.
+    POST a finished job's state to its callback URL (retried with backoff;
+    URLs that fail app/webhooks.py's checks are dropped).
     """
-    import os
+    return webhooks.post(url, payload)
 
+
+def render_html_job(html, job_id: str, profile: str = None) -> dict:
+    """
+    Write html (a str or a binary stream) to a temp file, render it and store
+    it as {job_id}.pdf (optimized with the given profile, see app/pdfopt.py).
+    """
     with tempfile.TemporaryDirectory() as td:
         html_path = os.path.join(td, "input.html")
         pdf_tmp = os.path.join(td, "output.pdf")
 
-        with open(html_path, "w", encoding="utf-8") as f:
-            f.write(html)
-
-        cmd = [
-            WKHTML_BIN,
-            "--enable-local-file-access",
-            "--image-quality","100",
-            "--dpi","150",
-            "--page-size", "A4",
-            "--margin-top", "10mm",
-            "--margin-bottom", "10mm",
-            "--margin-left", "10mm",
-            "--margin-right", "10mm",
-            html_path,
-            pdf_tmp,
-        ]
-
-        proc = subprocess.run(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            timeout=300,
-        )
-
-        stdout = proc.stdout.decode("utf-8", errors="ignore")
-        stderr = proc.stderr.decode("utf-8", errors="ignore")
-        if proc.returncode != 0:
-            raise RuntimeError(f"wkhtmltopdf rc={proc.returncode} stderr={stderr[:1000]}")
-
-        if not os.path.exists(pdf_tmp):
-            raise RuntimeError("wkhtmltopdf finished but output.pdf not found")
-
-        final_path = os.path.join(PDF_OUTPUT_DIR, f"{job_id}.pdf")
-        
-        os.makedirs(PDF_OUTPUT_DIR, exist_ok=True)
-
-        # Cross-device safe move (will copy+delete if needed)
-        shutil.move(pdf_tmp, final_path)
-
-        return {"pdf_path": final_path, "stdout": stdout[:500], "stderr": stderr[:500]}
+        resources = prepare_html(html_path, html)
+
+        diag = render_document(html_path, pdf_tmp, pages.plan_pages(html_path, cache_r))
+        return store_pdf(pdf_tmp, job_id, diag, resources, profile)
+
+
+def render_document(html_path: str, pdf_tmp: str, plan=None) -> dict:
+    """
+    Render html_path; with a page plan (app/pages.py), from cached static
+    page fragments and a render of the other pages only.
+    """
+    if plan is None or not render_fragments(plan):
+        return timed_render(render_pdf, html_path, pdf_tmp)
+    diag = timed_render(render_pdf, plan.dynamic_path, plan.dynamic_pdf) if plan.dynamic_path else {}
+    return splice_pages(plan, html_path, pdf_tmp, diag)
+
+
+def render_fragments(plan) -> bool:
+    try:
+        with metrics.stage("fragments"):
+            plan.render_fragments(render_pdf)
+        return True
+    except pages.SpliceError as e:
+        print(f"Static page fragments failed ({e}); rendering the whole document")
+        return False
+
+
+def splice_pages(plan, html_path: str, pdf_tmp: str, diag: dict) -> dict:
+    """
+    Assemble pdf_tmp from the plan's fragments and its rendered dynamic
+    pages; renders the whole document instead if they don't fit together.
+    """
+    try:
+        with metrics.stage("splice"):
+            plan.splice(plan.dynamic_pdf, pdf_tmp)
+    except pages.SpliceError as e:
+        print(f"Page splice failed ({e}); rendering the whole document")
+        return timed_render(render_pdf, html_path, pdf_tmp)
+    return {**diag, "splice": plan.report()}
+
+
+def timed_render(render, *args, stage: str = "render") -> dict:
+    """
+    Run a renderer call, recording its wall time and the engine's CPU time.
+    """
+    with metrics.stage(stage):
+        diag = render(*args)
+    if diag.get("cpu_seconds") is not None:
+        metrics.RENDER_CPU_SECONDS.labels(diag.get("engine") or "unknown").observe(diag["cpu_seconds"])
+    return diag
+
+
+def prepare_html(html_path: str, html) -> dict:
+    """
+    Write the HTML for the renderer and make it renderable offline.
+    Returns the resource report (local assets, cached and blocked URLs).
+    """
+    with metrics.stage("html_write"):
+        assets = write_html(html_path, html)
+    with metrics.stage("resolve"):
+        report = resolve_file(html_path) if RESOURCE_RESOLVER else {}
+    report["assets"] = assets
+    return report
+
+
+def write_html(html_path: str, html) -> dict:
+    """
+    Write html (str or binary stream) for the renderer, resolving asset://
+    references to local files on the way.
+    """
+    rewriter = AssetRewriter(resolve_refs=True)
+    with open(html_path, "wb") as f:
+        if isinstance(html, str):
+            f.write(rewriter.feed(html.encode("utf-8")))
+        else:
+            for chunk in iter(lambda: html.read(1024 * 1024), b""):
+                f.write(rewriter.feed(chunk))
+        f.write(rewriter.flush())
+    return {"resolved": rewriter.resolved, "missing": rewriter.missing}
+
+
+def store_pdf(pdf_tmp: str, job_id: str, diag: dict, resources: dict = None, profile: str = None) -> dict:
+    """
+    Optimize a rendered PDF (profile or PDF_OPTIMIZE_PROFILE), store it as
+    {job_id}.pdf (app/storage.py), index it for downloads and build the task
+    result.
+    """
+    with metrics.stage("optimize"):
+        optimized = optimize_pdf(pdf_tmp, profile)
+
+    pages = count_pages(pdf_tmp)
+    with metrics.stage("store"):
+        location, sha256, size = store_file(job_id, pdf_tmp, f"{job_id}.pdf")
+
+    metrics.PDF_SIZE_BYTES.observe(size)
+    if pages:
+        metrics.PDF_PAGES.observe(pages)
+
+    return {
+        "pdf_path": location,
+        "sha256": sha256,
+        "size": size,
+        "pages": pages,
+        "engine": diag.get("engine"),
+        "stdout": diag.get("stdout", ""),
+        "stderr": diag.get("stderr", ""),
+        "resources": resources or {},
+        "optimize": optimized,
+        "splice": diag.get("splice"),
+    }
+
+
+def store_file(job_id: str, src_path: str, name: str) -> tuple:
+    """
+    Move src_path into PDF storage as name and record it as job_id's download
+    in the file index (app/events.py: no result backend lookup, content hash
+    as ETag). Returns (location, sha256, size).
+    """
+    digest = hashlib.sha256()
+    with open(src_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    size = os.path.getsize(src_path)
+    location = storage.put(src_path, name)
+    events.set_job_file(cache_r, job_id, location, digest.hexdigest(), size)
+    return location, digest.hexdigest(), size
+
+
+@celery.task(name="export_pdfs")
+def export_pdfs(export_id: str, fmt: str, job_ids: list = None, group: list = None,
+                titles: dict = None) -> dict:
+    """
+    Celery task: the PDFs of finished jobs -> one merged PDF (a bookmark per
+    job) or ZIP (app/export.py), indexed like a job's PDF so
+    /download/{export_id} serves it. Jobs are job_ids in order or the
+    members of group ([kind, group_id]) in submission order, titled by their
+    consumer ids; unfinished ones are left out and listed as missing.
+    """
+    with job_outcome(None, export_id) as result:
+        if group:
+            job_ids = events.group_jobs(cache_r, *group)
+            titles = events.group_titles(cache_r, *group)
+        titles = titles or {}
+        items, missing = [], []
+        for job_id, info in zip(job_ids, events.get_job_files(cache_r, job_ids)):
+            if info is None:
+                missing.append(job_id)
+            else:
+                items.append((titles.get(job_id) or job_id, info["path"]))
+
+        with metrics.stage("export"), tempfile.TemporaryDirectory() as td:
+            out_path = os.path.join(td, f"{export_id}.{fmt}")
+            report = write_export(fmt, items, out_path, fetch=storage.local_copy)
+            location, sha256, size = store_file(export_id, out_path, f"{export_id}.{fmt}")
+        result.update(report, pdf_path=location, sha256=sha256, size=size, format=fmt, missing=missing)
+    return result
+
+
+@celery.task(name="gc_storage")
+def gc_storage() -> dict:
+    """
+    Celery task (beat, every PDF_GC_INTERVAL): PDF retention, see app/storage.py.
+    """
+    with metrics.stage("gc"):
+        return storage.gc()
+
+
+@celery.task(name="reconcile_admission")
+def reconcile_admission() -> dict:
+    """
+    Celery task (beat, every ADMISSION_RECONCILE_INTERVAL): drop admission
+    records of jobs that will never start, see app/admission.py.
+    """
+    return admission.reconcile(cache_r)
+
+
+@celery.task(name="generate_pdf_batch", bind=True)
+def generate_pdf_batch(self, documents: list, batch_id: str, division: str = None,
+                       profile: str = None) -> dict:
+    """
+    Celery task: render many documents together.
+    documents = [[job_id, blob_ref, cache_key], ...]
+
+    The batch is rendered with a single engine invocation and split back into
+    {job_id}.pdf files. Each job_id gets its own result in the backend, so
+    /status and /download work per document exactly as for generate_pdf.
+    If the combined render fails, documents are rendered one by one so a
+    single bad bill only fails its own job.
+    """
+    throttle(self, division, cost=len(documents))
+    backend = self.backend
+    job_ids = [doc[0] for doc in documents]
+    cache_keys = [doc[2] if len(doc) > 2 else None for doc in documents]
+    pipe = cache_r.pipeline(transaction=False)
+    for job_id in job_ids:
+        backend.store_result(job_id, None, "STARTED")
+        events.set_job_state(pipe, job_id, "RUNNING")
+    pipe.execute()
+    admission.started(cache_r, job_ids)
+
+    blob_refs = [doc[1] for doc in documents]
+    try:
+        return _render_batch(backend, batch_id, job_ids, blob_refs, cache_keys, profile)
+    except Exception as e:
+        for job_id, key in zip(job_ids, cache_keys):
+            if key:
+                cache.invalidate(cache_r, key, job_id)
+            backend.mark_as_failure(job_id, e)
+            notify(events.set_job_state(cache_r, job_id, "FAILED", **failure_state(e)))
+        raise
+    finally:
+        for ref in blob_refs:
+            blobstore.delete(ref)
+
+
+def _render_batch(backend, batch_id, job_ids, blob_refs, cache_keys, profile=None) -> dict:
+    with tempfile.TemporaryDirectory() as td:
+        html_paths, pdf_paths, reports = [], [], []
+        for i, ref in enumerate(blob_refs):
+            html_path = os.path.join(td, f"input-{i}.html")
+            with blobstore.open_blob(ref) as src:
+                reports.append(prepare_html(html_path, src))
+            html_paths.append(html_path)
+            pdf_paths.append(os.path.join(td, f"output-{i}.pdf"))
+
+        # Static pages come from fragments (app/pages.py): the batch render
+        # only gets the other pages of each document
+        plans = [pages.plan_pages(html_path, cache_r) for html_path in html_paths]
+        plans = [plan if plan is not None and render_fragments(plan) else None for plan in plans]
+        inputs, outputs = [], []
+        for plan, html_path, pdf_tmp in zip(plans, html_paths, pdf_paths):
+            if plan is None:
+                inputs.append(html_path)
+                outputs.append(pdf_tmp)
+            elif plan.dynamic_path:
+                inputs.append(plan.dynamic_path)
+                outputs.append(plan.dynamic_pdf)
+
+        # Only the combined render falls back to one render per document; a
+        # job that fails afterwards (splice, store) fails on its own
+        combined, diag = (batch_supported() if inputs else True), {}
+        if inputs and combined:
+            try:
+                diag = timed_render(render_pdf_batch, inputs, outputs, stage="batch_render")
+            except (RenderError, subprocess.SubprocessError, OSError, ValueError) as e:
+                print(f"Batch {batch_id}: combined render failed ({e}); rendering individually")
+                combined = False
+
+        done = failed = 0
+        for job_id, key, plan, html_path, pdf_tmp, report in zip(
+                job_ids, cache_keys, plans, html_paths, pdf_paths, reports):
+            try:
+                with job_outcome(key, job_id) as result:
+                    if not combined:
+                        doc_diag = render_document(html_path, pdf_tmp, plan)
+                    elif plan is None:
+                        doc_diag = diag
+                    else:
+                        doc_diag = splice_pages(plan, html_path, pdf_tmp, diag)
+                    result.update(store_pdf(pdf_tmp, job_id, doc_diag, report, profile))
+                backend.mark_as_done(job_id, result)
+                done += 1
+            except Exception as e:
+                backend.mark_as_failure(job_id, e)
+                failed += 1
+
+        return {"batch_id": batch_id, "done": done, "failed": failed, "combined": combined}
+
+
+# Metrics (app/metrics.py): queue wait from a publish-time header, and the
+# worker's /metrics endpoint aggregating its prefork children
+@signals.before_task_publish.connect
+def _stamp_enqueued_at(headers=None, **kwargs):
+    if headers is not None:
+        headers.setdefault("enqueued_at", time.time())
+
+
+@signals.task_prerun.connect
+def _observe_queue_wait(task=None, **kwargs):
+    enqueued_at = task.request.get("enqueued_at") if task is not None else None
+    if enqueued_at:
+        queue = (task.request.delivery_info or {}).get("routing_key") or "unknown"
+        metrics.QUEUE_WAIT_SECONDS.labels(queue).observe(max(time.time() - float(enqueued_at), 0))
+
+
+@signals.worker_init.connect
+def _reset_metrics(**kwargs):
+    metrics.clear_multiproc_dir()
+
+
+@signals.worker_init.connect
+def _check_batch_support(**kwargs):
+    # Once in the parent; prefork children inherit the answer
+    batch_supported()
+
+
+@signals.worker_ready.connect
+def _serve_metrics(**kwargs):
+    metrics.start_worker_server()
+
+
+@signals.worker_process_shutdown.connect
+def _child_metrics_done(pid=None, **kwargs):
+    metrics.process_exited(pid or os.getpid())
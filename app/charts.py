@@ -0,0 +1,194 @@
+# app/charts.py
+"""
+Server-side charts for bill templates: consumption series -> inline SVG.
+
+Replaces the Chart.js (CDN) charts drawn in the browser at render time, so a
+render needs no network fetch and no JavaScript. Available in templates as:
+
+    {{ bar_chart(labels, values, label="Units (kWh)") }}
+    {{ pie_chart(labels, values) }}
+    {{ pie_chart(labels, values, donut=True, value_prefix="₹ ") }}
+
+Identical series (e.g. the same tariff split across a division) are rendered
+once per process thanks to an LRU cache.
+"""
+import os
+import math
+from functools import lru_cache
+from html import escape
+
+from markupsafe import Markup
+
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", "4096"))
+
+# Chart.js default palette, so bills look the same as before
+PALETTE = ("#36a2eb", "#ff6384", "#ff9f40", "#ffcd56", "#4bc0c0", "#9966ff", "#c9cbcf")
+FONT = "font-family:Arial,Helvetica,sans-serif"
+
+
+def _value(v) -> float:
+    """
+    A series value as a number: missing or non-numeric values (None, "",
+    "-" for a month with no reading) count as 0 instead of failing the bill.
+    """
+    try:
+        value = float(str(v).replace(",", "") if isinstance(v, str) else v)
+    except (TypeError, ValueError):
+        return 0.0
+    return value if math.isfinite(value) else 0.0
+
+
+def _series(labels, values):
+    """
+    Normalise template data (lists, None, Jinja Undefined) to tuples.
+    """
+    labels = tuple("" if label is None else str(label) for label in (labels or ()))
+    values = tuple(_value(v) for v in (values or ()))
+    n = min(len(labels), len(values))
+    return labels[:n], values[:n]
+
+
+def _fmt(value: float, decimals) -> str:
+    if decimals is None:
+        return f"{value:g}"
+    return f"{value:,.{decimals}f}"
+
+
+def _nice_max(value: float) -> float:
+    if value <= 0:
+        return 1.0
+    magnitude = 10 ** math.floor(math.log10(value))
+    for step in (1, 2, 2.5, 5, 10):
+        if value <= step * magnitude:
+            return step * magnitude
+    return 10 * magnitude
+
+
+def bar_chart(labels, values, label=None, width=360, height=160, y_min=None, y_max=None,
+              decimals=None, color=PALETTE[0], y_title=None, css_id=None):
+    labels, values = _series(labels, values)
+    return Markup(_bar_svg(labels, values, label, width, height, y_min, y_max,
+                           decimals, color, y_title, css_id))
+
+
+def pie_chart(labels, values, width=240, height=200, donut=False, decimals=None,
+              value_prefix="", value_suffix="", colors=None, css_id=None):
+    labels, values = _series(labels, values)
+    colors = tuple(colors) if colors else PALETTE
+    return Markup(_pie_svg(labels, values, width, height, donut, decimals,
+                           value_prefix, value_suffix, colors, css_id))
+
+
+def _svg_open(width, height, css_id):
+    id_attr = f' id="{escape(css_id)}"' if css_id else ""
+    return (f'<svg xmlns="http://www.w3.org/2000/svg"{id_attr} width="{width}" height="{height}" '
+            f'viewBox="0 0 {width} {height}" style="{FONT}">')
+
+
+@lru_cache(maxsize=CHART_CACHE_SIZE)
+def _bar_svg(labels, values, label, width, height, y_min, y_max, decimals, color, y_title, css_id):
+    out = [_svg_open(width, height, css_id)]
+    if not values:
+        out.append("</svg>")
+        return "".join(out)
+
+    legend_h = 14 if label else 0
+    left, right, top, bottom = (34 if y_title else 26), 6, 12 + legend_h, 16
+    plot_w, plot_h = width - left - right, height - top - bottom
+
+    lo = 0.0 if y_min is None else float(y_min)
+    hi = _nice_max(max(values)) if y_max is None else float(y_max)
+    span = (hi - lo) or 1.0
+
+    def y(v):
+        v = min(max(v, lo), hi)
+        return top + plot_h - (v - lo) / span * plot_h
+
+    if label:
+        out.append(f'<rect x="{width / 2 - 40:.1f}" y="2" width="10" height="8" fill="{color}"/>'
+                   f'<text x="{width / 2 - 26:.1f}" y="9" font-size="8">{escape(label)}</text>')
+    if y_title:
+        out.append(f'<text x="8" y="{top + plot_h / 2:.1f}" font-size="7" text-anchor="middle" '
+                   f'transform="rotate(-90 8 {top + plot_h / 2:.1f})">{escape(y_title)}</text>')
+
+    # Grid + y ticks
+    for i in range(5):
+        v = lo + span * i / 4
+        gy = y(v)
+        out.append(f'<line x1="{left}" y1="{gy:.1f}" x2="{left + plot_w}" y2="{gy:.1f}" '
+                   f'stroke="#e5e5e5" stroke-width="0.5"/>'
+                   f'<text x="{left - 3}" y="{gy + 2.5:.1f}" font-size="7" text-anchor="end">'
+                   f'{_fmt(v, decimals)}</text>')
+
+    slot = plot_w / len(values)
+    bar_w = slot * 0.7
+    for i, (name, v) in enumerate(zip(labels, values)):
+        x = left + i * slot + (slot - bar_w) / 2
+        by = y(v)
+        out.append(f'<rect x="{x:.1f}" y="{by:.1f}" width="{bar_w:.1f}" '
+                   f'height="{top + plot_h - by:.1f}" fill="{color}" fill-opacity="0.6" '
+                   f'stroke="{color}" stroke-width="0.8"/>'
+                   f'<text x="{x + bar_w / 2:.1f}" y="{by - 2:.1f}" font-size="7" '
+                   f'text-anchor="middle">{_fmt(v, decimals)}</text>'
+                   f'<text x="{x + bar_w / 2:.1f}" y="{height - 5}" font-size="7" '
+                   f'text-anchor="middle">{escape(name)}</text>')
+
+    out.append(f'<line x1="{left}" y1="{top + plot_h}" x2="{left + plot_w}" y2="{top + plot_h}" '
+               f'stroke="#999" stroke-width="0.8"/></svg>')
+    return "".join(out)
+
+
+@lru_cache(maxsize=CHART_CACHE_SIZE)
+def _pie_svg(labels, values, width, height, donut, decimals, value_prefix, value_suffix, colors, css_id):
+    out = [_svg_open(width, height, css_id)]
+    total = sum(v for v in values if v > 0)
+    if not total:
+        out.append("</svg>")
+        return "".join(out)
+
+    legend_rows = math.ceil(len(labels) / 2)
+    legend_h = legend_rows * 11 + 4
+    cx, cy = width / 2, (height - legend_h) / 2
+    radius = min(width, height - legend_h) / 2 - 4
+    inner = radius * 0.55 if donut else 0
+
+    angle = -math.pi / 2  # start at 12 o'clock like Chart.js
+    for i, v in enumerate(values):
+        if v <= 0:
+            continue
+        color = colors[i % len(colors)]
+        sweep = v / total * 2 * math.pi
+        end = angle + sweep
+        large = 1 if sweep > math.pi else 0
+
+        if sweep >= 2 * math.pi - 1e-9:
+            out.append(f'<circle cx="{cx:.1f}" cy="{cy:.1f}" r="{radius:.1f}" fill="{color}"/>')
+        else:
+            x0, y0 = cx + radius * math.cos(angle), cy + radius * math.sin(angle)
+            x1, y1 = cx + radius * math.cos(end), cy + radius * math.sin(end)
+            out.append(f'<path d="M{cx:.1f},{cy:.1f} L{x0:.1f},{y0:.1f} '
+                       f'A{radius:.1f},{radius:.1f} 0 {large} 1 {x1:.1f},{y1:.1f} Z" '
+                       f'fill="{color}" stroke="#fff" stroke-width="1"/>')
+
+        mid = angle + sweep / 2
+        label_r = (radius + inner) / 2 if donut else radius * 0.62
+        tx, ty = cx + label_r * math.cos(mid), cy + label_r * math.sin(mid)
+        text = f"{value_prefix}{_fmt(v, decimals)}{value_suffix}"
+        out.append(f'<text x="{tx:.1f}" y="{ty + 2.5:.1f}" font-size="7" font-weight="bold" '
+                   f'text-anchor="middle">{escape(text)}</text>')
+        angle = end
+
+    if donut:
+        out.append(f'<circle cx="{cx:.1f}" cy="{cy:.1f}" r="{inner:.1f}" fill="#fff"/>')
+
+    # Legend, two columns under the chart
+    col_w = width / 2
+    for i, name in enumerate(labels):
+        lx = 4 + (i % 2) * col_w
+        ly = height - legend_h + 4 + (i // 2) * 11
+        out.append(f'<rect x="{lx:.1f}" y="{ly:.1f}" width="10" height="7" '
+                   f'fill="{colors[i % len(colors)]}"/>'
+                   f'<text x="{lx + 13:.1f}" y="{ly + 6.5:.1f}" font-size="7">{escape(name)}</text>')
+
+    out.append("</svg>")
+    return "".join(out)
@@ -0,0 +1,389 @@
+# app/events.py
+"""
+Job state records and push notifications.
+
+Every job has a small JSON state record  job_state:{job_id}
+    {"job_id", "status": PENDING|RUNNING|DONE|FAILED, "error"?, "updated_at"}
+written by the API at enqueue and by the worker as the job progresses. Each
+change is also PUBLISHed on  job_events:{job_id}.
+
+The API reads the record instead of asking the Celery result backend, and
+waits for changes through one pattern subscription per process
+(JobWatcher) instead of polling: long-poll /status, the /events SSE stream
+and synchronous /render all wait this way. Optional per-job webhooks, a set
+of callback URLs  job_webhooks:{job_id}  (one per request served by the
+job), are fired by the worker when the job finishes.
+
+Finished jobs also get a file index record  job_file:{job_id}
+    {"path", "sha256", "size"}
+so /download serves the PDF (with the content hash as its ETag) without
+going through the Celery result backend. A result cache hit keeps both
+records of the job it returns alive (keep_done_job).
+
+Jobs submitted as part of a billing cycle or a batch are also recorded in a
+group zset  job_groups:{kind}:{id}  scored by submission order, with their
+consumer ids in  job_group_titles:{kind}:{id}, so a whole run can be
+exported in the order it was submitted. Progress is kept as it happens:
+job_group_counts:{kind}:{id}  {status: jobs, "total"} and the failed members
+job_group_failed:{kind}:{id}  are updated by every state change of a member
+(each job lists its groups in  job_member_of:{job_id}), so a cycle's
+summary costs the same however large the cycle. Groups recorded before
+these counters are summarised with pipelined MGETs of the state records
+(get_job_states).
+
+Writers take a client or a pipeline, sync or asyncio (queue the commands on
+an asyncio pipeline, then await its execute()); readers used by the API
+have *_async variants for its asyncio client.
+"""
+import os
+import re
+import json
+import asyncio
+from datetime import datetime
+from collections import defaultdict
+from contextlib import contextmanager
+
+JOB_STATE_TTL = int(os.getenv("JOB_STATE_TTL", str(7 * 24 * 3600)))
+
+STATE_PREFIX = "job_state:"
+CHANNEL_PREFIX = "job_events:"
+WEBHOOK_PREFIX = "job_webhooks:"
+LEGACY_WEBHOOK_PREFIX = "job_webhook:"  # one URL (string), before webhook sets
+FILE_PREFIX = "job_file:"
+GROUP_PREFIX = "job_groups:"
+GROUP_TITLES_PREFIX = "job_group_titles:"
+GROUP_COUNTS_PREFIX = "job_group_counts:"
+GROUP_FAILED_PREFIX = "job_group_failed:"  # zset, scored like the group
+MEMBER_OF_PREFIX = "job_member_of:"
+LEGACY_GROUP_PREFIX = "job_group:"  # unordered set, before ordered groups
+FINAL_STATES = ("DONE", "FAILED")
+GROUP_KINDS = ("cycle", "batch")
+# MGET size per pipelined command when reading many states
+STATE_READ_CHUNK = int(os.getenv("STATE_READ_CHUNK", "1000"))
+
+_GROUP_ID_RE = re.compile(r"^[A-Za-z0-9_.:-]{1,128}$")
+
+# Append the jobs not yet in the group after its last member, keeping the
+# position of those already in it (a resubmitted bill does not move), and
+# record their titles (consumer ids). New members are counted under their
+# current status and learn that they belong to the group; counters are only
+# kept for groups that had them from their first member.
+# KEYS: group, titles, counts, failed. ARGV: ttl, state prefix, member-of
+# prefix, "kind:id", then job_id, title pairs.
+_ADD_TO_GROUP = """
+local counted = redis.call('EXISTS', KEYS[3]) == 1 or redis.call('EXISTS', KEYS[1]) == 0
+local last = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+local seq = tonumber(last[2] or '0')
+for i = 5, #ARGV, 2 do
+    local job_id = ARGV[i]
+    if redis.call('ZADD', KEYS[1], 'NX', seq + 1, job_id) == 1 then
+        seq = seq + 1
+        redis.call('SADD', ARGV[3] .. job_id, ARGV[4])
+        redis.call('EXPIRE', ARGV[3] .. job_id, ARGV[1])
+        if counted then
+            local state = redis.call('GET', ARGV[2] .. job_id)
+            local status = state and cjson.decode(state)['status'] or 'UNKNOWN'
+            redis.call('HINCRBY', KEYS[3], 'total', 1)
+            redis.call('HINCRBY', KEYS[3], status, 1)
+            if status == 'FAILED' then
+                redis.call('ZADD', KEYS[4], seq, job_id)
+            end
+        end
+    end
+    if ARGV[i + 1] ~= '' then
+        redis.call('HSETNX', KEYS[2], job_id, ARGV[i + 1])
+    end
+end
+for k = 1, 4 do
+    redis.call('EXPIRE', KEYS[k], ARGV[1])
+end
+return seq
+"""
+
+# Write a job's state record and move the job between the status counters
+# (and failed lists) of the groups it belongs to.
+# KEYS: state, member-of. ARGV: record, status, ttl, job_id, the group,
+# counts and failed key prefixes, then "1" to only refresh an existing record.
+_SET_STATE = """
+local prev = redis.call('GET', KEYS[1])
+if prev and ARGV[8] == '1' then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    return 0
+end
+local old = prev and cjson.decode(prev)['status'] or 'UNKNOWN'
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+if old == ARGV[2] then
+    return 0
+end
+for _, group in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+    local counts = ARGV[6] .. group
+    if redis.call('EXISTS', counts) == 1 then
+        redis.call('HINCRBY', counts, old, -1)
+        redis.call('HINCRBY', counts, ARGV[2], 1)
+        local failed = ARGV[7] .. group
+        if ARGV[2] == 'FAILED' then
+            local seq = redis.call('ZSCORE', ARGV[5] .. group, ARGV[4])
+            redis.call('ZADD', failed, seq or 0, ARGV[4])
+            redis.call('EXPIRE', failed, redis.call('TTL', counts))
+        elseif old == 'FAILED' then
+            redis.call('ZREM', failed, ARGV[4])
+        end
+    end
+end
+return 1
+"""
+
+
+def state_key(job_id: str) -> str:
+    return STATE_PREFIX + job_id
+
+
+def set_job_state(r, job_id: str, status: str, **fields) -> dict:
+    """
+    Record and publish a job state change, updating the progress counters of
+    its groups (works with a Redis pipeline too).
+    """
+    state = {"job_id": job_id, "status": status, **fields,
+             "updated_at": datetime.utcnow().isoformat()}
+    payload = json.dumps(state)
+    _write_state(r, job_id, payload, status)
+    r.publish(CHANNEL_PREFIX + job_id, payload)
+    return state
+
+
+def _write_state(r, job_id: str, payload: str, status: str, keep_existing: bool = False):
+    r.eval(_SET_STATE, 2, state_key(job_id), MEMBER_OF_PREFIX + job_id, payload, status, JOB_STATE_TTL,
+           job_id, GROUP_PREFIX, GROUP_COUNTS_PREFIX, GROUP_FAILED_PREFIX, "1" if keep_existing else "0")
+
+
+def add_webhook(r, job_id: str, url: str):
+    r.sadd(WEBHOOK_PREFIX + job_id, url)
+    r.expire(WEBHOOK_PREFIX + job_id, JOB_STATE_TTL)
+
+
+def remove_webhook(r, job_id: str, url: str):
+    """
+    Take url back from the job; 1 if it was still there (i.e. not yet taken
+    by pop_webhooks).
+    """
+    return r.srem(WEBHOOK_PREFIX + job_id, url)
+
+
+def pop_webhooks(r, job_id: str) -> list:
+    """
+    All callback URLs of a job, removed atomically (sync client).
+    """
+    pipe = r.pipeline()
+    pipe.smembers(WEBHOOK_PREFIX + job_id)
+    pipe.delete(WEBHOOK_PREFIX + job_id)
+    pipe.getdel(LEGACY_WEBHOOK_PREFIX + job_id)
+    urls, _, legacy = pipe.execute()
+    return sorted(urls | ({legacy} if legacy else set()))
+
+
+def set_job_file(r, job_id: str, path: str, sha256: str, size: int):
+    key = FILE_PREFIX + job_id
+    r.hset(key, mapping={"path": path, "sha256": sha256, "size": size})
+    r.expire(key, JOB_STATE_TTL)
+
+
+def keep_done_job(r, job_id: str, entry: dict):
+    """
+    On a hit on a DONE result cache entry (app/cache.py), which lives as long
+    as it is used: refresh the job's state and file records, or re-create
+    them from the entry once they have expired, so /status and /download
+    agree with the hit (works with a pipeline too).
+    """
+    state = {"job_id": job_id, "status": "DONE", "updated_at": datetime.utcnow().isoformat()}
+    _write_state(r, job_id, json.dumps(state), "DONE", keep_existing=True)
+    info = {"path": entry["pdf_path"]}
+    if entry.get("sha256"):
+        info.update(sha256=entry["sha256"], size=entry.get("size") or 0)
+    r.hset(FILE_PREFIX + job_id, mapping=info)
+    r.expire(FILE_PREFIX + job_id, JOB_STATE_TTL)
+
+
+def get_job_file(r, job_id: str):
+    """
+    {"path", "sha256", "size"} of a finished job's PDF, or None.
+    """
+    return r.hgetall(FILE_PREFIX + job_id) or None
+
+
+async def get_job_file_async(ar, job_id: str):
+    return await ar.hgetall(FILE_PREFIX + job_id) or None
+
+
+def get_job_files(r, job_ids: list) -> list:
+    """
+    get_job_file() for many jobs, in one pipeline.
+    """
+    pipe = r.pipeline(transaction=False)
+    for job_id in job_ids:
+        pipe.hgetall(FILE_PREFIX + job_id)
+    return [info or None for info in pipe.execute()]
+
+
+def get_job_states(r, job_ids: list) -> list:
+    """
+    State records of many jobs (None where missing / expired), read with
+    MGETs of STATE_READ_CHUNK keys sent in one pipeline.
+    """
+    pipe = r.pipeline(transaction=False)
+    _read_states(pipe, job_ids)
+    return _parse_states(pipe.execute())
+
+
+async def get_job_states_async(ar, job_ids: list) -> list:
+    pipe = ar.pipeline(transaction=False)
+    _read_states(pipe, job_ids)
+    return _parse_states(await pipe.execute())
+
+
+def _read_states(pipe, job_ids: list):
+    for start in range(0, len(job_ids), STATE_READ_CHUNK):
+        pipe.mget([state_key(j) for j in job_ids[start:start + STATE_READ_CHUNK]])
+
+
+def _parse_states(results: list) -> list:
+    states = []
+    for values in results:
+        states.extend(json.loads(v) if v else None for v in values)
+    return states
+
+
+def valid_group_id(group_id: str) -> bool:
+    return bool(_GROUP_ID_RE.match(group_id or ""))
+
+
+def group_key(kind: str, group_id: str) -> str:
+    return f"{GROUP_PREFIX}{kind}:{group_id}"
+
+
+def add_to_group(r, kind: str, group_id: str, job_ids: list, titles: dict = None):
+    """
+    Record job_ids, in submission order, as members of a cycle / batch, with
+    optional titles {job_id: consumer_id} (works with a pipeline too).
+    """
+    if not job_ids:
+        return
+    titles = titles or {}
+    suffix = f"{kind}:{group_id}"
+    args = [JOB_STATE_TTL, STATE_PREFIX, MEMBER_OF_PREFIX, suffix]
+    for job_id in job_ids:
+        args += [job_id, titles.get(job_id) or ""]
+    r.eval(_ADD_TO_GROUP, 4, GROUP_PREFIX + suffix, GROUP_TITLES_PREFIX + suffix,
+           GROUP_COUNTS_PREFIX + suffix, GROUP_FAILED_PREFIX + suffix, *args)
+
+
+def _read_group(r, kind: str, group_id: str):
+    pipe = r.pipeline(transaction=False)
+    pipe.zrange(group_key(kind, group_id), 0, -1)
+    pipe.smembers(f"{LEGACY_GROUP_PREFIX}{kind}:{group_id}")
+    return pipe
+
+
+def _members(ordered: list, legacy: set) -> list:
+    return ordered + sorted(set(legacy).difference(ordered))
+
+
+def group_jobs(r, kind: str, group_id: str) -> list:
+    """
+    Member job ids of a group in submission order (members of a group
+    recorded before ordered groups follow, sorted), so pages over them are
+    stable and exports follow the billing run.
+    """
+    return _members(*_read_group(r, kind, group_id).execute())
+
+
+async def group_jobs_async(ar, kind: str, group_id: str) -> list:
+    return _members(*await _read_group(ar, kind, group_id).execute())
+
+
+async def group_progress_async(ar, kind: str, group_id: str, failures_offset: int, failures_limit: int):
+    """
+    ({status: jobs, "total"}, one page of failed member job ids) from the
+    group's counters, or None for a group recorded without them.
+    """
+    suffix = f"{kind}:{group_id}"
+    pipe = ar.pipeline(transaction=False)
+    pipe.hgetall(GROUP_COUNTS_PREFIX + suffix)
+    if failures_limit > 0:
+        pipe.zrange(GROUP_FAILED_PREFIX + suffix, failures_offset, failures_offset + failures_limit - 1)
+    counts, *failed = await pipe.execute()
+    if not counts:
+        return None
+    return {status: int(n) for status, n in counts.items()}, (failed[0] if failed else [])
+
+
+def group_titles(r, kind: str, group_id: str) -> dict:
+    """
+    {job_id: title} recorded for members of a group (their consumer ids).
+    """
+    return r.hgetall(f"{GROUP_TITLES_PREFIX}{kind}:{group_id}")
+
+
+class JobWatcher:
+    """
+    Single pattern subscription (job_events:*) per API process, fanning
+    events out to in-process waiters:
+
+        with watcher.watch(job_ids) as events:   # asyncio.Queue
+            ... check current state, then await events.get()
+
+    Register first, then read the current state, so no event is missed.
+    """
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self._waiters = defaultdict(set)
+        self._task = None
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.psubscribe(CHANNEL_PREFIX + "*")
+                async for message in pubsub.listen():
+                    if message.get("type") != "pmessage":
+                        continue
+                    channel = message["channel"]
+                    if isinstance(channel, bytes):
+                        channel = channel.decode("utf-8")
+                    job_id = channel[len(CHANNEL_PREFIX):]
+                    waiters = self._waiters.get(job_id)
+                    if not waiters:
+                        continue
+                    event = json.loads(message["data"])
+                    for queue in list(waiters):
+                        queue.put_nowait(event)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"JobWatcher: subscription lost ({e}); reconnecting")
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    @contextmanager
+    def watch(self, job_ids):
+        self._ensure_started()
+        queue = asyncio.Queue()
+        for job_id in job_ids:
+            self._waiters[job_id].add(queue)
+        try:
+            yield queue
+        finally:
+            for job_id in job_ids:
+                waiters = self._waiters.get(job_id)
+                if waiters is not None:
+                    waiters.discard(queue)
+                    if not waiters:
+                        del self._waiters[job_id]
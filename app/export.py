@@ -0,0 +1,217 @@
+# app/export.py
+"""
+Exports of many finished PDFs (a batch, a billing cycle, a list of jobs) as
+one file, for print vendors and archives:
+
+  pdf  all bills concatenated, one bookmark per bill
+  zip  one entry per bill (stored: PDFs are already compressed)
+
+Both are written source by source straight to the output file: memory use
+does not grow with the number of bills (only the page list and the
+bookmarks are kept until the end).
+"""
+import re
+import zipfile
+from contextlib import nullcontext
+
+from pypdf import PdfReader
+from pypdf.errors import PyPdfError
+from pypdf.generic import (
+    ArrayObject,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    NullObject,
+    NumberObject,
+    StreamObject,
+    TextStringObject,
+)
+
+EXPORT_FORMATS = ("pdf", "zip")
+
+_UNSAFE_NAME = re.compile(r"[^A-Za-z0-9_.-]+")
+
+
+class ExportError(ValueError):
+    pass
+
+
+def check_format(fmt: str):
+    if fmt not in EXPORT_FORMATS:
+        raise ExportError(f"Unknown export format {fmt!r} (one of {', '.join(EXPORT_FORMATS)})")
+
+
+def write_export(fmt: str, items, out_path: str, fetch=nullcontext) -> dict:
+    """
+    Write items ((title, location) pairs, in order) to out_path as a merged
+    PDF or a ZIP. fetch(location) is a context manager yielding a local path
+    (e.g. app/storage.py local_copy). Unreadable sources are skipped and
+    reported.
+    """
+    check_format(fmt)
+    if fmt == "zip":
+        return write_zip(items, out_path, fetch)
+    return merge_pdfs(items, out_path, fetch)
+
+
+def write_zip(items, out_path: str, fetch=nullcontext) -> dict:
+    names, skipped = set(), []
+    with zipfile.ZipFile(out_path, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for title, location in items:
+            try:
+                with fetch(location) as pdf_path:
+                    zf.write(pdf_path, arcname=_unique_name(title, names))
+            except OSError:
+                skipped.append(title)
+    return {"documents": len(items) - len(skipped), "skipped": skipped}
+
+
+def merge_pdfs(items, out_path: str, fetch=nullcontext) -> dict:
+    with open(out_path, "wb") as f:
+        merger = _PdfConcat(f)
+        skipped = []
+        for title, location in items:
+            try:
+                with fetch(location) as pdf_path:
+                    merger.add(pdf_path, title)
+            except (PyPdfError, OSError, ValueError):
+                skipped.append(title)
+        merger.finish()
+    return {"documents": len(merger.outline), "pages": len(merger.kids), "skipped": skipped}
+
+
+def _unique_name(title: str, taken: set) -> str:
+    base = _UNSAFE_NAME.sub("_", title).strip("._")[:100] or "bill"
+    name, n = f"{base}.pdf", 1
+    while name in taken:
+        n += 1
+        name = f"{base}-{n}.pdf"
+    taken.add(name)
+    return name
+
+
+class _PdfConcat:
+    """
+    Minimal PDF writer appending the pages of one source PDF at a time.
+
+    Objects reachable from a source's pages are renumbered and written as they
+    are visited; references to the source's page tree point at the merged
+    one. Page tree, outline, catalog and xref table are written by finish().
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.offsets = [None]  # object number -> file offset (0 is the free entry)
+        self.pages_ref = self._alloc()
+        self.kids, self.outline = [], []
+        f.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+    def _alloc(self) -> IndirectObject:
+        self.offsets.append(None)
+        return IndirectObject(len(self.offsets) - 1, 0, None)
+
+    def _write(self, ref: IndirectObject, obj):
+        self.offsets[ref.idnum] = self.f.tell()
+        self.f.write(f"{ref.idnum} 0 obj\n".encode())
+        obj.write_to_stream(self.f)
+        self.f.write(b"\nendobj\n")
+
+    def add(self, pdf_path: str, title: str):
+        reader = PdfReader(pdf_path)
+        if reader.is_encrypted:
+            raise ValueError(f"{pdf_path} is encrypted")
+        pages = reader.pages  # inherited attributes are copied onto each page
+        refs, queue = {}, []
+
+        def ref(src: IndirectObject) -> IndirectObject:
+            key = (src.idnum, src.generation)
+            if key not in refs:
+                target = src.get_object()
+                if target is None:  # dangling reference
+                    target = NullObject()
+                if isinstance(target, DictionaryObject) and target.get("/Type") == "/Pages":
+                    refs[key] = self.pages_ref
+                else:
+                    refs[key] = self._alloc()
+                    queue.append((refs[key], target))
+            return refs[key]
+
+        def copy(obj):
+            if isinstance(obj, IndirectObject):
+                return ref(obj)
+            if isinstance(obj, StreamObject):
+                out = StreamObject()
+                out._data = obj._data  # raw (still encoded) stream data
+                out.update({k: copy(v) for k, v in obj.items() if k != "/Length"})
+                return out
+            if isinstance(obj, DictionaryObject):
+                return DictionaryObject({k: copy(v) for k, v in obj.items()})
+            if isinstance(obj, ArrayObject):
+                return ArrayObject(copy(v) for v in obj)
+            return obj
+
+        first = len(self.kids)
+        try:
+            for page in pages:
+                if page.indirect_reference is None:
+                    raise ValueError(f"{pdf_path}: page without object number")
+                self.kids.append(ref(page.indirect_reference))
+            while queue:
+                out_ref, obj = queue.pop()
+                self._write(out_ref, copy(obj))
+        except Exception:
+            # Objects already written stay unreferenced; unwritten ones are
+            # listed as free in the xref table
+            del self.kids[first:]
+            raise
+        if len(self.kids) > first:
+            self.outline.append((title, self.kids[first]))
+
+    def finish(self):
+        outline_ref = self._write_outline() if self.outline else None
+        self._write(self.pages_ref, DictionaryObject({
+            NameObject("/Type"): NameObject("/Pages"),
+            NameObject("/Kids"): ArrayObject(self.kids),
+            NameObject("/Count"): NumberObject(len(self.kids)),
+        }))
+        catalog = DictionaryObject({
+            NameObject("/Type"): NameObject("/Catalog"),
+            NameObject("/Pages"): self.pages_ref,
+        })
+        if outline_ref is not None:
+            catalog[NameObject("/Outlines")] = outline_ref
+            catalog[NameObject("/PageMode")] = NameObject("/UseOutlines")
+        root_ref = self._alloc()
+        self._write(root_ref, catalog)
+
+        xref = self.f.tell()
+        self.f.write(f"xref\n0 {len(self.offsets)}\n0000000000 65535 f \n".encode())
+        for offset in self.offsets[1:]:
+            if offset is None:
+                self.f.write(b"0000000000 00001 f \n")
+            else:
+                self.f.write(f"{offset:010d} 00000 n \n".encode())
+        self.f.write(f"trailer\n<< /Size {len(self.offsets)} /Root {root_ref.idnum} 0 R >>\n"
+                     f"startxref\n{xref}\n%%EOF\n".encode())
+
+    def _write_outline(self) -> IndirectObject:
+        root = self._alloc()
+        items = [self._alloc() for _ in self.outline]
+        for i, (title, page_ref) in enumerate(self.outline):
+            item = DictionaryObject({
+                NameObject("/Title"): TextStringObject(title),
+                NameObject("/Parent"): root,
+                NameObject("/Dest"): ArrayObject([page_ref, NameObject("/Fit")]),
+            })
+            if i > 0:
+                item[NameObject("/Prev")] = items[i - 1]
+            if i + 1 < len(items):
+                item[NameObject("/Next")] = items[i + 1]
+            self._write(items[i], item)
+        self._write(root, DictionaryObject({
+            NameObject("/Type"): NameObject("/Outlines"),
+            NameObject("/First"): items[0],
+            NameObject("/Last"): items[-1],
+            NameObject("/Count"): NumberObject(len(items)),
+        }))
+        return root
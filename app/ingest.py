@@ -0,0 +1,189 @@
+# app/ingest.py
+"""
+Streaming request ingestion: the body goes chunk by chunk from the socket,
+through optional decompression (Content-Encoding: gzip / zstd), into the
+blob store, with its SHA-256 computed on the way. Memory per request stays
+at roughly one chunk instead of two or three copies of the whole payload.
+
+MAX_BODY_BYTES bounds both the bytes received and the decoded size (so a
+small compressed upload cannot expand without limit). The other endpoints'
+bodies (JSON, templates, assets) are read whole with read_body / read_json,
+under the same kind of limit.
+
+Decoding, hashing, asset extraction and the blob writes run in the API's
+bounded thread pool (app/offload.py), one chunk at a time, so a large upload
+does not hold up the event loop.
+"""
+import os
+import json
+import zlib
+import hashlib
+from dataclasses import dataclass
+
+from fastapi import HTTPException, Request
+
+from . import blobstore
+from .assets import AssetRewriter
+from .offload import run_blocking
+
+try:
+    import zstandard
+except ImportError:  # optional: zstd uploads are then rejected with 415
+    zstandard = None
+
+_DECODE_ERRORS = (zlib.error, ValueError) + ((zstandard.ZstdError,) if zstandard else ())
+
+MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", str(20 * 1024 * 1024)))
+_DECODE_CHUNK = 256 * 1024
+_ZSTD_SLICE = 64  # compressed bytes per decompress step (<= ~2 MB out)
+
+
+@dataclass
+class IngestedBody:
+    blob_ref: str
+    sha256: str
+    size: int
+    assets_extracted: int = 0
+
+
+class _Identity:
+    def feed(self, data: bytes):
+        yield data
+
+    def flush(self):
+        return iter(())
+
+
+class _Gzip:
+    def __init__(self):
+        self._d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def feed(self, data: bytes):
+        # Bounded output per call; the rest stays in unconsumed_tail
+        while data:
+            out = self._d.decompress(data, _DECODE_CHUNK)
+            data = self._d.unconsumed_tail
+            if out:
+                yield out
+
+    def flush(self):
+        tail = self._d.flush()
+        if not self._d.eof:
+            raise HTTPException(status_code=400, detail="Truncated gzip body")
+        return iter([tail] if tail else [])
+
+
+class _Zstd:
+    def __init__(self):
+        self._d = zstandard.ZstdDecompressor().decompressobj()
+
+    def feed(self, data: bytes):
+        # decompress() has no output bound, but a zstd block of at most
+        # 128 KiB takes at least 4 input bytes: small slices keep each step
+        # to a few MB, and consume() stops at the size limit in between
+        for i in range(0, len(data), _ZSTD_SLICE):
+            out = self._d.decompress(data[i:i + _ZSTD_SLICE])
+            for j in range(0, len(out), _DECODE_CHUNK):
+                yield out[j:j + _DECODE_CHUNK]
+
+    def flush(self):
+        if not self._d.eof:
+            raise HTTPException(status_code=400, detail="Truncated zstd body")
+        return iter(())
+
+
+def _decoder(encoding: str):
+    encoding = (encoding or "identity").strip().lower()
+    if encoding in ("", "identity"):
+        return _Identity()
+    if encoding in ("gzip", "x-gzip"):
+        return _Gzip()
+    if encoding == "zstd" and zstandard is not None:
+        return _Zstd()
+    raise HTTPException(status_code=415, detail=f"Unsupported Content-Encoding {encoding!r}")
+
+
+def _too_large(max_bytes: int = MAX_BODY_BYTES):
+    return HTTPException(status_code=413, detail=f"Body exceeds {max_bytes} bytes")
+
+
+async def read_body(request: Request, max_bytes: int = MAX_BODY_BYTES) -> bytes:
+    """
+    The whole request body, or 413 once it is larger than max_bytes (early
+    from Content-Length when present).
+    """
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > max_bytes:
+        raise _too_large(max_bytes)
+    chunks, received = [], 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > max_bytes:
+            raise _too_large(max_bytes)
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+async def read_json(request: Request, max_bytes: int = MAX_BODY_BYTES):
+    """
+    read_body() parsed as JSON in the thread pool; 400 if it is not JSON.
+    """
+    body = await read_body(request, max_bytes)
+    try:
+        return await run_blocking(json.loads, body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be JSON")
+
+
+async def ingest_body(request: Request, max_bytes: int = MAX_BODY_BYTES,
+                      extract_assets: bool = False) -> IngestedBody:
+    """
+    Stream the request body into the blob store.
+    With extract_assets, inline data:image URIs are moved to the asset store
+    and replaced by asset:// references (the hash is still of the original body).
+    Raises 413 if the body is too large (early from Content-Length when
+    present), 415 for unknown encodings and 400 for empty / bad bodies.
+    """
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > max_bytes:
+        raise _too_large(max_bytes)
+
+    decoder = _decoder(request.headers.get("content-encoding"))
+    rewriter = AssetRewriter(extract_inline=extract_assets)
+    digest = hashlib.sha256()
+    received = size = 0
+    blank = True
+
+    try:
+        with blobstore.BlobWriter() as w:
+            def consume(chunks):
+                nonlocal blank, size
+                for data in chunks:
+                    size += len(data)
+                    if size > max_bytes:
+                        raise _too_large(max_bytes)
+                    digest.update(data)
+                    blank = blank and not data.strip()
+                    w.write(rewriter.feed(data))
+
+            def finish():
+                consume(decoder.flush())
+                w.write(rewriter.flush())
+
+            async for chunk in request.stream():
+                if not chunk:
+                    continue
+                received += len(chunk)
+                if received > max_bytes:
+                    raise _too_large(max_bytes)
+                await run_blocking(consume, decoder.feed(chunk))
+            await run_blocking(finish)
+    except _DECODE_ERRORS as e:
+        raise HTTPException(status_code=400, detail=f"Cannot decode body: {e}")
+
+    if blank:
+        await run_blocking(blobstore.delete, w.ref)
+        raise HTTPException(status_code=400, detail="Empty HTML body")
+
+    return IngestedBody(blob_ref=w.ref, sha256=digest.hexdigest(), size=size,
+                        assets_extracted=rewriter.extracted)
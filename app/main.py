@@ -1,26 +1,96 @@
 # app/main.py
 import os
+import json
 import uuid
+import asyncio
 import hashlib
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from celery.result import AsyncResult
 import redis
+import redis.asyncio as aioredis
 
-from .celery_app import celery
+from .celery_app import celery, BATCH_RENDER_SIZE, BULK_QUEUE, PRIORITY_QUEUES
+from .templates import TemplateError, register_template, list_templates, template_exists, template_version
+from .cache import cache_key, claim, invalidate
+from . import blobstore, metrics, storage, webhooks
+from .ingest import MAX_BODY_BYTES, ingest_body, read_body, read_json
+from .assets import ASSET_EXTRACT_INLINE, ASSET_MAX_BYTES, AssetError, put_asset, asset_path
+from .pdfopt import OptimizeError, check_profile
+from .export import EXPORT_FORMATS
+from .qr import DEFAULT_BORDER, DEFAULT_SCALE, QRError, check_options as check_qr_options, encode_batch
+from .offload import run_blocking
+from .admission import (
+    READY_MAX_FILL, AdmissionError, backlog, busy_retry_after, check_client, client_id, release, reserve,
+)
+from .events import (
+    FINAL_STATES, GROUP_KINDS, JobWatcher, add_to_group, add_webhook, get_job_file_async, get_job_states,
+    get_job_states_async, group_jobs_async, group_progress_async, keep_done_job, remove_webhook, set_job_state,
+    valid_group_id,
+)
 
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
 REDIS_DB_HASH = int(os.getenv("REDIS_DB_HASH", "2"))  # for hash->job mapping
 
 PDF_OUTPUT_DIR = os.getenv("PDF_OUTPUT_DIR", "/data/pdfs")
+BATCH_MAX_DOCUMENTS = int(os.getenv("BATCH_MAX_DOCUMENTS", "1000"))
+# Whole /generate/batch body; each document is also held to MAX_BODY_BYTES
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", str(128 * 1024 * 1024)))
+
+# A job's PDF never changes, so clients may keep it; ETag = content hash
+PDF_DOWNLOAD_MAX_AGE = int(os.getenv("PDF_DOWNLOAD_MAX_AGE", "86400"))
+# Behind nginx: URL prefix of an internal location aliased to PDF_OUTPUT_DIR;
+# downloads are then handed to nginx (sendfile, ranges) via X-Accel-Redirect
+PDF_ACCEL_REDIRECT = os.getenv("PDF_ACCEL_REDIRECT", "")
+
+# Synchronous renders (/render, /generate?wait=) go to the interactive queue,
+# served by dedicated workers, and at most SYNC_RENDER_CONCURRENCY requests per
+# API process hold their connection open waiting; beyond that they get a job_id.
+SYNC_RENDER_CONCURRENCY = int(os.getenv("SYNC_RENDER_CONCURRENCY", "16"))
+SYNC_RENDER_MAX_WAIT = float(os.getenv("SYNC_RENDER_MAX_WAIT", "30"))
+
+LONG_POLL_MAX_WAIT = float(os.getenv("LONG_POLL_MAX_WAIT", "60"))
+SSE_MAX_JOBS = int(os.getenv("SSE_MAX_JOBS", "1000"))
+SSE_MAX_DURATION = float(os.getenv("SSE_MAX_DURATION", "3600"))
+
+BULK_STATUS_MAX_IDS = int(os.getenv("BULK_STATUS_MAX_IDS", "10000"))
+FAILURES_PAGE_MAX = int(os.getenv("FAILURES_PAGE_MAX", "1000"))
+API_REDIS_MAX_CONNECTIONS = int(os.getenv("API_REDIS_MAX_CONNECTIONS", "64"))
+EXPORT_MAX_JOBS = int(os.getenv("EXPORT_MAX_JOBS", "100000"))
+QR_BATCH_MAX = int(os.getenv("QR_BATCH_MAX", "1000"))
+
+# Every uvicorn worker process imports this module and so has its own pools;
+# connections are only opened on first use, inside that process.
+#
+# asyncio client for everything on the event loop: job state records, groups,
+# the job event subscription (see app/events.py). Requests beyond
+# API_REDIS_MAX_CONNECTIONS wait for a free connection.
+ar = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool(
+    host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB_HASH, decode_responses=True,
+    max_connections=API_REDIS_MAX_CONNECTIONS,
+))
+watcher = JobWatcher(ar)
+# Sync client, only used from the bounded thread pool (app/offload.py): the
+# result cache (see app/cache.py) and enqueue
+r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB_HASH, decode_responses=True,
+                max_connections=API_REDIS_MAX_CONNECTIONS)
 
-# Redis used only for hash->job_id mapping (dedupe)
-r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB_HASH, decode_responses=True)
 
-app = FastAPI(title="HTML → PDF Service (FastAPI + Celery)")
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await ar.aclose()
+    await ar.connection_pool.disconnect()
+    r.close()
+
+
+app = FastAPI(title="HTML → PDF Service (FastAPI + Celery)", lifespan=lifespan)
+
+_sync_slots = asyncio.Semaphore(SYNC_RENDER_CONCURRENCY)
 
 app.add_middleware(
     CORSMiddleware,
@@ -50,86 +120,921 @@ def map_celery_state(state: str) -> str:
 
 
 @app.post("/generate")
-async def generate(request: Request):
+async def generate(request: Request, extract_assets: bool = ASSET_EXTRACT_INLINE, wait: float = 0,
+                   callback_url: str = None, cycle_id: str = None, consumer_id: str = None,
+                   priority: str = None, division: str = None, profile: str = None):
+    """
+    Accept raw HTML (body = <html>...</html>), optionally gzip/zstd encoded.
+    - Stream the body into the blob store, hashing it on the way
+      (?extract_assets=true moves inline data:image URIs to the asset store)
+    - Hash (+ render options) -> content-addressed cache key
+    - If an identical document is done or in flight -> return its job_id
+    - Else -> claim the key, create job_id, enqueue Celery task
+    - ?wait=N: wait up to N seconds and return the PDF itself (see /render)
+    - ?callback_url=...: POSTed the job state when the job finishes
+    - ?cycle_id=...: record the job in a billing cycle (see /status/cycle),
+      with ?consumer_id=... as its bookmark title in cycle exports
+    - ?priority=interactive|standard|bulk: job class / queue (default
+      standard, interactive with ?wait)
+    - ?division=...: rate-limited per division on the workers (app/ratelimit.py)
+    - ?profile=archive|email|mobile: PDF optimization (app/pdfopt.py)
+    - 429 with Retry-After when the backlog or the client's quota is full
+      (app/admission.py)
+    """
+    await run_blocking(check_callback_url, callback_url)
+    check_group_id(cycle_id)
+    check_group_id(division, "division")
+    check_pdf_profile(profile)
+    queue = job_queue(priority, "interactive" if wait > 0 else "standard")
+    await admit_client(request)
+    body = await ingest_body(request, extract_assets=extract_assets)
+
+    key = cache_key(body.sha256, render_options({"kind": "html"}, profile))
+    try:
+        job_id, entry = await claim_admitted(key, body.size)
+    except HTTPException:
+        await run_blocking(blobstore.delete, body.blob_ref)
+        raise
+    metrics.cache_lookup(entry)
+    if entry is not None:
+        await run_blocking(blobstore.delete, body.blob_ref)
+        if callback_url:
+            await run_blocking(attach_webhook, job_id, entry, callback_url)
+        response = await cached_response(job_id, entry)
+    else:
+        # Enqueue Celery task with our custom job_id; only the blob reference
+        # goes through the broker (see app/blobstore.py)
+        try:
+            await run_blocking(enqueue, key, job_id, "generate_pdf", args=[body.blob_ref, job_id],
+                               blob_ref=body.blob_ref, callback_url=callback_url, division=division,
+                               profile=profile, queue=queue)
+        except Exception:
+            await release(ar, [job_id])
+            raise
+        response = {
+            "status": "QUEUED",
+            "job_id": job_id,
+            "cached": False,
+        }
+    if cycle_id:
+        await record_in_group("cycle", cycle_id, [job_id], consumer_id)
+
+    if wait > 0:
+        return await wait_for_pdf(job_id, min(wait, SYNC_RENDER_MAX_WAIT), response)
+    return response
+
+
+@app.post("/render")
+async def render(request: Request, extract_assets: bool = ASSET_EXTRACT_INLINE,
+                 wait: float = SYNC_RENDER_MAX_WAIT, callback_url: str = None, cycle_id: str = None,
+                 consumer_id: str = None, priority: str = None, division: str = None,
+                 profile: str = None):
+    """
+    Low-latency render for counter reprints: same input as /generate, but the
+    response is the PDF itself when it is ready within ?wait= seconds
+    (default SYNC_RENDER_MAX_WAIT). Otherwise 202 with the job_id, to be
+    followed up with /status and /download as usual.
+    """
+    return await generate(request, extract_assets=extract_assets, wait=max(wait, 0.001),
+                          callback_url=callback_url, cycle_id=cycle_id, consumer_id=consumer_id,
+                          priority=priority, division=division, profile=profile)
+
+
+async def wait_for_pdf(job_id: str, wait: float, pending_response: dict):
+    """
+    Wait until job_id finishes or wait seconds pass. Returns the PDF, a 500
+    with the error, or 202 with pending_response. If all sync slots are taken,
+    returns 202 immediately rather than queueing more waiting connections.
+    """
+    if _sync_slots.locked():
+        return JSONResponse(status_code=202, content=pending_response)
+
+    async with _sync_slots:
+        state = await wait_for_job(job_id, wait)
+
+    if state["status"] == "DONE":
+        return await pdf_file_response(job_id, await job_file(job_id))
+    if state["status"] == "FAILED":
+        return JSONResponse(status_code=500, content=state)
+    return JSONResponse(status_code=202, content={**pending_response, "status": state["status"]})
+
+
+async def wait_for_job(job_id: str, timeout: float) -> dict:
+    """
+    Current status of job_id, waiting up to timeout seconds (on the job event
+    subscription, without polling) for it to reach DONE or FAILED.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    with watcher.watch([job_id]) as events:
+        state = (await job_statuses([job_id]))[0]
+        while state["status"] not in FINAL_STATES:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                state = public_state(await asyncio.wait_for(events.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+    return state
+
+
+def public_state(state: dict) -> dict:
+    out = {"status": state["status"], "job_id": state["job_id"]}
+    if state.get("error"):
+        out["error"] = state["error"]
+    if state.get("failure"):
+        out["failure"] = state["failure"]
+    return out
+
+
+async def job_statuses(job_ids: list, fallback: bool = True) -> list:
+    """
+    Status of many jobs from their job_state records (pipelined MGETs).
+    Jobs without a record (queued before records existed, or expired) fall
+    back to the Celery result backend, or are UNKNOWN with fallback=False.
+    """
+    out = []
+    for job_id, state in zip(job_ids, await get_job_states_async(ar, job_ids)):
+        if state is not None:
+            out.append(public_state(state))
+        elif not fallback:
+            out.append({"status": "UNKNOWN", "job_id": job_id})
+        else:
+            out.append(await run_blocking(celery_status, job_id))
+    return out
+
+
+def celery_status(job_id: str) -> dict:
+    """
+    Status from the Celery result backend (blocking).
+    """
+    res = AsyncResult(job_id, app=celery)
+    state = {"status": map_celery_state(res.state), "job_id": job_id}
+    if res.state == "FAILURE":
+        # res.info is the exception, may contain message
+        state["error"] = str(res.info)
+    return state
+
+
+async def record_state(job_id: str, status: str, **fields):
+    pipe = ar.pipeline(transaction=False)
+    set_job_state(pipe, job_id, status, **fields)
+    await pipe.execute()
+
+
+async def record_in_group(kind: str, group_id: str, job_ids: list, title: str = None):
+    pipe = ar.pipeline(transaction=False)
+    add_to_group(pipe, kind, group_id, job_ids, {job_id: title for job_id in job_ids if title})
+    await pipe.execute()
+
+
+def status_summary(states: list) -> dict:
+    counts = {"PENDING": 0, "RUNNING": 0, "DONE": 0, "FAILED": 0, "UNKNOWN": 0}
+    for state in states:
+        counts[state["status"]] = counts.get(state["status"], 0) + 1
+    return {"total": len(states), "counts": counts}
+
+
+def check_group_id(group_id: str, name: str = "cycle_id"):
+    if group_id is not None and not valid_group_id(group_id):
+        raise HTTPException(status_code=400, detail=f"Invalid {name} (1-128 of A-Z a-z 0-9 _ . : -)")
+
+
+def job_queue(priority: str, default: str) -> str:
     """
-    Accept raw HTML (body = <html>...</html>).
-    - Compute hash
-    - If hash seen before -> return existing job_id + status
-    - Else -> create job_id, enqueue Celery task, save hash->job_id
+    Celery queue for a job class (interactive / standard / bulk).
     """
-    body = await request.body()
+    queue = PRIORITY_QUEUES.get(priority or default)
+    if queue is None:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown priority {priority!r} (one of {', '.join(PRIORITY_QUEUES)})",
+        )
+    return queue
+
+
+def check_pdf_profile(profile: str):
+    try:
+        check_profile(profile)
+    except OptimizeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def render_options(options: dict, profile: str = None) -> dict:
+    """
+    Cache key options: documents rendered with another profile are other PDFs.
+    """
+    return {**options, "profile": profile} if profile else options
+
+
+def check_callback_url(url: str):
+    """
+    400 unless url is empty or a public http(s) URL (app/webhooks.py;
+    blocking: resolves the host name).
+    """
+    if not url:
+        return
+    try:
+        webhooks.check_callback_url(url)
+    except webhooks.CallbackURLError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def admit_client(request: Request, cost: int = 1):
+    """
+    Take cost documents from the client's quota (app/admission.py); 429 if
+    it is empty.
+    """
+    try:
+        await check_client(ar, client_id(request), cost)
+    except AdmissionError as e:
+        raise too_busy(e)
+
+
+async def admit(sizes: dict):
+    """
+    Admit jobs ({job_id: bytes}) into the backlog; 429 if it is full.
+    """
+    try:
+        await reserve(ar, sizes)
+    except AdmissionError as e:
+        raise too_busy(e)
+
+
+async def claim_admitted(key: str, size: int):
+    """
+    claim() cache key for a new job admitted into the backlog (429 if it is
+    full). Documents already done or in flight are never refused.
+    """
+    new_id = str(uuid.uuid4())
+    try:
+        await reserve(ar, {new_id: size})
+    except AdmissionError as e:
+        if not await ar.hexists(key, "job_id"):
+            raise too_busy(e)
+        job_id, entry = await run_blocking(claim, r, key, new_id)
+        if entry is None:
+            # Gone in the meantime: don't keep a claim we may not enqueue
+            await run_blocking(invalidate, r, key, new_id)
+            raise too_busy(e)
+        return job_id, entry
+
+    job_id, entry = await run_blocking(claim, r, key, new_id)
+    if entry is not None:
+        await release(ar, [new_id])
+    return job_id, entry
+
+
+def too_busy(e: AdmissionError) -> HTTPException:
+    metrics.ADMISSION_REJECTED.labels(e.reason).inc()
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+
+async def cached_response(job_id: str, entry: dict) -> dict:
+    if entry.get("state") == "DONE":
+        pipe = ar.pipeline(transaction=False)
+        keep_done_job(pipe, job_id, entry)
+        await pipe.execute()
+        status = "DONE"
+    else:
+        status = (await job_statuses([job_id]))[0]["status"]
+    return {"status": status, "job_id": job_id, "cached": True}
+
+
+def enqueue(key: str, job_id: str, task_name: str, args: list, blob_ref: str = None,
+            callback_url: str = None, division: str = None, profile: str = None, **options):
+    """
+    send_task for a job that owns cache key; releases the key (and the body
+    blob) if enqueue fails. Blocking: run it with run_blocking().
+    """
+    try:
+        pipe = r.pipeline(transaction=False)
+        set_job_state(pipe, job_id, "PENDING")
+        if callback_url:
+            add_webhook(pipe, job_id, callback_url)
+        pipe.execute()
+        kwargs = {"cache_key": key}
+        if division:
+            kwargs["division"] = division
+        if profile:
+            kwargs["profile"] = profile
+        celery.send_task(task_name, args=args, kwargs=kwargs, task_id=job_id, **options)
+        metrics.ENQUEUED.labels(options.get("queue") or "default").inc()
+    except Exception as e:
+        invalidate(r, key, job_id)
+        set_job_state(r, job_id, "FAILED", error=f"Enqueue failed: {e}")
+        if blob_ref:
+            blobstore.delete(blob_ref)
+        raise
+
+
+def attach_webhook(job_id: str, entry: dict, url: str):
+    """
+    Webhook of a request answered from the result cache (entry) or merged
+    into an identical in-flight job: POSTed now if the job has finished,
+    else by the worker when it does, with the original submitter's.
+    Blocking: run it with run_blocking().
+    """
+    state = None
+    if entry.get("state") != "DONE":
+        pipe = r.pipeline(transaction=False)
+        add_webhook(pipe, job_id, url)
+        pipe.execute()
+        state = get_job_states(r, [job_id])[0]
+        if state is None or state["status"] not in FINAL_STATES:
+            return
+        # Finished meanwhile: whoever removes the URL delivers it
+        if not remove_webhook(r, job_id, url):
+            return
+    state = state or get_job_states(r, [job_id])[0] or {"job_id": job_id, "status": "DONE"}
+    celery.send_task("deliver_webhook", args=[url, state])
+
+
+@app.post("/generate/batch")
+async def generate_batch(request: Request):
+    """
+    Accept many bills in one request:
+      {"documents": [{"html": "<html>...</html>", "consumer_id": "...",
+                      "callback_url": "..."}, ...],
+       "callback_url": "...",   # default webhook for every document
+       "cycle_id": "...",       # optional billing cycle (see /status/cycle)
+       "priority": "bulk",      # job class (default bulk, see /generate)
+       "division": "...",       # per-division rate limit (app/ratelimit.py)
+       "profile": "email"}      # PDF optimization profile (app/pdfopt.py)
+    (plain HTML strings are accepted as documents too).
+    - One job_id per document (poll /status and /download as usual)
+    - Documents are grouped into generate_pdf_batch tasks of BATCH_RENDER_SIZE
+    - Admitted whole or not at all (429, see /generate)
+    - 413 past BATCH_MAX_BYTES in all, or MAX_BODY_BYTES for one document
+    """
+    payload = await read_json(request, BATCH_MAX_BYTES)
+
+    documents = payload.get("documents") if isinstance(payload, dict) else None
+    if not isinstance(documents, list) or not documents:
+        raise HTTPException(status_code=400, detail="'documents' must be a non-empty list")
+    if len(documents) > BATCH_MAX_DOCUMENTS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many documents ({len(documents)} > {BATCH_MAX_DOCUMENTS})",
+        )
+
+    batch_id = str(uuid.uuid4())
+    default_callback = payload.get("callback_url")
+    cycle_id = payload.get("cycle_id")
+    check_group_id(cycle_id)
+    division = payload.get("division")
+    check_group_id(division, "division")
+    profile = payload.get("profile")
+    check_pdf_profile(profile)
+    queue = job_queue(payload.get("priority"), "bulk")
+    task_kwargs = {}
+    if division:
+        task_kwargs["division"] = division
+    if profile:
+        task_kwargs["profile"] = profile
+    sizes = await run_blocking(check_batch_documents, documents, default_callback)
+
+    await admit_client(request, cost=len(documents))
+    new_ids = {str(uuid.uuid4()): size for size in sizes}
+    await admit(new_ids)
+
+    # Hashing, cache claims, blob writes and publishes: one trip to the thread pool
+    # (admission records of jobs that fail to enqueue are dropped by reconcile_admission)
+    jobs = await run_blocking(enqueue_batch, batch_id, documents, list(new_ids), default_callback,
+                              cycle_id, queue, task_kwargs, profile)
+    used = {job["job_id"] for job in jobs}
+    await release(ar, [job_id for job_id in new_ids if job_id not in used])
+    return {
+        "status": "QUEUED",
+        "batch_id": batch_id,
+        "jobs": jobs,
+    }
+
+
+def check_batch_documents(documents: list, default_callback: str) -> list:
+    """
+    Validate /generate/batch documents; returns their sizes in bytes
+    (blocking: run it with run_blocking()).
+    """
+    sizes, checked = [], set()
+    for i, doc in enumerate(documents):
+        if isinstance(doc, str):
+            doc = {"html": doc}
+        html = doc.get("html") if isinstance(doc, dict) else None
+        if not isinstance(html, str) or not html.strip():
+            raise HTTPException(status_code=400, detail=f"documents[{i}]: empty or missing 'html'")
+        callback_url = doc.get("callback_url") or default_callback
+        if callback_url not in checked:
+            check_callback_url(callback_url)
+            checked.add(callback_url)
+        sizes.append(len(html.encode("utf-8")))
+        if sizes[-1] > MAX_BODY_BYTES:
+            raise HTTPException(status_code=413, detail=f"documents[{i}] exceeds {MAX_BODY_BYTES} bytes")
+    return sizes
+
+
+def enqueue_batch(batch_id: str, documents: list, new_ids: list, default_callback: str, cycle_id: str,
+                  queue: str, task_kwargs: dict, profile: str) -> list:
+    """
+    Claim, record and send generate_pdf_batch tasks for validated documents,
+    with new_ids as job_ids for documents not found in the result cache
+    (blocking: run it with run_blocking()). If anything fails, the keys
+    claimed for jobs not yet sent are released and their blobs deleted.
+    """
+    jobs, pending, merged = [], [], []
+    sent = 0
+    try:
+        pipe = r.pipeline(transaction=False)
+        for doc, new_id in zip(documents, new_ids):
+            if isinstance(doc, str):
+                doc = {"html": doc}
+            html = doc["html"]
+
+            key = cache_key(pdf_hash(html.encode("utf-8")), render_options({"kind": "html"}, profile))
+            job_id, entry = claim(r, key, new_id)
+            metrics.cache_lookup(entry)
+            jobs.append({"job_id": job_id, "consumer_id": doc.get("consumer_id"), "cached": entry is not None})
+            callback_url = doc.get("callback_url") or default_callback
+            if entry is not None:
+                if entry["state"] == "DONE":
+                    keep_done_job(pipe, job_id, entry)
+                if callback_url:
+                    merged.append((job_id, entry, callback_url))
+            else:
+                item = [job_id, None, key]
+                pending.append(item)
+                item[1] = blobstore.put(html.encode("utf-8"))
+                set_job_state(pipe, job_id, "PENDING")
+                if callback_url:
+                    add_webhook(pipe, job_id, callback_url)
+        job_ids = [job["job_id"] for job in jobs]
+        titles = {job["job_id"]: str(job["consumer_id"]) for job in jobs if job["consumer_id"]}
+        add_to_group(pipe, "batch", batch_id, job_ids, titles)
+        if cycle_id:
+            add_to_group(pipe, "cycle", cycle_id, job_ids, titles)
+        pipe.execute()
+
+        for start in range(0, len(pending), BATCH_RENDER_SIZE):
+            chunk = pending[start:start + BATCH_RENDER_SIZE]
+            celery.send_task("generate_pdf_batch", args=[chunk, batch_id], kwargs=task_kwargs, queue=queue)
+            metrics.ENQUEUED.labels(queue).inc()
+            sent = start + len(chunk)
+    except Exception as e:
+        for job_id, blob_ref, key in pending[sent:]:
+            invalidate(r, key, job_id)
+            set_job_state(r, job_id, "FAILED", error=f"Enqueue failed: {e}")
+            if blob_ref:
+                blobstore.delete(blob_ref)
+        raise
+
+    # Jobs are queued: a webhook that cannot be attached must not undo them
+    for job_id, entry, callback_url in merged:
+        attach_webhook(job_id, entry, callback_url)
+    return jobs
+
+
+@app.post("/templates/{template_id}")
+async def put_template(template_id: str, request: Request):
+    """
+    Register (or replace) a bill template. Body = Jinja2 HTML template.
+    Relative asset paths in the template resolve inside TEMPLATE_DIR.
+    """
+    body = await read_body(request)
     if not body.strip():
-        raise HTTPException(status_code=400, detail="Empty HTML body")
+        raise HTTPException(status_code=400, detail="Empty template body")
+
+    try:
+        return await run_blocking(register_template, template_id, body.decode("utf-8"))
+    except TemplateError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    h = pdf_hash(body)
-    hash_key = f"pdf_hash:{h}"
 
-    # existing_job_id = r.get(hash_key)
-    # if existing_job_id:
-    #     # Check Celery state
-    #     res = AsyncResult(existing_job_id, app=celery)
-    #     status = map_celery_state(res.state)
-    #     return {
-    #         "status": status,
-    #         "job_id": existing_job_id,
-    #         "cached": True,
-    #     }
+@app.get("/templates")
+async def get_templates():
+    return {"templates": await run_blocking(list_templates)}
+
+
+@app.post("/generate/{template_id}")
+async def generate_from_template(template_id: str, request: Request, callback_url: str = None,
+                                 cycle_id: str = None, consumer_id: str = None, priority: str = None,
+                                 division: str = None, profile: str = None):
+    """
+    Render a registered template with per-consumer JSON (body = template data).
+    Only the template id and the data are queued; HTML is built on the worker.
+    Accepts the same callback_url / cycle_id / consumer_id / priority /
+    division / profile as /generate, and is admitted the same way.
+    """
+    await run_blocking(check_callback_url, callback_url)
+    check_group_id(cycle_id)
+    check_group_id(division, "division")
+    check_pdf_profile(profile)
+    queue = job_queue(priority, "standard")
+    await admit_client(request)
+    data = await read_json(request)
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="Template data must be a JSON object")
 
-    # New job
-    html = body.decode("utf-8")
-    job_id = str(uuid.uuid4())
+    try:
+        found = await run_blocking(template_exists, template_id)
+    except TemplateError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not found:
+        raise HTTPException(status_code=404, detail=f"Unknown template {template_id!r}")
 
-    # Enqueue Celery task with our custom job_id
-    task = celery.send_task("generate_pdf", args=[html, job_id], task_id=job_id)
+    data_json = json.dumps(data, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    version = await run_blocking(template_version, template_id)
+    options = {"kind": "template", "template": template_id, "version": version}
+    key = cache_key(pdf_hash(data_json), render_options(options, profile))
+    job_id, entry = await claim_admitted(key, len(data_json))
+    metrics.cache_lookup(entry)
+    if cycle_id:
+        await record_in_group("cycle", cycle_id, [job_id], consumer_id)
+    if entry is not None:
+        if callback_url:
+            await run_blocking(attach_webhook, job_id, entry, callback_url)
+        return {**await cached_response(job_id, entry), "template_id": template_id}
 
-    # Store hash -> job_id
-    r.set(hash_key, job_id)
+    try:
+        await run_blocking(enqueue, key, job_id, "generate_pdf_from_template",
+                           args=[template_id, data, job_id], callback_url=callback_url,
+                           division=division, profile=profile, queue=queue)
+    except Exception:
+        await release(ar, [job_id])
+        raise
 
     return {
         "status": "QUEUED",
         "job_id": job_id,
+        "template_id": template_id,
         "cached": False,
     }
 
 
+@app.post("/assets")
+async def upload_asset(request: Request):
+    """
+    Upload an image once (body = image bytes, Content-Type = its MIME type)
+    and reference it from bills as asset://{asset_id}.
+    """
+    data = await read_body(request, ASSET_MAX_BYTES)
+    try:
+        asset_id = await run_blocking(put_asset, data, request.headers.get("content-type", ""))
+    except AssetError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"asset_id": asset_id, "url": f"asset://{asset_id}"}
+
+
+@app.get("/assets/{asset_id}")
+async def get_asset(asset_id: str):
+    path = await run_blocking(asset_path, asset_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Asset not found")
+    return FileResponse(path)
+
+
+@app.post("/qr/batch")
+async def qr_batch(request: Request):
+    """
+    Encode many QR payloads in one call (app/qr.py):
+      {"payloads": ["upi://pay?...", ...],
+       "format": "svg" | "png",   # inline SVG (default) or base64 1-bit PNG
+       "ecc": "M",                # error correction L / M / Q / H
+       "border": 1,               # quiet zone in modules
+       "scale": 4}                # PNG pixels per module
+    Returns {"codes": [{"payload", "svg" | "png"} | {"payload", "error"}, ...]}
+    in payload order. Bill templates can call qr(payload) directly instead.
+    """
+    payload = await read_json(request)
+
+    payloads = payload.get("payloads") if isinstance(payload, dict) else None
+    if not isinstance(payloads, list) or not payloads:
+        raise HTTPException(status_code=400, detail="'payloads' must be a non-empty list")
+    if len(payloads) > QR_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"Too many payloads ({len(payloads)} > {QR_BATCH_MAX})")
+    if not all(isinstance(p, str) and p for p in payloads):
+        raise HTTPException(status_code=400, detail="Every payload must be a non-empty string")
+    fmt = payload.get("format") or "svg"
+    ecc = payload.get("ecc") or "M"
+    border, scale = payload.get("border", DEFAULT_BORDER), payload.get("scale", DEFAULT_SCALE)
+    if not isinstance(border, int) or not isinstance(scale, int):
+        raise HTTPException(status_code=400, detail="'border' and 'scale' must be integers")
+    try:
+        check_qr_options(fmt, ecc, border)
+    except QRError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    codes = await run_blocking(encode_batch, payloads, fmt, ecc, border, scale)
+    return {"format": fmt, "codes": codes}
+
+
 @app.get("/status/{job_id}")
-async def status(job_id: str):
-    res = AsyncResult(job_id, app=celery)
-    state = res.state
-    api_status = map_celery_state(state)
+async def status(job_id: str, wait: float = 0):
+    """
+    Job status. With ?wait=N (long-poll), the response is held until the job
+    is DONE / FAILED or N seconds (max LONG_POLL_MAX_WAIT) have passed.
+    """
+    if wait > 0:
+        return await wait_for_job(job_id, min(wait, LONG_POLL_MAX_WAIT))
+    return (await job_statuses([job_id]))[0]
 
-    if state == "FAILURE":
-        # res.info is the exception, may contain message
-        err = str(res.info)
-        return {"status": api_status, "job_id": job_id, "error": err}
 
-    return {"status": api_status, "job_id": job_id}
+@app.post("/status/bulk")
+async def status_bulk(request: Request):
+    """
+    Status of many jobs in one call (body = {"job_ids": [...]}), read with
+    pipelined MGETs of the job state records. Jobs without a record are
+    reported as UNKNOWN.
+    """
+    payload = await read_json(request)
+    job_ids = payload.get("job_ids") if isinstance(payload, dict) else None
+    if not isinstance(job_ids, list) or not all(isinstance(j, str) for j in job_ids):
+        raise HTTPException(status_code=400, detail="'job_ids' must be a list of strings")
+    if len(job_ids) > BULK_STATUS_MAX_IDS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many job_ids ({len(job_ids)} > {BULK_STATUS_MAX_IDS})",
+        )
 
+    states = await job_statuses(job_ids, fallback=False)
+    return {**status_summary(states), "jobs": states}
 
-@app.get("/download/{job_id}")
-async def download(job_id: str):
-    res = AsyncResult(job_id, app=celery)
-    if res.state != "SUCCESS":
-        raise HTTPException(status_code=409, detail=f"Job not ready (state={res.state})")
 
-    result = res.result or {}
+@app.get("/status/{kind}/{group_id}")
+async def status_group(kind: str, group_id: str, failures_offset: int = 0, failures_limit: int = 100):
+    """
+    Progress of a billing cycle (/status/cycle/{cycle_id}) or a batch
+    (/status/batch/{batch_id}): counts per state plus one page of failed jobs
+    with their errors, for targeted retries. Counts come from the group's
+    counters (app/events.py); only the failures page reads job states.
+    """
+    if kind not in GROUP_KINDS:
+        raise HTTPException(status_code=404, detail="Not found")
+    failures_offset = max(failures_offset, 0)
+    failures_limit = min(max(failures_limit, 0), FAILURES_PAGE_MAX)
+
+    progress = await group_progress_async(ar, kind, group_id, failures_offset, failures_limit)
+    if progress is not None:
+        counts, failed_ids = progress
+        total = counts.pop("total", 0)
+        summary = status_summary([])
+        summary["counts"].update(counts)
+        return {
+            f"{kind}_id": group_id,
+            "total": total,
+            "counts": summary["counts"],
+            "failures": await job_statuses(failed_ids, fallback=False),
+            "failures_total": counts.get("FAILED", 0),
+            "failures_offset": failures_offset,
+        }
+
+    # Recorded before group counters: read every member's state
+    job_ids = await group_jobs_async(ar, kind, group_id)
+    if not job_ids:
+        raise HTTPException(status_code=404, detail=f"Unknown {kind} {group_id!r}")
+    states = await job_statuses(job_ids, fallback=False)
+    failures = [s for s in states if s["status"] == "FAILED"]
+    return {
+        f"{kind}_id": group_id,
+        **status_summary(states),
+        "failures": failures[failures_offset:failures_offset + failures_limit],
+        "failures_total": len(failures),
+        "failures_offset": failures_offset,
+    }
+
+
+@app.get("/events")
+async def job_events(request: Request, job_ids: str):
+    """
+    Server-sent events for a set of jobs (?job_ids=a,b,c): the current status
+    of each job first, then one "job" event per state change, until every job
+    is DONE / FAILED ("end" event) or the client disconnects.
+    """
+    ids = list(dict.fromkeys(j.strip() for j in job_ids.split(",") if j.strip()))
+    if not ids:
+        raise HTTPException(status_code=400, detail="job_ids is required")
+    if len(ids) > SSE_MAX_JOBS:
+        raise HTTPException(status_code=400, detail=f"At most {SSE_MAX_JOBS} job_ids per stream")
+
+    def sse(event: str, data: dict) -> str:
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    async def stream():
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + SSE_MAX_DURATION
+        with watcher.watch(ids) as events:
+            pending = set(ids)
+            for state in await job_statuses(ids):
+                yield sse("job", state)
+                if state["status"] in FINAL_STATES:
+                    pending.discard(state["job_id"])
+
+            while pending and loop.time() < deadline:
+                if await request.is_disconnected():
+                    return
+                try:
+                    event = await asyncio.wait_for(events.get(), 15)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                state = public_state(event)
+                yield sse("job", state)
+                if state["status"] in FINAL_STATES:
+                    pending.discard(state["job_id"])
+
+        yield sse("end", {"pending": sorted(pending)})
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/export")
+async def export(request: Request):
+    """
+    Export finished PDFs as one file, built by a worker task (app/export.py):
+      {"cycle_id": "..."} | {"batch_id": "..."} |
+      {"job_ids": ["...", {"job_id": "...", "title": "..."}, ...]},
+      "format": "pdf" | "zip",   # merged PDF with a bookmark per job (default) or ZIP
+      "callback_url": "..."      # optional webhook, as for /generate
+    Returns an export job_id: poll /status/{job_id} (the result lists jobs
+    that were not finished), then GET /download/{job_id}.
+    """
+    payload = await read_json(request)
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="Body must be a JSON object")
+
+    fmt = payload.get("format") or "pdf"
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown format {fmt!r} (one of {', '.join(EXPORT_FORMATS)})",
+        )
+    callback_url = payload.get("callback_url")
+    await run_blocking(check_callback_url, callback_url)
+
+    task_kwargs, count = {}, 0
+    groups = [kind for kind in GROUP_KINDS if payload.get(f"{kind}_id")]
+    if len(groups) + ("job_ids" in payload) != 1:
+        raise HTTPException(status_code=400, detail="Give exactly one of cycle_id, batch_id, job_ids")
+    if groups:
+        kind = groups[0]
+        group_id = payload[f"{kind}_id"]
+        check_group_id(group_id, f"{kind}_id")
+        count = len(await group_jobs_async(ar, kind, group_id))
+        if not count:
+            raise HTTPException(status_code=404, detail=f"Unknown {kind} {group_id!r}")
+        task_kwargs["group"] = [kind, group_id]
+    else:
+        job_ids, titles = [], {}
+        entries = payload["job_ids"]
+        if not isinstance(entries, list) or not entries:
+            raise HTTPException(status_code=400, detail="'job_ids' must be a non-empty list")
+        for i, entry in enumerate(entries):
+            if isinstance(entry, dict):
+                job_id, title = entry.get("job_id"), entry.get("title")
+                if title is not None and not isinstance(title, str):
+                    raise HTTPException(status_code=400, detail=f"job_ids[{i}]: 'title' must be a string")
+                if title and isinstance(job_id, str):
+                    titles[job_id] = title
+            else:
+                job_id = entry
+            if not isinstance(job_id, str) or not job_id:
+                raise HTTPException(status_code=400, detail=f"job_ids[{i}]: missing job_id")
+            job_ids.append(job_id)
+        count = len(job_ids)
+        task_kwargs.update(job_ids=job_ids, titles=titles)
+    if count > EXPORT_MAX_JOBS:
+        raise HTTPException(status_code=413, detail=f"Too many jobs ({count} > {EXPORT_MAX_JOBS})")
+
+    export_id = str(uuid.uuid4())
+    pipe = ar.pipeline(transaction=False)
+    set_job_state(pipe, export_id, "PENDING")
+    if callback_url:
+        add_webhook(pipe, export_id, callback_url)
+    await pipe.execute()
+    try:
+        await run_blocking(celery.send_task, "export_pdfs", args=[export_id, fmt], kwargs=task_kwargs,
+                           task_id=export_id, queue=BULK_QUEUE)
+        metrics.ENQUEUED.labels(BULK_QUEUE).inc()
+    except Exception as e:
+        await record_state(export_id, "FAILED", error=f"Enqueue failed: {e}")
+        raise
+
+    return {"status": "QUEUED", "job_id": export_id, "format": fmt, "jobs": count}
+
+
+@app.api_route("/download/{job_id}", methods=["GET", "HEAD"])
+async def download(job_id: str, request: Request):
+    """
+    The job's PDF. Served from the job file index (no result backend lookup)
+    with a strong ETag (the content hash): If-None-Match -> 304, Range ->
+    206, HEAD -> headers only.
+    """
+    return await pdf_file_response(job_id, await job_file(job_id), request)
+
+
+async def job_file(job_id: str) -> dict:
+    """
+    {"path", "sha256"?} of a finished job's PDF; 409 if it is not done.
+    """
+    info = await get_job_file_async(ar, job_id)
+    if info is not None:
+        return info
+
+    state = (await job_statuses([job_id]))[0]
+    if state["status"] != "DONE":
+        raise HTTPException(status_code=409, detail=f"Job not ready (state={state['status']})")
+
+    # Finished before the file index existed: path from the task result
+    result = await run_blocking(lambda: AsyncResult(job_id, app=celery).result) or {}
     pdf_path = result.get("pdf_path")
     if not pdf_path:
         raise HTTPException(status_code=500, detail="PDF path missing in task result")
+    return {"path": pdf_path, "sha256": result.get("sha256")}
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (c.strip() for c in if_none_match.split(","))
+    return etag in (c[2:] if c.startswith("W/") else c for c in candidates)
+
 
-    # (Optionally) verify file exists
-    if not os.path.exists(pdf_path):
-        raise HTTPException(status_code=500, detail="PDF file missing on server")
+async def pdf_file_response(job_id: str, info: dict, request: Request = None) -> Response:
+    pdf_path = info["path"]
+    remote = pdf_path.startswith("s3://")
+    stat_result = None
+    if not remote:
+        try:
+            stat_result = await run_blocking(os.stat, pdf_path)
+        except FileNotFoundError:
+            # Collected by the retention GC (app/storage.py)
+            raise HTTPException(status_code=410, detail="PDF no longer available")
+
+    headers = {"X-Job-Id": job_id, "Cache-Control": f"private, max-age={PDF_DOWNLOAD_MAX_AGE}"}
+    if info.get("sha256"):
+        headers["ETag"] = f'"{info["sha256"]}"'
+        if request is not None and etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+            return Response(status_code=304, headers=headers)
 
     filename = os.path.basename(pdf_path)
-    return FileResponse(pdf_path, media_type="application/pdf", filename=filename)
+    # Exports (/export) may be ZIPs; everything else is a PDF
+    media_type = "application/zip" if pdf_path.endswith(".zip") else "application/pdf"
+    if remote:
+        # Object storage: the client fetches it directly (presigned URL)
+        url = await run_blocking(lambda: storage.storage_for(pdf_path).url(pdf_path, filename))
+        return RedirectResponse(url, status_code=302, headers=headers)
+    if PDF_ACCEL_REDIRECT:
+        headers["X-Accel-Redirect"] = (PDF_ACCEL_REDIRECT.rstrip("/") + "/"
+                                       + os.path.relpath(pdf_path, PDF_OUTPUT_DIR))
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return Response(media_type=media_type, headers=headers)
+
+    # Starlette handles Range / If-Range / HEAD, and sends the file with the
+    # server's zero-copy path (http.response.pathsend) where supported
+    return FileResponse(pdf_path, media_type=media_type, filename=filename,
+                        headers=headers, stat_result=stat_result)
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """
+    Prometheus metrics of the API (see app/metrics.py); workers expose theirs
+    on WORKER_METRICS_PORT.
+    """
+    if metrics.prometheus_client is None:
+        raise HTTPException(status_code=404, detail="prometheus_client is not installed")
+    body, content_type = await run_blocking(metrics.exposition)
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/ready")
+async def ready():
+    """
+    Readiness for load balancers and the billing scheduler: the admission
+    backlog (app/admission.py), 503 with Retry-After while it is above
+    READY_MAX_FILL of its caps or Redis is unreachable.
+    """
+    try:
+        state = await backlog(ar)
+    except Exception as e:
+        return JSONResponse(status_code=503, content={"status": "redis_error", "detail": str(e)})
+    if state["fill"] >= READY_MAX_FILL:
+        return JSONResponse(status_code=503, content={"status": "busy", **state},
+                            headers={"Retry-After": str(busy_retry_after(state))})
+    return {"status": "ready", **state}
 
 
 @app.get("/")
 async def health():
     # quick health check
     try:
-        r.ping()
+        await ar.ping()
         return {"status": "ok"}
     except Exception as e:
         return JSONResponse(status_code=500, content={"status": "redis_error", "detail": str(e)})
@@ -0,0 +1,183 @@
+# app/metrics.py
+"""
+Prometheus metrics for the API and the render workers.
+
+- API: GET /metrics (cache lookups, queue submissions).
+- Workers: per-stage timing, wkhtmltopdf wall / CPU time, PDF size and
+  pages, outcomes and failures by reason; served on WORKER_METRICS_PORT by
+  the Celery parent process.
+
+Celery prefork children (and multi-process API servers) write their samples
+to PROMETHEUS_MULTIPROC_DIR, which the exposing process aggregates. Unlabelled
+metrics open their files when this module is imported, so the directory is
+created here first; samples of earlier runs are best removed before the
+process starts (docker-compose.yml does), clear_multiproc_dir() drops the
+rest when the worker starts.
+
+prometheus_client is optional: without it every metric is a no-op and
+/metrics answers 404.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9808"))
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "")
+
+if MULTIPROC_DIR:
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+try:
+    import prometheus_client
+    from prometheus_client import CollectorRegistry, Counter, Histogram
+    from prometheus_client import multiprocess
+except ImportError:  # optional: metrics are then disabled
+    prometheus_client = None
+
+# Seconds: sub-second stages up to renders of large batches
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+QUEUE_BUCKETS = (0.1, 0.5, 1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200, 14400)
+SIZE_BUCKETS = (16e3, 32e3, 64e3, 128e3, 256e3, 512e3, 1e6, 2e6, 5e6, 10e6, 50e6)
+PAGE_BUCKETS = (1, 2, 3, 4, 6, 8, 12, 16, 32, 64, 128)
+
+
+class _Noop:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+def _histogram(name, documentation, labels=(), buckets=STAGE_BUCKETS):
+    if prometheus_client is None:
+        return _Noop()
+    return Histogram(name, documentation, labels, buckets=buckets)
+
+
+def _counter(name, documentation, labels=()):
+    if prometheus_client is None:
+        return _Noop()
+    return Counter(name, documentation, labels)
+
+
+STAGE_SECONDS = _histogram(
+    "pdf_stage_seconds",
+    "Time per pipeline stage (html_write, template, render, store, ...)", ["stage"],
+)
+QUEUE_WAIT_SECONDS = _histogram(
+    "pdf_queue_wait_seconds",
+    "Time from enqueue to task start", ["queue"], buckets=QUEUE_BUCKETS,
+)
+RENDER_CPU_SECONDS = _histogram(
+    "pdf_render_cpu_seconds",
+    "CPU time (user + system) of the render engine per invocation", ["engine"],
+)
+PDF_SIZE_BYTES = _histogram(
+    "pdf_size_bytes",
+    "Size of rendered PDFs", buckets=SIZE_BUCKETS,
+)
+PDF_PAGES = _histogram(
+    "pdf_pages",
+    "Pages per rendered PDF", buckets=PAGE_BUCKETS,
+)
+JOBS = _counter(
+    "pdf_jobs_total",
+    "Finished jobs by outcome (done / failed)", ["outcome"],
+)
+FAILURES = _counter(
+    "pdf_job_failures_total",
+    "Failed jobs by reason (exception type)", ["reason"],
+)
+ENQUEUED = _counter(
+    "pdf_jobs_enqueued_total",
+    "Jobs submitted to Celery, per queue", ["queue"],
+)
+CACHE_LOOKUPS = _counter(
+    "pdf_cache_lookups_total",
+    "Result cache lookups: hit (done), coalesced (in flight) or miss", ["result"],
+)
+ADMISSION_REJECTED = _counter(
+    "pdf_admission_rejected_total",
+    "Submissions refused with 429 (app/admission.py): queue_jobs, queue_bytes or client", ["reason"],
+)
+THROTTLED = _counter(
+    "pdf_throttled_total",
+    "Render tasks put back by their division's rate limit (app/ratelimit.py)", ["division"],
+)
+PAGE_FRAGMENTS = _counter(
+    "pdf_page_fragments_total",
+    "Static page fragments (app/pages.py): hit (cached) or rendered", ["result"],
+)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a block as pipeline stage name (recorded on success and failure).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+
+def cache_lookup(entry):
+    """
+    Count a cache.claim() result (entry None = miss, caller renders).
+    """
+    if entry is None:
+        CACHE_LOOKUPS.labels("miss").inc()
+    elif entry.get("state") == "DONE":
+        CACHE_LOOKUPS.labels("hit").inc()
+    else:
+        CACHE_LOOKUPS.labels("coalesced").inc()
+
+
+def registry():
+    """
+    Registry to expose: all processes' samples in multiprocess mode, else
+    this process's.
+    """
+    if MULTIPROC_DIR:
+        reg = CollectorRegistry()
+        multiprocess.MultiProcessCollector(reg)
+        return reg
+    return prometheus_client.REGISTRY
+
+
+def exposition() -> tuple:
+    """
+    (body, content_type) for a /metrics response.
+    """
+    return prometheus_client.generate_latest(registry()), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def clear_multiproc_dir():
+    """
+    Remove samples of earlier runs (call once, before workers start). The
+    files of this process, opened when the module was imported, are kept.
+    """
+    if not MULTIPROC_DIR:
+        return
+    own = f"_{os.getpid()}.db"
+    for name in os.listdir(MULTIPROC_DIR):
+        if name.endswith(".db") and not name.endswith(own):
+            try:
+                os.remove(os.path.join(MULTIPROC_DIR, name))
+            except FileNotFoundError:
+                pass
+
+
+def start_worker_server():
+    if prometheus_client and WORKER_METRICS_PORT:
+        prometheus_client.start_http_server(WORKER_METRICS_PORT, registry=registry())
+
+
+def process_exited(pid: int):
+    if prometheus_client and MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
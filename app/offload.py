@@ -0,0 +1,34 @@
+# app/offload.py
+"""
+Bounded thread pool for the blocking calls left in the API (Celery
+publishes, the result cache's Redis scripts, legacy result-backend lookups,
+blob / asset / template file I/O), so they never run on the event loop.
+
+At most API_BLOCKING_THREADS of them run at once per process: a slow broker
+or disk makes requests queue here instead of stalling every request on the
+uvicorn worker. Each worker process has its own pool (created on first use,
+inside that process's event loop).
+"""
+import os
+import functools
+
+import anyio
+import anyio.to_thread
+
+API_BLOCKING_THREADS = int(os.getenv("API_BLOCKING_THREADS", "32"))
+
+_limiter = None
+
+
+def limiter() -> anyio.CapacityLimiter:
+    global _limiter
+    if _limiter is None:
+        _limiter = anyio.CapacityLimiter(API_BLOCKING_THREADS)
+    return _limiter
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    await func(*args, **kwargs), run in the bounded thread pool.
+    """
+    return await anyio.to_thread.run_sync(functools.partial(func, *args, **kwargs), limiter=limiter())
@@ -0,0 +1,289 @@
+# app/pages.py
+"""
+Static-page splicing for multi-page bills.
+
+Bills are a row of sibling <div class="page"> sections, and the back pages
+(tariff details, terms, payment instructions) are usually byte-identical for
+every consumer of a division. Such static pages are rendered once into a PDF
+fragment cached in PAGE_CACHE_DIR, keyed by a hash of the page and the
+document around it (head, styles); per job only the other pages are
+rendered, and the PDF is spliced together from both.
+
+A page is static when
+  - it is marked <div class="page" data-static>: its content must then not
+    depend on the document's scripts, which are left out of its render, or
+  - its fragment is already cached, or the same page in the same document
+    was seen in PAGE_STATIC_MIN_SEEN jobs within PAGE_STATIC_SEEN_TTL seconds
+    (counted in Redis; 0 = marked pages only).
+
+Documents that cannot be split safely (fewer than two page sections, other
+content between them, sections at different levels) are rendered whole, as
+are documents whose separately rendered pages do not line up one PDF page
+per section where that matters (plan.splice raises SpliceError).
+PAGE_SPLICE=0 turns splicing off.
+"""
+import os
+import re
+import hashlib
+import tempfile
+
+import redis
+from pypdf import PdfReader, PdfWriter
+from pypdf.errors import PyPdfError
+
+from . import metrics
+from .renderer import PAGE_CSS, PDF_ENGINE, WKHTML_OPTIONS, RenderError
+
+PAGE_SPLICE = os.getenv("PAGE_SPLICE", "1") == "1"
+PAGE_CACHE_DIR = os.getenv("PAGE_CACHE_DIR", "/tmp/page-cache")
+PAGE_CACHE_MAX_FILES = int(os.getenv("PAGE_CACHE_MAX_FILES", "500"))
+PAGE_STATIC_MIN_SEEN = int(os.getenv("PAGE_STATIC_MIN_SEEN", "2"))
+PAGE_STATIC_SEEN_TTL = int(os.getenv("PAGE_STATIC_SEEN_TTL", "3600"))
+# Larger documents are rendered whole (splitting reads them into memory)
+PAGE_SPLICE_MAX_BYTES = int(os.getenv("PAGE_SPLICE_MAX_BYTES", str(4 * 1024 * 1024)))
+
+SEEN_KEY_PREFIX = "pages:seen:"
+
+# Fragments rendered by another engine or page setup are not reused
+_ENGINE_ID = hashlib.sha256(
+    "\0".join([PDF_ENGINE, PAGE_CSS, *WKHTML_OPTIONS]).encode("utf-8")
+).hexdigest()
+
+_TOKENS = re.compile(rb"<!--.*?-->|<(script|style)\b.*?</\1\s*>|<div\b[^>]*>|</div\s*>", re.I | re.S)
+_CLASS = re.compile(rb"""\sclass\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""", re.I)
+_STATIC = re.compile(rb"\sdata-static\b", re.I)
+_GAP = re.compile(rb"\s*(?:<!--.*?-->\s*)*", re.S)
+_SCRIPT = re.compile(rb"<script\b.*?</script\s*>", re.I | re.S)
+
+
+class SpliceError(RenderError):
+    pass
+
+
+def _is_page(tag: bytes) -> bool:
+    m = _CLASS.search(tag)
+    return m is not None and b"page" in (m.group(1) or m.group(2) or m.group(3)).split()
+
+
+def split_pages(html: bytes):
+    """
+    (prefix, [page section, ...], suffix) of a document whose pages are
+    sibling <div class="page"> elements, or None.
+    """
+    stack, spans, parent = [], [], None  # stack: (start, is page)
+    for m in _TOKENS.finditer(html):
+        tag = m.group(0)
+        if m.group(1) or tag.startswith(b"<!--"):
+            continue
+        if tag.startswith(b"</"):
+            if not stack:
+                return None
+            start, is_page = stack.pop()
+            if is_page:
+                spans.append((start, m.end()))
+            continue
+        is_page = not any(p for _, p in stack) and _is_page(tag)
+        if is_page:
+            here = stack[-1][0] if stack else -1
+            if spans and here != parent:
+                return None
+            parent = here
+        stack.append((m.start(), is_page))
+
+    if len(spans) < 2 or any(p for _, p in stack):
+        return None
+    for (_, end), (start, _) in zip(spans, spans[1:]):
+        if not _GAP.fullmatch(html, end, start):
+            return None
+    return html[:spans[0][0]], [html[a:b] for a, b in spans], html[spans[-1][1]:]
+
+
+def plan_pages(html_path: str, r=None):
+    """
+    PagePlan for a prepared document, or None if it is rendered whole (no
+    static pages, cannot be split, PAGE_SPLICE off). r: Redis client for
+    the seen counters.
+    """
+    if not PAGE_SPLICE or os.path.getsize(html_path) > PAGE_SPLICE_MAX_BYTES:
+        return None
+    with open(html_path, "rb") as f:
+        parts = split_pages(f.read())
+    if parts is None:
+        return None
+    plan = PagePlan(html_path, *parts)
+    plan.classify(r)
+    if not any(plan.keys):
+        return None
+    plan.write_dynamic()
+    return plan
+
+
+class PagePlan:
+    """
+    One document split into pages: keys[i] is the fragment key of static
+    page i (None for pages rendered with the job).
+    """
+
+    def __init__(self, html_path: str, prefix: bytes, sections: list, suffix: bytes):
+        self.html_path = html_path
+        self.prefix, self.sections, self.suffix = prefix, sections, suffix
+        self.keys = [None] * len(sections)
+        base = os.path.splitext(html_path)[0]
+        self.dynamic_path = f"{base}.dynamic.html"
+        self.dynamic_pdf = f"{base}.dynamic.pdf"
+        self.rendered = 0
+
+    def _context(self, marked: bool) -> tuple:
+        if marked:
+            return _SCRIPT.sub(b"", self.prefix), _SCRIPT.sub(b"", self.suffix)
+        return self.prefix, self.suffix
+
+    def _key(self, i: int) -> str:
+        prefix, suffix = self._context(bool(_STATIC.search(self._open_tag(i))))
+        digest = hashlib.sha256(_ENGINE_ID.encode("ascii"))
+        for part in (prefix, self.sections[i], suffix):
+            digest.update(len(part).to_bytes(8, "big"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _open_tag(self, i: int) -> bytes:
+        section = self.sections[i]
+        return section[:section.index(b">") + 1]
+
+    def classify(self, r=None):
+        unknown = []
+        for i in range(len(self.sections)):
+            key = self._key(i)
+            if _STATIC.search(self._open_tag(i)) or os.path.exists(_fragment_path(key)):
+                self.keys[i] = key
+            else:
+                unknown.append((i, key))
+        if not unknown or r is None or PAGE_STATIC_MIN_SEEN <= 0:
+            return
+        try:
+            pipe = r.pipeline(transaction=False)
+            for _, key in unknown:
+                pipe.incr(SEEN_KEY_PREFIX + key)
+                pipe.expire(SEEN_KEY_PREFIX + key, PAGE_STATIC_SEEN_TTL)
+            seen = pipe.execute()[::2]
+        except redis.RedisError as e:
+            print(f"Page seen counters unavailable ({e}); splicing marked pages only")
+            return
+        for (i, key), count in zip(unknown, seen):
+            if count >= PAGE_STATIC_MIN_SEEN:
+                self.keys[i] = key
+
+    def write_dynamic(self):
+        dynamic = [s for s, key in zip(self.sections, self.keys) if key is None]
+        if not dynamic:
+            self.dynamic_path = None
+            return
+        with open(self.dynamic_path, "wb") as f:
+            f.write(self.prefix + b"\n".join(dynamic) + self.suffix)
+
+    def render_fragments(self, render):
+        """
+        Render the static pages missing from the fragment cache with
+        render(html_path, pdf_path).
+        """
+        for i, key in enumerate(self.keys):
+            if key is None:
+                continue
+            path = _fragment_path(key)
+            if os.path.exists(path):
+                _touch(path)
+                metrics.PAGE_FRAGMENTS.labels("hit").inc()
+                continue
+            prefix, suffix = self._context(bool(_STATIC.search(self._open_tag(i))))
+            # Next to the document, so relative references resolve the same way
+            base = os.path.splitext(self.html_path)[0]
+            html_path, pdf_path = f"{base}.page-{i}.html", f"{base}.page-{i}.pdf"
+            with open(html_path, "wb") as f:
+                f.write(prefix + self.sections[i] + suffix)
+            try:
+                render(html_path, pdf_path)
+            except RenderError as e:
+                raise SpliceError(f"static page {i + 1}: {e}", e.details)
+            _cache_put(pdf_path, path)
+            self.rendered += 1
+            metrics.PAGE_FRAGMENTS.labels("rendered").inc()
+
+    def splice(self, dynamic_pdf: str, pdf_path: str):
+        """
+        Write the document to pdf_path: fragments for static pages, the pages
+        of dynamic_pdf (the render of dynamic_path) for the others.
+        """
+        runs = []  # [fragment key | number of dynamic sections]
+        for key in self.keys:
+            if key is None and runs and isinstance(runs[-1], int):
+                runs[-1] += 1
+            else:
+                runs.append(1 if key is None else key)
+        dynamic_runs = [run for run in runs if isinstance(run, int)]
+
+        writer = PdfWriter()
+        try:
+            dynamic = PdfReader(dynamic_pdf).pages if dynamic_runs else []
+            if len(dynamic_runs) > 1 and len(dynamic) != sum(dynamic_runs):
+                # Can't tell which PDF pages belong to which section
+                raise SpliceError(f"{len(dynamic)} PDF pages for {sum(dynamic_runs)} page sections")
+            pos = 0
+            for run in runs:
+                if isinstance(run, int):
+                    n = run if len(dynamic_runs) > 1 else len(dynamic)
+                    for page in dynamic[pos:pos + n]:
+                        writer.add_page(page)
+                    pos += n
+                else:
+                    for page in PdfReader(_fragment_path(run)).pages:
+                        writer.add_page(page)
+            with open(pdf_path, "wb") as f:
+                writer.write(f)
+        except (PyPdfError, OSError, ValueError) as e:
+            raise SpliceError(str(e))
+
+    def report(self) -> dict:
+        return {"sections": len(self.sections), "static": sum(1 for k in self.keys if k),
+                "fragments_rendered": self.rendered}
+
+
+def _fragment_path(key: str) -> str:
+    return os.path.join(PAGE_CACHE_DIR, f"{key}.pdf")
+
+
+def _touch(path: str):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _cache_put(src_path: str, path: str):
+    """
+    Atomically add a fragment, then drop the least recently used ones past
+    PAGE_CACHE_MAX_FILES.
+    """
+    os.makedirs(PAGE_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=PAGE_CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out, open(src_path, "rb") as src:
+            out.write(src.read())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    entries = []
+    with os.scandir(PAGE_CACHE_DIR) as it:
+        for entry in it:
+            if entry.name.endswith(".pdf"):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    continue
+    entries.sort()
+    for _, old in entries[:max(0, len(entries) - PAGE_CACHE_MAX_FILES)]:
+        try:
+            os.remove(old)
+        except FileNotFoundError:
+            pass
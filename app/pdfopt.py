@@ -0,0 +1,208 @@
+# app/pdfopt.py
+"""
+Optional post-processing of rendered PDFs (pikepdf), by profile:
+
+  archive  lossless: identical objects merged, unused resources dropped,
+           streams recompressed into object streams, linearized
+  email    + photos (JPEG) re-encoded at quality 80, images capped at 1600 px
+  mobile   + photos at quality 60, images capped at 1000 px
+
+Repeated images and fonts (the same logo on every page, identical font
+programs) are stored once. Chart and logo bitmaps (Flate) stay lossless and
+are only downsampled when over the cap; soft masks are left alone.
+Fonts are not re-subset: wkhtmltopdf already embeds subsets.
+
+Linearized output lets viewers show the first page before the whole file
+has downloaded. The result is kept only if it is not noticeably larger;
+any failure leaves the original PDF untouched.
+
+Profile per job (profile=...) or PDF_OPTIMIZE_PROFILE for every job; the
+stage is skipped when pikepdf is not installed.
+"""
+import io
+import os
+import zlib
+import hashlib
+
+try:
+    import pikepdf
+    from pikepdf import Name, PdfImage
+except ImportError:  # optional: PDFs are then stored as rendered
+    pikepdf = None
+
+PDF_OPTIMIZE_PROFILE = os.getenv("PDF_OPTIMIZE_PROFILE", "")
+
+PROFILES = {
+    "archive": {"jpeg_quality": None, "max_px": None},
+    "email": {"jpeg_quality": 80, "max_px": 1600},
+    "mobile": {"jpeg_quality": 60, "max_px": 1000},
+}
+# Linearization tables may add a little; beyond this the original is kept
+MAX_GROWTH = 1.02
+
+
+class OptimizeError(ValueError):
+    pass
+
+
+def check_profile(profile: str):
+    if profile and profile not in PROFILES:
+        raise OptimizeError(f"Unknown PDF profile {profile!r} (one of {', '.join(PROFILES)})")
+
+
+def optimize_pdf(pdf_path: str, profile: str = None) -> dict:
+    """
+    Optimize pdf_path in place. Returns a report for the task result
+    ({} when no profile applies).
+    """
+    profile = profile or PDF_OPTIMIZE_PROFILE
+    if not profile:
+        return {}
+    check_profile(profile)
+    if pikepdf is None:
+        return {"profile": profile, "skipped": "pikepdf not installed"}
+
+    settings = PROFILES[profile]
+    before = os.path.getsize(pdf_path)
+    tmp_path = f"{pdf_path}.opt"
+    report = {"profile": profile, "bytes_before": before}
+    try:
+        with pikepdf.open(pdf_path) as pdf:
+            report["images_recompressed"] = _recompress_images(pdf, settings)
+            report["objects_merged"] = _merge_duplicate_streams(pdf)
+            pdf.remove_unreferenced_resources()
+            pdf.save(
+                tmp_path,
+                linearize=True,
+                compress_streams=True,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
+            )
+        after = os.path.getsize(tmp_path)
+        if after > before * MAX_GROWTH:
+            os.remove(tmp_path)
+            report.update(bytes_after=before, kept="original")
+        else:
+            os.replace(tmp_path, pdf_path)
+            report.update(bytes_after=after)
+    except Exception as e:
+        # Never fail a bill over its optimization
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        report.update(bytes_after=before, error=str(e)[:500])
+    return report
+
+
+def _recompress_images(pdf, settings: dict) -> int:
+    quality, max_px = settings["jpeg_quality"], settings["max_px"]
+    if quality is None and max_px is None:
+        return 0
+
+    masks = {obj.SMask.objgen for obj in pdf.objects
+             if isinstance(obj, pikepdf.Stream) and "/SMask" in obj}
+    done = 0
+    for obj in list(pdf.objects):
+        if not isinstance(obj, pikepdf.Stream) or obj.get("/Subtype") != "/Image":
+            continue
+        if obj.objgen in masks or obj.get("/ImageMask") or obj.get("/BitsPerComponent") != 8:
+            continue
+        if obj.get("/ColorSpace") not in ("/DeviceRGB", "/DeviceGray"):
+            continue
+        is_jpeg = obj.get("/Filter") == "/DCTDecode"
+        too_big = max_px and max(int(obj.Width), int(obj.Height)) > max_px
+        if not (too_big or (is_jpeg and quality)):
+            continue
+        if _rewrite_image(obj, is_jpeg, quality or 90, max_px):
+            done += 1
+    return done
+
+
+def _rewrite_image(obj, is_jpeg: bool, quality: int, max_px) -> bool:
+    """
+    Re-encode one image XObject; photos as JPEG, everything else as Flate.
+    Only replaced when the new stream is smaller.
+    """
+    image = PdfImage(obj).as_pil_image()
+    mode = "L" if obj.ColorSpace == "/DeviceGray" else "RGB"
+    image = image.convert(mode)
+    if max_px and max(image.size) > max_px:
+        image.thumbnail((max_px, max_px))
+
+    if is_jpeg:
+        buf = io.BytesIO()
+        image.save(buf, format="JPEG", quality=quality, optimize=True)
+        data, filter_ = buf.getvalue(), Name.DCTDecode
+    else:
+        data, filter_ = zlib.compress(image.tobytes(), 9), Name.FlateDecode
+
+    if len(data) >= len(obj.read_raw_bytes()):
+        return False
+    obj.write(data, filter=filter_)
+    obj.Width, obj.Height = image.size
+    obj.ColorSpace = Name.DeviceGray if mode == "L" else Name.DeviceRGB
+    obj.BitsPerComponent = 8
+    for key in ("/DecodeParms", "/Decode"):
+        if key in obj:
+            del obj[key]
+    return True
+
+
+def _merge_duplicate_streams(pdf, max_passes: int = 4) -> int:
+    """
+    Point every reference to a byte-identical stream (same data and
+    dictionary) at one copy; unreferenced copies are dropped on save.
+    Repeated, since merging e.g. two identical soft masks makes the images
+    that reference them identical too.
+    """
+    merged = set()
+    for _ in range(max_passes):
+        dupes = _find_duplicates(pdf, merged)
+        if not dupes:
+            break
+        for obj in pdf.objects:
+            if isinstance(obj, (pikepdf.Dictionary, pikepdf.Stream, pikepdf.Array)):
+                _relink(obj, dupes)
+        _relink(pdf.trailer, dupes)
+        merged.update(dupes)
+    return len(merged)
+
+
+def _find_duplicates(pdf, skip: set) -> dict:
+    """
+    {objgen of a duplicate stream: the stream to use instead}
+    """
+    canonical, dupes = {}, {}
+    for obj in pdf.objects:
+        if not isinstance(obj, pikepdf.Stream) or obj.objgen in skip:
+            continue
+        try:
+            raw = obj.read_raw_bytes()
+        except pikepdf.PdfError:
+            continue
+        meta = pikepdf.Dictionary(obj.stream_dict)
+        if "/Length" in meta:
+            del meta["/Length"]
+        key = hashlib.sha256(meta.unparse() + b"\0" + raw).digest()
+        if key in canonical:
+            dupes[obj.objgen] = canonical[key]
+        else:
+            canonical[key] = obj
+    return dupes
+
+
+def _relink(container, dupes: dict):
+    """
+    Replace references to duplicates inside container (and its direct
+    sub-dictionaries / arrays).
+    """
+    if isinstance(container, pikepdf.Array):
+        items = enumerate(list(container))
+    else:
+        items = [(k, container[k]) for k in list(container.keys())]
+    for key, value in items:
+        if not isinstance(value, pikepdf.Object):
+            continue  # numbers / booleans come back as Python values
+        if value.is_indirect:
+            if value.objgen in dupes:
+                container[key] = dupes[value.objgen]
+        elif isinstance(value, (pikepdf.Dictionary, pikepdf.Array)):
+            _relink(value, dupes)
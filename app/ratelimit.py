@@ -0,0 +1,97 @@
+# app/ratelimit.py
+"""
+Per-division render rate limits: token buckets in Redis, shared by all
+workers.
+
+Every render task of a division (tenant) takes tokens from
+ratelimit:{division} before it runs: one per document. Buckets refill at
+DIVISION_RATE_LIMIT documents/second up to DIVISION_RATE_BURST, with
+per-division overrides in DIVISION_RATE_LIMITS ("bhopal=20,indore=5").
+A task that finds its bucket empty is retried later, so its worker slot
+goes to other divisions' jobs in the meantime and one division's billing
+cycle cannot monopolise the fleet. Retries are spread over the time the
+division's backlog needs to drain: each throttled task reserves the next
+free slot of the division's schedule  ratelimit_next:{division}  (cost/rate
+seconds per task), instead of every task coming back when the bucket next
+refills and most of them being throttled again.
+
+A rate of 0 disables the limit (the default).
+"""
+import os
+
+DIVISION_RATE_LIMIT = float(os.getenv("DIVISION_RATE_LIMIT", "0"))
+DIVISION_RATE_BURST = float(os.getenv("DIVISION_RATE_BURST", "20"))
+DIVISION_RATE_LIMITS = {
+    name.strip(): float(rate)
+    for name, _, rate in (
+        item.partition("=") for item in os.getenv("DIVISION_RATE_LIMITS", "").split(",") if "=" in item
+    )
+}
+
+RATELIMIT_PREFIX = "ratelimit:"
+SCHEDULE_PREFIX = "ratelimit_next:"
+
+# Refill by elapsed time (Redis clock, same for every worker), then take
+# ARGV[3] tokens if available. Returns the seconds to wait (0 = go) as a
+# string, since Lua numbers are truncated to integers on return.
+# Also used for the API's per-client quotas (app/admission.py).
+TAKE_TOKENS = """
+local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+return tostring(wait)
+"""
+
+
+# Reserve the retry slot of a throttled task: the later of now + ARGV[1] (the
+# bucket's refill wait) and the division's next free slot, which then moves
+# on by ARGV[2] tokens at ARGV[3]/second. Returns the seconds until the slot.
+_RESERVE_SLOT = """
+local wait, cost, rate = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local slot = math.max(now + wait, tonumber(redis.call('GET', KEYS[1]) or '0'))
+local next_slot = slot + cost / rate
+redis.call('SET', KEYS[1], tostring(next_slot), 'EX', math.ceil(next_slot - now) + 60)
+return tostring(slot - now)
+"""
+
+
+def division_rate(division: str) -> float:
+    return DIVISION_RATE_LIMITS.get(division, DIVISION_RATE_LIMIT)
+
+
+def acquire(r, division: str, cost: int = 1) -> float:
+    """
+    Take cost tokens from the division's bucket.
+    Returns 0 if the job may run now, else the seconds until it may.
+    """
+    rate = division_rate(division) if division else 0
+    if rate <= 0:
+        return 0.0
+    burst = max(DIVISION_RATE_BURST, 1.0)
+    # A batch bigger than the burst waits for a full bucket, then takes it all
+    cost = min(cost, burst)
+    return float(r.eval(TAKE_TOKENS, 1, RATELIMIT_PREFIX + division, rate, burst, cost))
+
+
+def retry_delay(r, division: str, wait: float, cost: int = 1) -> float:
+    """
+    Seconds until a task that acquire() throttled (wait) should come back:
+    its slot in the division's retry schedule.
+    """
+    rate = division_rate(division)
+    cost = min(cost, max(DIVISION_RATE_BURST, 1.0))
+    return float(r.eval(_RESERVE_SLOT, 1, SCHEDULE_PREFIX + division, wait, cost, rate))
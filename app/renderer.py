@@ -0,0 +1,679 @@
+# app/renderer.py
+"""
+Render engine layer: HTML file -> PDF file.
+
+Two engines are available:
+- "wkhtmltopdf": one wkhtmltopdf subprocess per document (the original path,
+  always available and used as the fallback).
+- "weasyprint": a pool of long-lived renderer processes. Each one imports
+  WeasyPrint once and then takes documents over a stdin/stdout pipe, so fonts,
+  CSS machinery and interpreter startup are paid once per renderer instead of
+  once per bill. Renderers are recycled after RENDERER_MAX_JOBS documents or
+  when their RSS passes RENDERER_MAX_RSS_MB.
+
+The engine is chosen with PDF_ENGINE; wkhtmltopdf stays the default because
+bills are laid out for it. Its startup is amortized by batch renders instead
+(render_pdf_batch: one process per generate_pdf_batch chunk). WeasyPrint is
+a different layout engine, so check a cycle's bills before switching:
+- no JavaScript: documents with <script> (e.g. Chart.js charts) are
+  rendered by wkhtmltopdf instead; bill templates draw their charts as
+  inline SVG (app/charts.py) and need no script;
+- CSS paged media (@page, page-break-*) is followed more strictly, flexbox
+  and grid layouts differ from wkhtmltopdf's old WebKit, and --dpi /
+  --image-quality do not apply (images keep their resolution), so page
+  breaks and sizes of the same HTML can differ;
+- offline renders (RENDER_OFFLINE) only load file: and data: URLs.
+
+Renderer processes are started with
+subprocess (not multiprocessing) because Celery prefork children are daemonic
+and may not fork multiprocessing children.
+
+Resource governance: renderer processes run in their own process group with
+rlimits on address space (RENDER_MAX_MEMORY_MB), open files
+(RENDER_MAX_OPEN_FILES) and, for one-shot renders, CPU time (the render's
+timeout, or RENDER_MAX_CPU_SECONDS). The timeout itself is derived from the
+document (render_timeout: size and page count, at most RENDER_TIMEOUT), and
+the whole group is killed when it expires. Failures carry the reason,
+limits and usage in RenderError.details.
+"""
+import os
+import re
+import sys
+import json
+import queue
+import signal
+import resource
+import tempfile
+import selectors
+import subprocess
+import threading
+import xml.etree.ElementTree as ET
+
+PDF_ENGINE = os.getenv("PDF_ENGINE", "wkhtmltopdf")  # "wkhtmltopdf" | "weasyprint"
+WKHTML_BIN = os.getenv("WKHTML_BIN", "/usr/bin/wkhtmltopdf")
+# Upper bound; each document gets render_timeout() from its size and pages
+RENDER_TIMEOUT = int(os.getenv("RENDER_TIMEOUT", "300"))
+RENDER_TIMEOUT_MIN = int(os.getenv("RENDER_TIMEOUT_MIN", "30"))
+RENDER_TIMEOUT_PER_MB = float(os.getenv("RENDER_TIMEOUT_PER_MB", "60"))
+RENDER_TIMEOUT_PER_PAGE = float(os.getenv("RENDER_TIMEOUT_PER_PAGE", "10"))
+
+# Per renderer process; 0 = no limit
+RENDER_MAX_MEMORY_MB = int(os.getenv("RENDER_MAX_MEMORY_MB", "4096"))
+RENDER_MAX_CPU_SECONDS = int(os.getenv("RENDER_MAX_CPU_SECONDS", "0"))  # 0 = the render's timeout
+RENDER_MAX_OPEN_FILES = int(os.getenv("RENDER_MAX_OPEN_FILES", "1024"))
+
+# Offline renders: wkhtmltopdf goes through a dead proxy, so any external URL
+# not rewritten by app.resolver fails at once instead of waiting for a timeout
+RENDER_OFFLINE = os.getenv("RENDER_OFFLINE", "1") == "1"
+OFFLINE_PROXY = os.getenv("OFFLINE_PROXY", "http://127.0.0.1:9")
+
+RENDERER_POOL_SIZE = int(os.getenv("RENDERER_POOL_SIZE", "1"))
+RENDERER_MAX_JOBS = int(os.getenv("RENDERER_MAX_JOBS", "500"))
+RENDERER_MAX_RSS_MB = int(os.getenv("RENDERER_MAX_RSS_MB", "1024"))
+
+# Page setup shared by every engine (A4, 10mm margins)
+PAGE_CSS = "@page { size: A4; margin: 10mm; }"
+WKHTML_OPTIONS = [
+    "--enable-local-file-access",
+    "--image-quality", "100",
+    "--dpi", "150",
+    "--page-size", "A4",
+    "--margin-top", "10mm",
+    "--margin-bottom", "10mm",
+    "--margin-left", "10mm",
+    "--margin-right", "10mm",
+]
+if RENDER_OFFLINE:
+    WKHTML_OPTIONS += [
+        "--proxy", OFFLINE_PROXY,
+        "--load-error-handling", "ignore",
+        "--load-media-error-handling", "ignore",
+    ]
+
+
+class RenderError(RuntimeError):
+    def __init__(self, message: str = "", details: dict = None):
+        super().__init__(message)
+        self.details = details or {}
+
+
+class EngineUnavailable(RenderError):
+    """The engine cannot run here (missing binary / library); use the fallback."""
+
+
+class RenderTimeout(RenderError):
+    """The render ran past its timeout; its process group was killed."""
+
+
+class RenderResourceLimit(RenderError):
+    """The renderer was stopped by its CPU or memory limit."""
+
+
+_PAGE_CLASS = re.compile(rb"""class\s*=\s*["'](?:[^"']*\s)?page(?:\s[^"']*)?["']""", re.IGNORECASE)
+_SCRIPT_TAG = re.compile(rb"<script[\s>]", re.IGNORECASE)
+
+
+def render_timeout(html_path: str) -> int:
+    """
+    Timeout for one document: RENDER_TIMEOUT_MIN plus RENDER_TIMEOUT_PER_MB
+    per MB of HTML and RENDER_TIMEOUT_PER_PAGE per page section beyond the
+    first, capped at RENDER_TIMEOUT.
+    """
+    try:
+        size = os.path.getsize(html_path)
+        with open(html_path, "rb") as f:
+            pages = len(_PAGE_CLASS.findall(f.read(8 * 1024 * 1024)))
+    except OSError:
+        return RENDER_TIMEOUT
+    timeout = (RENDER_TIMEOUT_MIN + size / (1024 * 1024) * RENDER_TIMEOUT_PER_MB
+               + max(pages - 1, 0) * RENDER_TIMEOUT_PER_PAGE)
+    return int(min(RENDER_TIMEOUT, max(RENDER_TIMEOUT_MIN, timeout)))
+
+
+def uses_javascript(html_path: str) -> bool:
+    """
+    Whether the document has <script> elements (read in 1 MB blocks).
+    """
+    tail = b""
+    try:
+        with open(html_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                if _SCRIPT_TAG.search(tail + block):
+                    return True
+                tail = block[-16:]
+    except OSError:
+        pass
+    return False
+
+
+def resource_limits(cpu_seconds: float = None) -> dict:
+    """
+    rlimits for a renderer process ({name: soft limit}); cpu_seconds None =
+    no CPU limit (long-lived renderers).
+    """
+    limits = {}
+    if RENDER_MAX_MEMORY_MB > 0:
+        limits["memory_mb"] = RENDER_MAX_MEMORY_MB
+    if RENDER_MAX_OPEN_FILES > 0:
+        limits["open_files"] = RENDER_MAX_OPEN_FILES
+    if cpu_seconds:
+        limits["cpu_seconds"] = int(RENDER_MAX_CPU_SECONDS or cpu_seconds)
+    return limits
+
+
+def _limiter(limits: dict):
+    """
+    preexec_fn applying limits in the renderer process (before exec).
+    """
+    def apply():
+        if "memory_mb" in limits:
+            size = limits["memory_mb"] * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (size, size))
+        if "open_files" in limits:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (limits["open_files"], limits["open_files"]))
+        if "cpu_seconds" in limits:
+            # SIGXCPU at the soft limit, SIGKILL shortly after
+            resource.setrlimit(resource.RLIMIT_CPU, (limits["cpu_seconds"], limits["cpu_seconds"] + 5))
+    return apply
+
+
+def _kill_group(pid: int):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+_OOM_MARKERS = (b"bad_alloc", b"Cannot allocate memory", b"out of memory", b"MemoryError")
+
+
+def run_limited(cmd, timeout: float, limits: dict) -> dict:
+    """
+    Run cmd in its own process group under limits (resource_limits()); the
+    whole group is killed after timeout seconds. Returns {"returncode",
+    "stdout", "stderr", "cpu_seconds", "max_rss_mb"}; raises RenderTimeout
+    or RenderResourceLimit.
+    """
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=out, stderr=err,
+                                start_new_session=True, preexec_fn=_limiter(limits))
+        waited = {}
+        # wait4 reports this render's own CPU time and peak RSS
+        waiter = threading.Thread(target=lambda: waited.update(result=os.wait4(proc.pid, 0)), daemon=True)
+        waiter.start()
+        waiter.join(timeout)
+        timed_out = waiter.is_alive()
+        # On timeout the renderer and anything it started; otherwise leftovers
+        _kill_group(proc.pid)
+        waiter.join()
+        _, status, usage = waited["result"]
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+        out.seek(0)
+        err.seek(0)
+        stdout, stderr = out.read(), err.read()
+
+    result = {
+        "returncode": proc.returncode,
+        "stdout": stdout.decode("utf-8", errors="ignore"),
+        "stderr": stderr.decode("utf-8", errors="ignore"),
+        "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 3),
+        "max_rss_mb": round(usage.ru_maxrss / 1024.0, 1),  # KiB on Linux
+    }
+    details = {"timeout": timeout, "limits": limits, "returncode": proc.returncode,
+               "cpu_seconds": result["cpu_seconds"], "max_rss_mb": result["max_rss_mb"]}
+    if timed_out:
+        raise RenderTimeout(f"render timed out after {timeout}s (process group killed)",
+                            {"reason": "timeout", **details})
+    rc = proc.returncode
+    if rc in (-signal.SIGXCPU, -signal.SIGKILL) and "cpu_seconds" in limits \
+            and result["cpu_seconds"] >= limits["cpu_seconds"] - 1:
+        raise RenderResourceLimit(f"render exceeded its CPU limit of {limits['cpu_seconds']}s",
+                                  {"reason": "cpu_limit", **details})
+    if rc != 0 and "memory_mb" in limits and any(m in stderr for m in _OOM_MARKERS):
+        raise RenderResourceLimit(f"render exceeded its memory limit of {limits['memory_mb']} MB",
+                                  {"reason": "memory_limit", **details})
+    return result
+
+
+_batch_support = {}
+
+
+def wkhtml_batch_supported(bin_path: str = WKHTML_BIN) -> bool:
+    """
+    Whether bin_path can render batches: several inputs with --outline /
+    --dump-outline need a wkhtmltopdf built against patched Qt (the
+    wkhtmltox packages; distribution packages usually are not). Checked once
+    per process; workers check in the parent so their children inherit it.
+    """
+    if bin_path not in _batch_support:
+        try:
+            out = subprocess.run([bin_path, "--version"], stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, timeout=30).stdout
+            supported = b"patched qt" in out.lower()
+        except (OSError, subprocess.SubprocessError):
+            supported = False
+        if not supported:
+            print(f"{bin_path} is not built with patched Qt; batches are rendered one document at a time")
+        _batch_support[bin_path] = supported
+    return _batch_support[bin_path]
+
+
+def batch_supported() -> bool:
+    """
+    Whether render_pdf_batch can work with the configured engine.
+    """
+    return PDF_ENGINE != SubprocessEngine.name or wkhtml_batch_supported()
+
+
+class SubprocessEngine:
+    """
+    One wkhtmltopdf process per document.
+    """
+    name = "wkhtmltopdf"
+
+    def __init__(self, bin_path: str = WKHTML_BIN, options=None):
+        self.bin_path = bin_path
+        self.options = list(WKHTML_OPTIONS if options is None else options)
+
+    def render(self, html_path: str, pdf_path: str, timeout: int = RENDER_TIMEOUT) -> dict:
+        cmd = [self.bin_path, *self.options, html_path, pdf_path]
+
+        run = run_limited(cmd, timeout, resource_limits(timeout))
+        if run["returncode"] != 0:
+            raise RenderError(f"wkhtmltopdf rc={run['returncode']} stderr={run['stderr'][:1000]}",
+                              {"reason": "crashed" if run["returncode"] < 0 else "exit",
+                               "returncode": run["returncode"], "max_rss_mb": run["max_rss_mb"]})
+
+        if not os.path.exists(pdf_path):
+            raise RenderError("wkhtmltopdf finished but output.pdf not found")
+
+        return {"engine": self.name, "stdout": run["stdout"][:500], "stderr": run["stderr"][:500],
+                "cpu_seconds": run["cpu_seconds"], "max_rss_mb": run["max_rss_mb"], "timeout": timeout}
+
+    def render_batch(self, html_paths, pdf_paths, timeout: int = RENDER_TIMEOUT) -> dict:
+        """
+        Render several documents with ONE wkhtmltopdf invocation, then split the
+        combined PDF back into one file per document.
+
+        Every input gets an invisible top-level marker heading; --dump-outline
+        reports the page each marker landed on, which gives the page range per
+        document.
+        """
+        if not wkhtml_batch_supported(self.bin_path):
+            raise RenderError(f"{self.bin_path} cannot render batches (needs patched Qt)")
+        workdir = os.path.dirname(pdf_paths[0])
+        combined = os.path.join(workdir, "batch.pdf")
+        outline = os.path.join(workdir, "batch-outline.xml")
+
+        marked_paths = [_with_batch_marker(p, i) for i, p in enumerate(html_paths)]
+
+        cmd = [self.bin_path, *self.options, "--outline", "--outline-depth", "1",
+               "--dump-outline", outline,
+               *marked_paths, combined]
+        batch_timeout = timeout * len(html_paths)
+        run = run_limited(cmd, batch_timeout, resource_limits(batch_timeout))
+        stderr = run["stderr"]
+        if run["returncode"] != 0:
+            raise RenderError(f"wkhtmltopdf rc={run['returncode']} stderr={stderr[:1000]}")
+        if not os.path.exists(combined) or not os.path.exists(outline):
+            raise RenderError("wkhtmltopdf finished but batch output not found")
+
+        starts = _batch_marker_pages(outline, len(html_paths))
+        split_pdf(combined, starts, pdf_paths)
+        return {"engine": self.name, "stderr": stderr[:500], "invocations": 1,
+                "cpu_seconds": run["cpu_seconds"], "max_rss_mb": run["max_rss_mb"]}
+
+    def close(self):
+        pass
+
+
+BATCH_MARKER = "ngb-batch-doc-"
+_BODY_OPEN = re.compile(rb"<body[^>]*>", re.IGNORECASE)
+
+
+def _with_batch_marker(html_path: str, index: int) -> str:
+    """
+    Copy of html_path with the batch marker inserted right after <body>.
+    """
+    marker = (
+        f'<h1 style="margin:0;padding:0;height:0;line-height:0;font-size:1px;'
+        f'color:transparent;overflow:hidden">{BATCH_MARKER}{index}</h1>'
+    ).encode("utf-8")
+    with open(html_path, "rb") as f:
+        html = f.read()
+    m = _BODY_OPEN.search(html)
+    pos = m.end() if m else 0
+    marked_path = f"{html_path}.batch.html"
+    with open(marked_path, "wb") as f:
+        f.write(html[:pos] + marker + html[pos:])
+    return marked_path
+
+
+def _batch_marker_pages(outline_path: str, count: int) -> list:
+    """
+    0-based start page of each document, read from wkhtmltopdf's outline dump.
+    """
+    pages = {}
+    for item in ET.parse(outline_path).getroot().iter():
+        title = item.get("title") or ""
+        if title.startswith(BATCH_MARKER) and item.get("page") is not None:
+            pages.setdefault(int(title[len(BATCH_MARKER):]), int(item.get("page")))
+
+    if sorted(pages) != list(range(count)):
+        raise RenderError(f"batch outline has {len(pages)} markers for {count} documents")
+    starts = [pages[i] for i in range(count)]
+    if starts != sorted(starts):
+        raise RenderError("batch outline markers out of order")
+    # Outline page numbers are absolute; the first document starts at page 0
+    return [p - starts[0] for p in starts]
+
+
+def count_pages(pdf_path: str):
+    """
+    Number of pages of a PDF, or None if it cannot be parsed.
+    """
+    from pypdf import PdfReader
+    from pypdf.errors import PyPdfError
+
+    try:
+        return len(PdfReader(pdf_path).pages)
+    except (PyPdfError, OSError, ValueError):
+        return None
+
+
+def split_pdf(pdf_path: str, starts, pdf_paths):
+    """
+    Split pdf_path into len(starts) files; document i covers
+    pages [starts[i], starts[i+1]).
+    """
+    from pypdf import PdfReader, PdfWriter
+
+    reader = PdfReader(pdf_path)
+    total = len(reader.pages)
+    bounds = list(starts) + [total]
+    for i, out_path in enumerate(pdf_paths):
+        first, last = bounds[i], bounds[i + 1]
+        if not (0 <= first < last <= total):
+            raise RenderError(f"bad page range {first}-{last} for document {i} (total={total})")
+        writer = PdfWriter()
+        for n in range(first, last):
+            writer.add_page(reader.pages[n])
+        with open(out_path, "wb") as f:
+            writer.write(f)
+
+
+class PersistentRenderer:
+    """
+    A single warm renderer process speaking line-delimited JSON over its pipes:
+      request:  {"html": "/path/in.html", "pdf": "/path/out.pdf"}
+      response: {"ok": true} | {"ok": false, "error": "..."}
+    The process announces itself with {"ready": true} once its library is loaded.
+    """
+
+    def __init__(self, argv, start_timeout: int = 60):
+        # Memory / file limits only: CPU time adds up over the renderer's life
+        self.limits = resource_limits()
+        self.proc = subprocess.Popen(
+            argv,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            bufsize=0,
+            start_new_session=True,
+            preexec_fn=_limiter(self.limits),
+        )
+        self.jobs = 0
+        hello = self._read(start_timeout)
+        if not hello.get("ready"):
+            self.close()
+            raise EngineUnavailable(hello.get("error") or "renderer failed to start")
+
+    def _read(self, timeout: float) -> dict:
+        sel = selectors.DefaultSelector()
+        sel.register(self.proc.stdout, selectors.EVENT_READ)
+        try:
+            if not sel.select(timeout):
+                self.kill()
+                raise RenderTimeout(f"renderer timed out after {timeout}s (process group killed)",
+                                    {"reason": "timeout", "timeout": timeout, "limits": self.limits})
+        finally:
+            sel.close()
+
+        line = self.proc.stdout.readline()
+        if not line:
+            self.kill()
+            raise RenderError(f"renderer exited (rc={self.proc.poll()})",
+                              {"reason": "crashed", "returncode": self.proc.poll(), "limits": self.limits})
+        return json.loads(line)
+
+    def render(self, html_path: str, pdf_path: str, timeout: int = RENDER_TIMEOUT) -> dict:
+        request = json.dumps({"html": html_path, "pdf": pdf_path}) + "\n"
+        try:
+            self.proc.stdin.write(request.encode("utf-8"))
+        except (BrokenPipeError, OSError) as e:
+            self.kill()
+            raise RenderError(f"renderer pipe closed: {e}")
+
+        reply = self._read(timeout)
+        self.jobs += 1
+        if not reply.get("ok"):
+            raise RenderError(reply.get("error") or "render failed")
+        if not os.path.exists(pdf_path):
+            raise RenderError("renderer finished but output.pdf not found")
+        return {}
+
+    @property
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def rss_mb(self) -> float:
+        try:
+            with open(f"/proc/{self.proc.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) / 1024.0
+        except OSError:
+            pass
+        return 0.0
+
+    def kill(self):
+        if self.alive:
+            _kill_group(self.proc.pid)
+        self.proc.wait()
+
+    def close(self):
+        if self.alive:
+            try:
+                self.proc.stdin.close()
+                self.proc.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        self.kill()
+
+
+class RendererPool:
+    """
+    Fixed-size pool of PersistentRenderer processes, created lazily and
+    recycled after max_jobs documents or past max_rss_mb.
+    """
+
+    def __init__(self, factory, size: int = RENDERER_POOL_SIZE,
+                 max_jobs: int = RENDERER_MAX_JOBS, max_rss_mb: int = RENDERER_MAX_RSS_MB):
+        self.factory = factory
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max(1, size))
+
+    def _should_recycle(self, renderer: PersistentRenderer) -> bool:
+        if not renderer.alive:
+            return True
+        if self.max_jobs and renderer.jobs >= self.max_jobs:
+            return True
+        if self.max_rss_mb and renderer.rss_mb() >= self.max_rss_mb:
+            return True
+        return False
+
+    def render(self, html_path: str, pdf_path: str, timeout: int = RENDER_TIMEOUT) -> dict:
+        with self._slots:
+            try:
+                renderer = self._idle.get_nowait()
+            except queue.Empty:
+                renderer = self.factory()
+
+            try:
+                result = renderer.render(html_path, pdf_path, timeout=timeout)
+                result["renderer_jobs"] = renderer.jobs
+                return result
+            finally:
+                if self._should_recycle(renderer):
+                    renderer.close()
+                else:
+                    self._idle.put(renderer)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class WeasyPrintEngine:
+    """
+    Pool of persistent WeasyPrint processes (see weasyprint_server below).
+    WeasyPrint runs no JavaScript, so documents with scripts go to one-shot
+    wkhtmltopdf.
+    """
+    name = "weasyprint"
+
+    def __init__(self, size: int = RENDERER_POOL_SIZE):
+        argv = [sys.executable, "-m", "app.renderer", "weasyprint-server"]
+        self.pool = RendererPool(lambda: PersistentRenderer(argv), size=size)
+
+    def render(self, html_path: str, pdf_path: str, timeout: int = RENDER_TIMEOUT) -> dict:
+        if uses_javascript(html_path):
+            result = get_fallback_engine().render(html_path, pdf_path, timeout=timeout)
+            result["reason"] = "javascript"
+            return result
+        result = self.pool.render(html_path, pdf_path, timeout=timeout)
+        result["engine"] = self.name
+        return result
+
+    def render_batch(self, html_paths, pdf_paths, timeout: int = RENDER_TIMEOUT) -> dict:
+        # Renderers are already warm, so a batch is just consecutive documents
+        for html_path, pdf_path in zip(html_paths, pdf_paths):
+            self.render(html_path, pdf_path, timeout=timeout)
+        return {"engine": self.name}
+
+    def close(self):
+        self.pool.close()
+
+
+ENGINES = {
+    SubprocessEngine.name: SubprocessEngine,
+    WeasyPrintEngine.name: WeasyPrintEngine,
+}
+
+_engine = None
+_fallback = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """
+    Engine for this process, created on first use (i.e. after the Celery fork).
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            cls = ENGINES.get(PDF_ENGINE)
+            if cls is None:
+                raise RenderError(f"Unknown PDF_ENGINE={PDF_ENGINE!r} (choose from {sorted(ENGINES)})")
+            _engine = cls()
+        return _engine
+
+
+def get_fallback_engine():
+    global _fallback
+    with _engine_lock:
+        if _fallback is None:
+            _fallback = SubprocessEngine()
+        return _fallback
+
+
+def render_pdf(html_path: str, pdf_path: str, timeout: int = None) -> dict:
+    """
+    Render html_path to pdf_path with the configured engine, falling back to
+    one-shot wkhtmltopdf if the configured engine is unavailable.
+    timeout defaults to render_timeout(html_path).
+    Returns engine diagnostics (engine name, truncated stdout/stderr).
+    """
+    global _engine
+    timeout = timeout or render_timeout(html_path)
+    engine = get_engine()
+    try:
+        return engine.render(html_path, pdf_path, timeout=timeout)
+    except EngineUnavailable as e:
+        print(f"Render engine {engine.name} unavailable ({e}); falling back to wkhtmltopdf")
+        engine.close()
+        fallback = get_fallback_engine()
+        with _engine_lock:
+            _engine = fallback
+        return fallback.render(html_path, pdf_path, timeout=timeout)
+
+
+def render_pdf_batch(html_paths, pdf_paths, timeout: int = None) -> dict:
+    """
+    Render many documents in one go (see SubprocessEngine.render_batch).
+    timeout (per document) defaults to the largest render_timeout().
+    Raises RenderError if the batch cannot be rendered or split; callers
+    should then fall back to render_pdf per document.
+    """
+    timeout = timeout or max(render_timeout(p) for p in html_paths)
+    engine = get_engine()
+    try:
+        return engine.render_batch(html_paths, pdf_paths, timeout=timeout)
+    except EngineUnavailable:
+        return get_fallback_engine().render_batch(html_paths, pdf_paths, timeout=timeout)
+
+
+def weasyprint_server():
+    """
+    Entry point of a persistent WeasyPrint renderer (see PersistentRenderer).
+    """
+    out = sys.stdout.buffer
+    # Anything the library prints must not corrupt the protocol stream
+    sys.stdout = sys.stderr
+
+    def reply(**msg):
+        out.write((json.dumps(msg) + "\n").encode("utf-8"))
+        out.flush()
+
+    try:
+        from weasyprint import HTML, CSS, URLFetcher
+        page_css = CSS(string=PAGE_CSS)
+        # Same as wkhtmltopdf's dead proxy: anything not local fails at once
+        url_fetcher = URLFetcher(allowed_protocols=("file", "data") if RENDER_OFFLINE else None)
+    except Exception as e:
+        reply(ready=False, error=f"weasyprint unavailable: {e}")
+        return
+
+    reply(ready=True)
+    for line in sys.stdin.buffer:
+        if not line.strip():
+            continue
+        try:
+            req = json.loads(line)
+            HTML(filename=req["html"], url_fetcher=url_fetcher).write_pdf(req["pdf"], stylesheets=[page_css])
+            reply(ok=True)
+        except Exception as e:
+            reply(ok=False, error=str(e)[:1000])
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["weasyprint-server"]:
+        weasyprint_server()
+    else:
+        print("usage: python -m app.renderer weasyprint-server", file=sys.stderr)
+        sys.exit(2)
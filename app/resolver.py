@@ -0,0 +1,149 @@
+# app/resolver.py
+"""
+Offline resource resolution for renders.
+
+Before a document is rendered, every external resource it would fetch
+(script/img/iframe src, <link href>, CSS url() and @import) is looked up:
+- whitelisted (RESOURCE_WHITELIST) and present in RESOURCE_CACHE_DIR
+  -> rewritten to the local file:// copy
+- anything else -> rewritten to an empty "data:," resource, so the renderer
+  never waits on the network
+
+Plain links (<a href>) are left alone; they are not fetched by the renderer.
+RENDER_OFFLINE in app.renderer additionally points wkhtmltopdf at a dead
+proxy, so anything missed here fails immediately instead of timing out.
+
+The cache is pre-populated where network access is available:
+    python -m app.resolver fetch https://cdn.jsdelivr.net/npm/chart.js
+"""
+import os
+import re
+import sys
+import hashlib
+import urllib.request
+from urllib.parse import urlsplit
+
+RESOURCE_CACHE_DIR = os.getenv("RESOURCE_CACHE_DIR", "/data/resource-cache")
+RESOURCE_WHITELIST = [
+    h.strip().lower()
+    for h in os.getenv(
+        "RESOURCE_WHITELIST", "cdn.jsdelivr.net,fonts.googleapis.com,fonts.gstatic.com"
+    ).split(",")
+    if h.strip()
+]
+RESOURCE_FETCH_TIMEOUT = int(os.getenv("RESOURCE_FETCH_TIMEOUT", "20"))
+
+BLOCKED_URL = "data:,"
+
+_URL = r"(?:https?:)?//[^\"'\s)<>]+"
+_PATTERNS = [
+    # src="..." on script / img / iframe / source / embed ...
+    re.compile(r"(\bsrc\s*=\s*[\"'])(" + _URL + r")", re.IGNORECASE),
+    # href="..." inside <link ...> (stylesheets, fonts, icons)
+    re.compile(r"(<link\b[^>]*?\bhref\s*=\s*[\"'])(" + _URL + r")", re.IGNORECASE),
+    # CSS url(...) and @import "..."
+    re.compile(r"(\burl\(\s*[\"']?)(" + _URL + r")", re.IGNORECASE),
+    re.compile(r"(@import\s+[\"'])(" + _URL + r")", re.IGNORECASE),
+]
+
+
+def is_whitelisted(url: str) -> bool:
+    host = (urlsplit(url).hostname or "").lower()
+    return any(host == h or host.endswith("." + h) for h in RESOURCE_WHITELIST)
+
+
+def cache_path(url: str) -> str:
+    url = _absolute(url)
+    ext = os.path.splitext(urlsplit(url).path)[1][:8]
+    if not re.match(r"^\.[A-Za-z0-9]+$", ext or "."):
+        ext = ""
+    return os.path.join(RESOURCE_CACHE_DIR, hashlib.sha256(url.encode("utf-8")).hexdigest() + ext)
+
+
+def _absolute(url: str) -> str:
+    return "https:" + url if url.startswith("//") else url
+
+
+class ResourceReport:
+    def __init__(self):
+        self.cached = []
+        self.blocked = []
+
+    def as_dict(self) -> dict:
+        return {"cached": self.cached, "blocked": self.blocked}
+
+
+def resolve_html(html: str, report: ResourceReport = None) -> str:
+    """
+    Rewrite the external resources of html as described above.
+    """
+    report = report if report is not None else ResourceReport()
+
+    def replace(m):
+        url = m.group(2)
+        if is_whitelisted(_absolute(url)):
+            path = cache_path(url)
+            if os.path.exists(path):
+                report.cached.append(url)
+                return m.group(1) + "file://" + path
+            report.blocked.append({"url": url, "reason": "not cached"})
+        else:
+            report.blocked.append({"url": url, "reason": "not whitelisted"})
+        return m.group(1) + BLOCKED_URL
+
+    for pattern in _PATTERNS:
+        html = pattern.sub(replace, html)
+    return html
+
+
+def resolve_file(html_path: str) -> dict:
+    """
+    resolve_html in place on a file; returns the per-job report.
+    """
+    with open(html_path, "r", encoding="utf-8", errors="surrogateescape") as f:
+        html = f.read()
+    report = ResourceReport()
+    resolved = resolve_html(html, report)
+    if resolved != html:
+        with open(html_path, "w", encoding="utf-8", errors="surrogateescape") as f:
+            f.write(resolved)
+    return report.as_dict()
+
+
+def fetch(url: str, depth: int = 1) -> str:
+    """
+    Download a whitelisted URL into the cache. For stylesheets, the resources
+    they reference (fonts, images) are fetched too and rewritten to the cache.
+    """
+    url = _absolute(url)
+    if not is_whitelisted(url):
+        raise ValueError(f"{url} is not whitelisted (RESOURCE_WHITELIST)")
+
+    req = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0 (wkhtmltopdf resource cache)"})
+    with urllib.request.urlopen(req, timeout=RESOURCE_FETCH_TIMEOUT) as resp:
+        data = resp.read()
+        content_type = resp.headers.get("Content-Type", "")
+
+    if depth > 0 and "css" in content_type:
+        css = data.decode("utf-8", errors="replace")
+        for ref in set(re.findall(r"url\(\s*[\"']?(" + _URL + r")", css)):
+            if is_whitelisted(_absolute(ref)):
+                fetch(ref, depth - 1)
+        css = resolve_html(css)
+        data = css.encode("utf-8")
+
+    os.makedirs(RESOURCE_CACHE_DIR, exist_ok=True)
+    path = cache_path(url)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return path
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "fetch":
+        print("usage: python -m app.resolver fetch URL [URL ...]", file=sys.stderr)
+        sys.exit(2)
+    for u in sys.argv[2:]:
+        print(f"{fetch(u)}  {u}")
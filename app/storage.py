@@ -0,0 +1,289 @@
+# app/storage.py
+"""
+Where finished PDFs (and exports) are kept, and for how long.
+
+Backends (PDF_STORAGE):
+  local  PDF_OUTPUT_DIR, sharded by a hash of the file name so no directory
+         grows past a few thousand entries:
+           {PDF_OUTPUT_DIR}/3f/a9/{job_id}.pdf   (PDF_SHARD_LEVELS levels of 256)
+  s3     an S3-compatible object store (AWS S3, MinIO, ...), same key layout:
+           s3://{PDF_S3_BUCKET}/{PDF_S3_PREFIX}3f/a9/{job_id}.pdf
+
+Writes are atomic: a file shows up under its final name only when complete
+(rename within the shard directory / a single PUT or completed multipart
+upload). The returned location is what the job file index (app/events.py)
+records; reads go to the backend a location belongs to, so files written
+before a change of PDF_STORAGE (including old flat {job_id}.pdf files) stay
+readable.
+
+Retention, gc() (the gc_storage task, run by Celery beat every
+PDF_GC_INTERVAL seconds):
+  - files older than PDF_RETENTION_DAYS are deleted
+  - above PDF_STORAGE_QUOTA_BYTES, the oldest files are deleted until the
+    store is under PDF_STORAGE_QUOTA_LOW_WATER of the quota
+  - leftovers of interrupted writes are removed
+Memory stays flat on millions of files: a first pass only sums sizes
+per minute of age, a second pass deletes everything older than the resulting
+cutoff. Downloads of collected jobs answer 410; cached documents are
+rendered again (app/cache.py).
+
+boto3 is only needed for the s3 backend.
+"""
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:  # optional: only the local backend is available
+    boto3 = None
+
+PDF_STORAGE = os.getenv("PDF_STORAGE", "local")
+PDF_OUTPUT_DIR = os.getenv("PDF_OUTPUT_DIR", "/data/pdfs")
+PDF_SHARD_LEVELS = int(os.getenv("PDF_SHARD_LEVELS", "2"))
+
+PDF_S3_BUCKET = os.getenv("PDF_S3_BUCKET", "")
+PDF_S3_PREFIX = os.getenv("PDF_S3_PREFIX", "pdfs/")
+PDF_S3_ENDPOINT_URL = os.getenv("PDF_S3_ENDPOINT_URL", "")  # e.g. http://minio:9000
+PDF_S3_REGION = os.getenv("PDF_S3_REGION", "")
+PDF_S3_URL_TTL = int(os.getenv("PDF_S3_URL_TTL", "300"))  # presigned download URLs
+
+PDF_RETENTION_DAYS = float(os.getenv("PDF_RETENTION_DAYS", "0"))  # 0 = keep forever
+PDF_STORAGE_QUOTA_BYTES = int(os.getenv("PDF_STORAGE_QUOTA_BYTES", "0"))  # 0 = no quota
+PDF_STORAGE_QUOTA_LOW_WATER = float(os.getenv("PDF_STORAGE_QUOTA_LOW_WATER", "0.9"))
+PDF_GC_INTERVAL = int(os.getenv("PDF_GC_INTERVAL", "3600"))
+
+TEMP_SUFFIXES = (".tmp", ".part")
+# Temp files older than this belong to writers that died
+STALE_TEMP_SECONDS = 3600
+_AGE_BUCKET = 60
+
+
+class StorageError(OSError):
+    pass
+
+
+def shard_path(name: str) -> str:
+    """
+    "3f/a9/{name}": PDF_SHARD_LEVELS two-hex-digit levels from sha256(name).
+    """
+    digest = hashlib.sha256(name.encode("utf-8")).hexdigest()
+    return "/".join([digest[2 * i:2 * i + 2] for i in range(PDF_SHARD_LEVELS)] + [name])
+
+
+class LocalStorage:
+    def __init__(self, root: str = PDF_OUTPUT_DIR):
+        self.root = root
+
+    def put(self, src_path: str, name: str) -> str:
+        """
+        Move src_path into the store as name; returns its location (a path).
+        """
+        dest = os.path.join(self.root, shard_path(name))
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp_path = f"{dest}.tmp"
+        try:
+            # Cross-device safe (copy + delete), then an atomic rename
+            shutil.move(src_path, tmp_path)
+            os.replace(tmp_path, dest)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return dest
+
+    def exists(self, location: str) -> bool:
+        return os.path.exists(location)
+
+    def delete(self, location: str):
+        try:
+            os.remove(location)
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def local_copy(self, location: str):
+        yield location
+
+    def scan(self):
+        """
+        (location, size, mtime) of every file in the store.
+        """
+        stack = [self.root]
+        while stack:
+            try:
+                entries = os.scandir(stack.pop())
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            st = entry.stat(follow_symlinks=False)
+                            yield entry.path, st.st_size, st.st_mtime
+                    except FileNotFoundError:
+                        continue  # deleted meanwhile
+
+
+class S3Storage:
+    def __init__(self, bucket: str = PDF_S3_BUCKET, prefix: str = PDF_S3_PREFIX,
+                 endpoint_url: str = PDF_S3_ENDPOINT_URL, region: str = PDF_S3_REGION):
+        if boto3 is None:
+            raise StorageError("PDF_STORAGE=s3 requires boto3")
+        if not bucket:
+            raise StorageError("PDF_S3_BUCKET is not set")
+        self.bucket, self.prefix = bucket, prefix
+        self.client = boto3.client("s3", endpoint_url=endpoint_url or None, region_name=region or None)
+
+    def _key(self, location: str) -> tuple:
+        bucket, _, key = location[len("s3://"):].partition("/")
+        return bucket, key
+
+    def put(self, src_path: str, name: str) -> str:
+        key = self.prefix + shard_path(name)
+        content_type = "application/zip" if name.endswith(".zip") else "application/pdf"
+        try:
+            self.client.upload_file(src_path, self.bucket, key, ExtraArgs={"ContentType": content_type})
+        except ClientError as e:
+            raise StorageError(f"Upload of {name} failed: {e}")
+        os.remove(src_path)
+        return f"s3://{self.bucket}/{key}"
+
+    def exists(self, location: str) -> bool:
+        bucket, key = self._key(location)
+        try:
+            self.client.head_object(Bucket=bucket, Key=key)
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise StorageError(str(e))
+
+    def delete(self, location: str):
+        bucket, key = self._key(location)
+        self.client.delete_object(Bucket=bucket, Key=key)
+
+    @contextmanager
+    def local_copy(self, location: str):
+        bucket, key = self._key(location)
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(key)[1])
+        os.close(fd)
+        try:
+            try:
+                self.client.download_file(bucket, key, path)
+            except ClientError as e:
+                raise StorageError(f"Download of {location} failed: {e}")
+            yield path
+        finally:
+            os.remove(path)
+
+    def url(self, location: str, filename: str, ttl: int = PDF_S3_URL_TTL) -> str:
+        """
+        Presigned GET URL, so downloads go straight to the object store.
+        """
+        bucket, key = self._key(location)
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": bucket, "Key": key,
+                    "ResponseContentDisposition": f'attachment; filename="{filename}"'},
+            ExpiresIn=ttl,
+        )
+
+    def scan(self):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get("Contents", []):
+                yield f"s3://{self.bucket}/{obj['Key']}", obj["Size"], obj["LastModified"].timestamp()
+
+
+_backends = {}
+
+
+def _backend(kind: str):
+    if kind not in _backends:
+        if kind == "s3":
+            _backends[kind] = S3Storage()
+        elif kind == "local":
+            _backends[kind] = LocalStorage()
+        else:
+            raise StorageError(f"Unknown PDF_STORAGE {kind!r} (local or s3)")
+    return _backends[kind]
+
+
+def get_storage():
+    """
+    Backend new files are written to (PDF_STORAGE).
+    """
+    return _backend(PDF_STORAGE)
+
+
+def storage_for(location: str):
+    """
+    Backend holding an existing location.
+    """
+    return _backend("s3" if location.startswith("s3://") else "local")
+
+
+def put(src_path: str, name: str) -> str:
+    return get_storage().put(src_path, name)
+
+
+def exists(location: str) -> bool:
+    return storage_for(location).exists(location)
+
+
+def delete(location: str):
+    storage_for(location).delete(location)
+
+
+def local_copy(location: str):
+    """
+    Context manager yielding a local path with the file's content.
+    """
+    return storage_for(location).local_copy(location)
+
+
+def gc(backend=None, now: float = None) -> dict:
+    """
+    Apply the retention policy to backend (default: get_storage()).
+    """
+    backend = backend or get_storage()
+    now = now or time.time()
+    if PDF_RETENTION_DAYS <= 0 and PDF_STORAGE_QUOTA_BYTES <= 0:
+        return {"skipped": "no PDF_RETENTION_DAYS or PDF_STORAGE_QUOTA_BYTES set"}
+
+    cutoff = now - PDF_RETENTION_DAYS * 86400 if PDF_RETENTION_DAYS > 0 else 0
+    total = 0
+    if PDF_STORAGE_QUOTA_BYTES > 0:
+        by_age = defaultdict(int)
+        for location, size, mtime in backend.scan():
+            if mtime >= cutoff and not location.endswith(TEMP_SUFFIXES):
+                total += size
+                by_age[int(mtime // _AGE_BUCKET)] += size
+        excess = total - PDF_STORAGE_QUOTA_BYTES * PDF_STORAGE_QUOTA_LOW_WATER
+        if total > PDF_STORAGE_QUOTA_BYTES:
+            for bucket in sorted(by_age):
+                cutoff = max(cutoff, (bucket + 1) * _AGE_BUCKET)
+                excess -= by_age[bucket]
+                if excess <= 0:
+                    break
+
+    report = {"cutoff": cutoff, "files": 0, "bytes": 0, "temp_files": 0, "bytes_kept": 0}
+    for location, size, mtime in backend.scan():
+        if location.endswith(TEMP_SUFFIXES):
+            if mtime < now - STALE_TEMP_SECONDS:
+                backend.delete(location)
+                report["temp_files"] += 1
+        elif mtime < cutoff:
+            backend.delete(location)
+            report["files"] += 1
+            report["bytes"] += size
+        else:
+            report["bytes_kept"] += size
+    return report
@@ -0,0 +1,192 @@
+# app/templates.py
+"""
+Registered bill templates (Jinja2) rendered server-side from per-consumer JSON.
+
+Templates are looked up by id as "{template_id}.html":
+- first in TEMPLATE_DIR (templates registered through POST /templates/{id},
+  shared between API and workers through the data volume)
+- then in the built-in bill/ directory (e.g. "bill" -> bill/bill.html)
+
+Compiled templates are kept in Jinja's in-process cache (re-checked by mtime)
+and their bytecode in TEMPLATE_CACHE_DIR, so each worker compiles a template
+once instead of receiving the expanded HTML with every job.
+
+Templates can draw charts server-side with bar_chart / pie_chart (app.charts)
+and QR codes from their payload with qr (app.qr), and format values with the
+money / number / yes_no filters.
+
+Anyone who can reach the API can register a template, so templates run in
+Jinja's sandbox: no access to Python internals (__globals__, __class__ ...)
+from template code.
+"""
+import os
+import re
+import hashlib
+import tempfile
+
+from jinja2 import (
+    ChainableUndefined,
+    ChoiceLoader,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    TemplateNotFound,
+    Undefined,
+    select_autoescape,
+)
+from jinja2.sandbox import SandboxedEnvironment
+
+from .charts import bar_chart, pie_chart
+from .qr import qr
+
+TEMPLATE_DIR = os.getenv("TEMPLATE_DIR", "/data/templates")
+TEMPLATE_CACHE_DIR = os.getenv("TEMPLATE_CACHE_DIR", "/tmp/template-cache")
+BUILTIN_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bill")
+
+TEMPLATE_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+_HEAD_OPEN = re.compile(r"<head[^>]*>", re.IGNORECASE)
+
+os.makedirs(TEMPLATE_DIR, exist_ok=True)
+os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+
+env = SandboxedEnvironment(
+    loader=ChoiceLoader([
+        FileSystemLoader(TEMPLATE_DIR),
+        FileSystemLoader(BUILTIN_TEMPLATE_DIR),
+    ]),
+    autoescape=select_autoescape(["html"]),
+    bytecode_cache=FileSystemBytecodeCache(TEMPLATE_CACHE_DIR),
+    auto_reload=True,
+    cache_size=64,
+    # Missing data renders empty (and charts empty) instead of failing the bill
+    undefined=ChainableUndefined,
+)
+
+
+def _numeric(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _blank(value):
+    return value is None or isinstance(value, Undefined)
+
+
+def number(value, decimals: int = 2):
+    """
+    1234.5 -> "1,234.50"; text is shown as given, missing values empty.
+    """
+    if _blank(value):
+        return ""
+    n = _numeric(value)
+    if n is None:
+        return value
+    return f"{n:,.{decimals}f}"
+
+
+def money(value, decimals: int = 2):
+    if _blank(value):
+        return ""
+    n = _numeric(value)
+    if n is None:
+        return value
+    return f"₹ {number(n, decimals)}"
+
+
+def yes_no(value):
+    if isinstance(value, bool):
+        return "Yes" if value else "No"
+    return "" if _blank(value) else value
+
+
+env.globals.update(bar_chart=bar_chart, pie_chart=pie_chart, qr=qr)
+env.filters.update(money=money, number=number, yes_no=yes_no)
+
+
+class TemplateError(ValueError):
+    pass
+
+
+def template_name(template_id: str) -> str:
+    if not TEMPLATE_ID_RE.match(template_id or ""):
+        raise TemplateError(f"Invalid template id {template_id!r}")
+    return f"{template_id}.html"
+
+
+def template_exists(template_id: str) -> bool:
+    try:
+        env.get_template(template_name(template_id))
+        return True
+    except TemplateNotFound:
+        return False
+
+
+def template_version(template_id: str) -> str:
+    """
+    sha256 of the current template source (part of the result cache key).
+    """
+    try:
+        source, _, _ = env.loader.get_source(env, template_name(template_id))
+    except TemplateNotFound:
+        raise TemplateError(f"Unknown template {template_id!r}")
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+def register_template(template_id: str, source: str) -> dict:
+    """
+    Validate (compile) and store a template in TEMPLATE_DIR.
+    Returns {"template_id", "version"} where version is the source hash.
+    """
+    name = template_name(template_id)
+    try:
+        env.parse(source)
+    except Exception as e:
+        raise TemplateError(f"Template does not compile: {e}")
+
+    # Own temp file per registration: concurrent ones must not share it
+    fd, tmp_path = tempfile.mkstemp(dir=TEMPLATE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(source)
+        os.chmod(tmp_path, 0o644)  # mkstemp's 0600 would hide it from the workers
+        os.replace(tmp_path, os.path.join(TEMPLATE_DIR, name))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return {"template_id": template_id, "version": hashlib.sha256(source.encode("utf-8")).hexdigest()}
+
+
+def list_templates() -> list:
+    ids = set()
+    for directory in (TEMPLATE_DIR, BUILTIN_TEMPLATE_DIR):
+        if os.path.isdir(directory):
+            ids.update(f[:-5] for f in os.listdir(directory) if f.endswith(".html"))
+    return sorted(i for i in ids if TEMPLATE_ID_RE.match(i))
+
+
+def render_template(template_id: str, data: dict) -> str:
+    """
+    Render a registered template with per-consumer data.
+    Relative asset paths (e.g. wzlogo.png) resolve next to the template file,
+    via a <base> tag unless the template sets its own.
+    """
+    try:
+        template = env.get_template(template_name(template_id))
+    except TemplateNotFound:
+        raise TemplateError(f"Unknown template {template_id!r}")
+
+    html = template.render(**data)
+
+    if template.filename and "<base" not in html.lower():
+        base = f'<base href="file://{os.path.dirname(template.filename)}/">'
+        m = _HEAD_OPEN.search(html)
+        pos = m.end() if m else 0
+        html = html[:pos] + base + html[pos:]
+
+    return html
@@ -0,0 +1,86 @@
+# app/webhooks.py
+"""
+Job webhooks: callback URL checks and delivery.
+
+Callback URLs come from API clients and are POSTed by the workers, so they
+must not reach the service's own network: a callback must be an http(s)
+URL whose host resolves only to public addresses (private, loopback,
+link-local, shared, multicast and reserved ones are refused). The API checks
+it when the job is submitted (400) and the worker again right before each
+delivery, since DNS can change in between; redirects are not followed.
+
+WEBHOOK_ALLOW_PRIVATE=1 lifts the address check, for deployments whose
+callbacks are internal services.
+"""
+import os
+import json
+import socket
+import ipaddress
+import urllib.error
+import urllib.request
+from urllib.parse import urlsplit
+
+WEBHOOK_TIMEOUT = int(os.getenv("WEBHOOK_TIMEOUT", "10"))
+WEBHOOK_ALLOW_PRIVATE = os.getenv("WEBHOOK_ALLOW_PRIVATE", "0") == "1"
+
+
+class CallbackURLError(ValueError):
+    pass
+
+
+def check_callback_url(url: str):
+    """
+    Raise CallbackURLError unless url is an http(s) URL of a public host
+    (blocking: resolves the host name).
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise CallbackURLError("callback_url must be an http(s) URL")
+    try:
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+    except ValueError:
+        raise CallbackURLError("callback_url has an invalid port")
+    if WEBHOOK_ALLOW_PRIVATE:
+        return
+
+    try:
+        infos = socket.getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError):
+        raise CallbackURLError(f"callback_url host {parts.hostname!r} does not resolve")
+    for info in infos:
+        addr = ipaddress.ip_address(info[4][0].split("%")[0])
+        if not addr.is_global or addr.is_multicast:
+            raise CallbackURLError("callback_url must not point to a private, loopback or link-local address")
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+_opener = urllib.request.build_opener(_NoRedirect)
+
+
+def post(url: str, payload: dict) -> dict:
+    """
+    POST payload as JSON to a checked callback URL. Returns {"status"}, or
+    {"refused"} when the URL fails the check or redirects (not worth a
+    retry); other errors are raised.
+    """
+    try:
+        check_callback_url(url)
+    except CallbackURLError as e:
+        return {"refused": str(e)}
+    req = urllib.request.Request(
+        url,
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    try:
+        with _opener.open(req, timeout=WEBHOOK_TIMEOUT) as resp:
+            return {"status": resp.status}
+    except urllib.error.HTTPError as e:
+        if 300 <= e.code < 400:
+            return {"refused": f"redirect ({e.code}) not followed"}
+        raise
@@ -0,0 +1,432 @@
+# bench/run.py
+"""
+Benchmark / load test for the PDF service.
+
+Each document goes through the public API as a client would:
+    POST /generate (or /generate/{template_id})  ->  GET /status?wait=  ->  GET /download
+with the repository fixtures (bill2.html, bill5_v5.html, and the bill/
+template with bench/fixtures/bill.json), at a given concurrency and mix.
+
+Runs entirely locally. By default the API and a Celery worker (thread pool)
+run in this process against an in-memory Redis (fakeredis) and the stub
+renderer (bench/stub_wkhtmltopdf.py):
+
+    python -m bench.run --documents 200 --concurrency 16 --mix bill2=1,bill5_v5=1,bill=2
+    python -m bench.run --wkhtmltopdf /usr/bin/wkhtmltopdf --workers 4   # real renderer
+    python -m bench.run --redis local                                    # real Redis (REDIS_HOST)
+    python -m bench.run --url http://localhost:8085 --api-pid 1234 --worker-pid 5678
+    python -m bench.run --compare bench/results/A.json bench/results/B.json
+
+Reports p50 / p95 / p99 latencies, documents per second (per core and per
+CPU second) and peak memory of API and workers, and writes everything to
+bench/results/{timestamp}-{label}.json.
+
+Needs httpx; fakeredis for --redis fake, psutil for --api-pid / --worker-pid.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(ROOT, "bench")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+STUB_RENDERER = os.path.join(BENCH_DIR, "stub_wkhtmltopdf.py")
+
+# name -> (kind, source)
+FIXTURES = {
+    "bill2": ("html", os.path.join(ROOT, "bill2.html")),
+    "bill5_v5": ("html", os.path.join(ROOT, "bill5_v5.html")),
+    "bill": ("template", os.path.join(BENCH_DIR, "fixtures", "bill.json")),
+}
+FINAL_STATES = ("DONE", "FAILED")
+COMPARED = ("total_p50", "total_p95", "total_p99", "docs_per_second", "docs_per_core_second",
+            "docs_per_cpu_second", "api_peak_rss_mb", "worker_peak_rss_mb", "errors")
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in FIXTURES:
+            raise SystemExit(f"unknown fixture {name!r} (one of {', '.join(FIXTURES)})")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+class Documents:
+    """
+    Request bodies per fixture. Every document is made unique (so it is really
+    rendered) unless picked as a repeat, which resends an earlier body of the
+    same fixture and measures the result cache.
+    """
+
+    def __init__(self, run_id: str, repeat: float):
+        self.run_id = run_id
+        self.repeat = repeat
+        self.sources = {}
+        for name, (kind, path) in FIXTURES.items():
+            with open(path, "rb") as f:
+                self.sources[name] = f.read() if kind == "html" else json.load(f)
+
+    def request(self, name: str, n: int, rng: random.Random) -> dict:
+        if rng.random() < self.repeat:
+            n = 0
+        kind, _ = FIXTURES[name]
+        if kind == "html":
+            marker = f"\n<!-- bench {self.run_id} {n} -->\n".encode("utf-8")
+            return {"url": "/generate", "content": self.sources[name] + marker}
+        data = json.loads(json.dumps(self.sources[name]))
+        data["consumer"]["customer_no"] = f"B{self.run_id}{n:07d}"
+        return {"url": f"/generate/{name}", "json": data}
+
+
+async def run_document(client, fixture: str, req: dict, args) -> dict:
+    out = {"fixture": fixture, "ok": False}
+    t0 = time.perf_counter()
+    try:
+        body = {k: v for k, v in req.items() if k != "url"}
+        params = {"priority": args.priority} if args.priority else None
+        resp = await client.post(req["url"], params=params, **body)
+        resp.raise_for_status()
+        job = resp.json()
+        job_id = job["job_id"]
+        out["cached"] = bool(job.get("cached"))
+        t1 = time.perf_counter()
+
+        status = job.get("status")
+        while status not in FINAL_STATES:
+            remaining = args.timeout - (time.perf_counter() - t0)
+            if remaining <= 0:
+                raise TimeoutError(f"job {job_id} not finished after {args.timeout}s")
+            resp = await client.get(f"/status/{job_id}", params={"wait": min(remaining, 30)})
+            resp.raise_for_status()
+            status = resp.json()["status"]
+            if status == "FAILED":
+                raise RuntimeError(f"job {job_id} failed: {resp.json().get('error')}")
+        t2 = time.perf_counter()
+
+        resp = await client.get(f"/download/{job_id}")
+        resp.raise_for_status()
+        t3 = time.perf_counter()
+        out.update(ok=True, bytes=len(resp.content), submit=t1 - t0, complete=t2 - t0,
+                   download=t3 - t2, total=t3 - t0)
+    except Exception as e:
+        out["error"] = f"{type(e).__name__}: {e}"
+    return out
+
+
+async def drive(client, args, fixtures: list, documents: Documents) -> tuple:
+    rng = random.Random(args.seed)
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def one(fixture, n):
+        async with sem:
+            return await run_document(client, fixture, documents.request(fixture, n, rng), args)
+
+    for i in range(args.warmup):
+        await one(fixtures[i % len(fixtures)], args.documents + i + 1)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one(f, n + 1) for n, f in enumerate(fixtures)))
+    return results, time.perf_counter() - start
+
+
+class MemorySampler:
+    """
+    Peak RSS per role, sampled with psutil. roles = {role: [(pid, scope)]}
+    where scope is "tree" (process + descendants), "self" or "children".
+    """
+
+    def __init__(self, roles: dict, interval: float = 0.2):
+        import psutil
+
+        self.psutil = psutil
+        self.roles = {role: [(psutil.Process(pid), scope) for pid, scope in procs]
+                      for role, procs in roles.items() if procs}
+        self.peaks = {role: 0 for role in self.roles}
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _rss(self, procs) -> int:
+        total = 0
+        for proc, scope in procs:
+            try:
+                members = [] if scope == "children" else [proc]
+                if scope != "self":
+                    members += proc.children(recursive=True)
+                for p in members:
+                    total += p.memory_info().rss
+            except self.psutil.Error:
+                pass
+        return total
+
+    def _run(self):
+        while not self._stop.is_set():
+            for role, procs in self.roles.items():
+                self.peaks[role] = max(self.peaks[role], self._rss(procs))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def use_fake_redis():
+    """
+    Point every redis.Redis / redis.asyncio.Redis client at one in-memory server.
+    """
+    import redis
+    import redis.asyncio
+    import fakeredis
+    import fakeredis.aioredis
+
+    server = fakeredis.FakeServer()
+
+    def sync_client(*args, **kwargs):
+        kwargs.pop("host", None)
+        kwargs.pop("port", None)
+        return fakeredis.FakeRedis(server=server, **kwargs)
+
+    def async_client(*args, **kwargs):
+        kwargs.pop("host", None)
+        kwargs.pop("port", None)
+        pool = kwargs.pop("connection_pool", None)
+        if pool is not None:
+            # The API's BlockingConnectionPool: keep its db / decoding, not its sockets
+            options = pool.connection_kwargs
+            kwargs.update(db=options.get("db", 0), decode_responses=options.get("decode_responses", False))
+        return fakeredis.aioredis.FakeRedis(server=server, **kwargs)
+
+    redis.Redis = sync_client
+    redis.asyncio.Redis = async_client
+
+
+def start_inprocess(args, workdir: str):
+    """
+    API app + Celery worker (thread pool) in this process; returns (app, stop).
+    """
+    for name in ("pdfs", "blobs", "assets", "templates", "resource-cache"):
+        os.makedirs(os.path.join(workdir, name), exist_ok=True)
+    os.environ.update({
+        "PDF_OUTPUT_DIR": os.path.join(workdir, "pdfs"),
+        "BLOB_DIR": os.path.join(workdir, "blobs"),
+        "ASSET_DIR": os.path.join(workdir, "assets"),
+        "TEMPLATE_DIR": os.path.join(workdir, "templates"),
+        "RESOURCE_CACHE_DIR": os.path.join(workdir, "resource-cache"),
+        "WKHTML_BIN": args.wkhtmltopdf or STUB_RENDERER,
+    })
+    if args.redis == "fake":
+        os.environ.update({"CELERY_BROKER_URL": "memory://", "CELERY_RESULT_BACKEND": "cache+memory://"})
+        use_fake_redis()
+
+    sys.path.insert(0, ROOT)
+    from app.celery_app import celery, PRIORITY_QUEUES
+    from app.main import app
+
+    # The thread pool's consumer loop only frees prefetch slots (late acks,
+    # prefetch=1) when its 2s drain times out, and the in-memory broker is
+    # polled (1s by default); both would dominate latencies here, unlike with
+    # prefork workers in a deployment
+    celery.conf.task_acks_late = False
+    celery.conf.worker_prefetch_multiplier = 4
+    if args.redis == "fake":
+        celery.conf.broker_transport_options = {**celery.conf.broker_transport_options,
+                                                "polling_interval": 0.01}
+
+    worker = celery.WorkController(
+        pool_cls="threads",
+        concurrency=args.workers,
+        queues=list(PRIORITY_QUEUES.values()),
+        without_heartbeat=True,
+        without_mingle=True,
+        without_gossip=True,
+        loglevel="WARNING",
+    )
+    threading.Thread(target=worker.start, daemon=True).start()
+    return app, worker.stop
+
+
+def percentile(values: list, p: float):
+    if not values:
+        return None
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+    return round(values[k], 4)
+
+
+def summarize(results: list, elapsed: float, cores: int, cpu_seconds) -> dict:
+    ok = [r for r in results if r["ok"]]
+    summary = {
+        "documents": len(results),
+        "ok": len(ok),
+        "errors": len(results) - len(ok),
+        "cached": sum(1 for r in ok if r.get("cached")),
+        "elapsed_s": round(elapsed, 3),
+        "docs_per_second": round(len(ok) / elapsed, 3) if elapsed else None,
+        "docs_per_core_second": round(len(ok) / elapsed / cores, 3) if elapsed else None,
+        "cores": cores,
+    }
+    if cpu_seconds:
+        summary["cpu_seconds"] = round(cpu_seconds, 3)
+        summary["docs_per_cpu_second"] = round(len(ok) / cpu_seconds, 3)
+    for phase in ("submit", "complete", "download", "total"):
+        values = [r[phase] for r in ok]
+        for p in (50, 95, 99):
+            summary[f"{phase}_p{p}"] = percentile(values, p)
+    return summary
+
+
+def cpu_time() -> float:
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def git_rev() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+async def benchmark(args) -> dict:
+    import httpx
+
+    weights = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    fixtures = rng.choices(list(weights), weights=list(weights.values()), k=args.documents)
+    documents = Documents(run_id=datetime.utcnow().strftime("%H%M%S"), repeat=args.repeat)
+    memory, stop = {}, None
+
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout)
+        cores = args.cores or os.cpu_count()
+        roles = {"api": [(pid, "tree") for pid in args.api_pid],
+                 "worker": [(pid, "tree") for pid in args.worker_pid]}
+        cpu_before = None
+    else:
+        workdir = tempfile.mkdtemp(prefix="pdf-bench-")
+        app, stop = start_inprocess(args, workdir)
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench",
+                                   timeout=args.timeout)
+        cores = args.cores or len(os.sched_getaffinity(0))
+        # API and worker share this process; renderer processes are its children
+        roles = {"api": [(os.getpid(), "self")], "worker": [(os.getpid(), "children")]}
+        memory["note"] = "in-process: api = API + worker process, worker = renderer processes"
+        cpu_before = cpu_time()
+    sampler = None
+    if any(roles.values()):
+        try:
+            sampler = MemorySampler(roles)
+        except ImportError:
+            memory["note"] = "psutil not installed: memory not sampled"
+
+    try:
+        async with client:
+            if sampler:
+                with sampler:
+                    results, elapsed = await drive(client, args, fixtures, documents)
+                memory.update({f"{role}_peak_rss_mb": round(peak / 2**20, 1)
+                               for role, peak in sampler.peaks.items()})
+            else:
+                results, elapsed = await drive(client, args, fixtures, documents)
+    finally:
+        if stop:
+            stop()
+
+    cpu_seconds = cpu_time() - cpu_before if cpu_before is not None else None
+
+    per_fixture = {
+        name: summarize([r for r in results if r["fixture"] == name], elapsed, cores, None)
+        for name in weights
+    }
+    return {
+        "label": args.label,
+        "timestamp": datetime.utcnow().isoformat(),
+        "git_rev": git_rev(),
+        "mode": "remote" if args.url else f"in-process (redis={args.redis})",
+        "renderer": "remote" if args.url else (args.wkhtmltopdf or "stub"),
+        "config": {k: v for k, v in vars(args).items() if k not in ("compare",)},
+        "summary": {**summarize(results, elapsed, cores, cpu_seconds), **memory},
+        "per_fixture": per_fixture,
+        "errors": [r["error"] for r in results if not r["ok"]][:20],
+    }
+
+
+def save(report: dict) -> str:
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    path = os.path.join(RESULTS_DIR, f"{stamp}-{report['label']}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    return path
+
+
+def compare(paths: list):
+    reports = []
+    for path in paths:
+        with open(path) as f:
+            reports.append(json.load(f))
+    base = reports[0]["summary"]
+    print(f"{'metric':<24}" + "".join(f"{os.path.basename(p)[:28]:>30}" for p in paths))
+    for key in COMPARED:
+        row = f"{key:<24}"
+        for report in reports:
+            value = report["summary"].get(key)
+            cell = "-" if value is None else f"{value:g}"
+            if report is not reports[0] and isinstance(value, (int, float)) and base.get(key):
+                cell += f" ({(value - base[key]) / base[key] * 100:+.1f}%)"
+            row += f"{cell:>30}"
+        print(row)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--documents", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--mix", default="bill2=1,bill5_v5=1,bill=1", help="fixture=weight,...")
+    parser.add_argument("--repeat", type=float, default=0.0, help="share of documents resent (cache hits)")
+    parser.add_argument("--warmup", type=int, default=2, help="documents before measuring")
+    parser.add_argument("--priority", help="job class for every document (interactive/standard/bulk)")
+    parser.add_argument("--timeout", type=float, default=300, help="per-document timeout, seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--label", default="run")
+    parser.add_argument("--url", help="benchmark a running deployment instead of in-process")
+    parser.add_argument("--redis", choices=("fake", "local"), default="fake",
+                        help="in-process: fakeredis or the Redis at REDIS_HOST")
+    parser.add_argument("--workers", type=int, default=2, help="in-process worker concurrency")
+    parser.add_argument("--wkhtmltopdf", help="real renderer binary (default: stub)")
+    parser.add_argument("--cores", type=int, help="cores for docs/core/second (default: available)")
+    parser.add_argument("--api-pid", type=int, action="append", default=[])
+    parser.add_argument("--worker-pid", type=int, action="append", default=[])
+    parser.add_argument("--compare", nargs="+", metavar="RESULT_JSON", help="compare saved results")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(args.compare)
+        return
+
+    report = asyncio.run(benchmark(args))
+    path = save(report)
+    print(json.dumps(report["summary"], indent=2))
+    print(f"results: {path}")
+
+
+if __name__ == "__main__":
+    main()
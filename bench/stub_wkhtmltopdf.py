@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# bench/stub_wkhtmltopdf.py
+"""
+Stand-in for wkhtmltopdf, for benchmarks without the real binary.
+
+Accepts the same command line as the renderer builds (options, one or more
+input .html files, output .pdf, --dump-outline for batches) and writes a
+valid PDF with one blank A4 page per class="page" element of each input
+(at least one). The top-level <h1> of each input goes into the outline
+dump, so batch splitting works as with the real binary.
+
+Render cost is simulated per page:
+  BENCH_STUB_SLEEP_MS  wall time (waiting, e.g. for fonts / network)
+  BENCH_STUB_CPU_MS    busy CPU time
+"""
+import os
+import re
+import sys
+import time
+
+SLEEP_MS = float(os.getenv("BENCH_STUB_SLEEP_MS", "0"))
+CPU_MS = float(os.getenv("BENCH_STUB_CPU_MS", "0"))
+
+_PAGE = re.compile(rb"""class\s*=\s*["'][^"']*\bpage\b""", re.IGNORECASE)
+_H1 = re.compile(rb"<h1[^>]*>([^<]*)</h1>", re.IGNORECASE)
+
+
+def write_pdf(path: str, pages: int):
+    """
+    Minimal PDF: catalog, page tree and `pages` empty A4 pages.
+    """
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + i} 0 R" for i in range(pages))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode())
+    for _ in range(pages):
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] >>")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for n, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{n} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def burn(seconds: float):
+    end = time.process_time() + seconds
+    while time.process_time() < end:
+        pass
+
+
+def main(argv) -> int:
+    if argv == ["--version"]:
+        # Like the patched-Qt builds that batch renders need (app/renderer.py)
+        print("wkhtmltopdf 0.12.6.1 (with patched qt)")
+        return 0
+    if len(argv) < 2:
+        print("usage: stub_wkhtmltopdf [options] input.html [...] output.pdf", file=sys.stderr)
+        return 1
+    output = argv[-1]
+    outline = argv[argv.index("--dump-outline") + 1] if "--dump-outline" in argv else None
+    inputs = [a for a in argv[:-1] if a.lower().endswith((".html", ".htm")) and os.path.isfile(a)]
+    if not inputs:
+        print("stub_wkhtmltopdf: no input files", file=sys.stderr)
+        return 1
+
+    total, items = 0, []
+    for path in inputs:
+        with open(path, "rb") as f:
+            html = f.read()
+        heading = _H1.search(html)
+        if heading:
+            items.append((heading.group(1).decode("utf-8", "replace"), total + 1))
+        total += max(1, len(_PAGE.findall(html)))
+
+    if SLEEP_MS:
+        time.sleep(SLEEP_MS * total / 1000)
+    if CPU_MS:
+        burn(CPU_MS * total / 1000)
+
+    write_pdf(output, total)
+    if outline:
+        with open(outline, "w", encoding="utf-8") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8" ?>\n'
+                    '<outline xmlns="http://wkhtmltopdf.org/outline">\n')
+            for title, page in items:
+                f.write(f'<item title="{title}" page="{page}" link="" backLink=""/>\n')
+            f.write("</outline>\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,18 @@
+from jinja2 import ChainableUndefined
+
+from app.charts import _series, bar_chart, pie_chart
+
+
+def test_missing_values_count_as_zero():
+    labels, values = _series(["Jan", "Feb", "Mar", "Apr", "May"], [120, None, "", "1,050.5", "n/a"])
+    assert labels == ("Jan", "Feb", "Mar", "Apr", "May")
+    assert values == (120.0, 0.0, 0.0, 1050.5, 0.0)
+
+
+def test_undefined_series_renders_empty():
+    assert _series(ChainableUndefined(), ChainableUndefined()) == ((), ())
+
+
+def test_charts_render_with_gaps():
+    assert "<svg" in bar_chart(["Jan", "Feb", None], [10, None, float("nan")])
+    assert "<svg" in pie_chart(["Energy", "Duty"], ["", None])
@@ -1,31 +1,93 @@
 # worker/worker.py
+# Run from the project root: python -m worker.worker
+"""
+Standalone Redis-list worker (an alternative to the Celery workers).
+
+Producers RPUSH {"job_id": ..., "html": ...} onto PDF_QUEUE_NAME; job status
+is kept in the hash job:{job_id} (status, error, failure, pdf_path, attempts).
+
+- Reliable dequeue: jobs are moved (BLMOVE / LMOVE, up to the number of free
+  render slots per round trip) into this worker's processing list and removed
+  from it only after their outcome is recorded.
+- Recovery: every worker heartbeats into PDF_QUEUE_NAME:workers; the
+  processing list of a worker silent for WORKER_VISIBILITY_TIMEOUT seconds is
+  pushed back to the front of the queue by whichever worker notices first.
+  A job is attempted at most WORKER_MAX_ATTEMPTS times.
+- Renders run in a process pool of WORKER_CONCURRENCY (default: CPU count).
+- SIGTERM / SIGINT: stop taking jobs, finish the running ones (at most
+  WORKER_DRAIN_TIMEOUT seconds), then put anything unfinished back.
+
+Set a stable WORKER_ID (e.g. the container hostname) so a restarted worker
+takes back its own processing list right away.
+"""
 import os
 import json
+import time
+import signal
+import socket
 import tempfile
-import subprocess
+import threading
 from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 
 import redis
 
+from app import storage
+from app.renderer import render_pdf
+
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
 QUEUE_NAME = os.getenv("PDF_QUEUE_NAME", "queue:pdf_jobs")
-PDF_OUTPUT_DIR = os.getenv("PDF_OUTPUT_DIR", "/data/pdfs")
-WKHTML_BIN = os.getenv("WKHTML_BIN", "/usr/bin/wkhtmltopdf")
 
-os.makedirs(PDF_OUTPUT_DIR, exist_ok=True)
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "0")) or os.cpu_count() or 1
+WORKER_HEARTBEAT_INTERVAL = float(os.getenv("WORKER_HEARTBEAT_INTERVAL", "10"))
+# A worker without heartbeat for this long is dead; its jobs are requeued
+WORKER_VISIBILITY_TIMEOUT = float(os.getenv("WORKER_VISIBILITY_TIMEOUT", "60"))
+WORKER_MAX_ATTEMPTS = int(os.getenv("WORKER_MAX_ATTEMPTS", "3"))
+WORKER_DRAIN_TIMEOUT = float(os.getenv("WORKER_DRAIN_TIMEOUT", "120"))
+
+WORKERS_KEY = f"{QUEUE_NAME}:workers"  # zset: worker id -> last heartbeat
+PROCESSING_KEY = f"{QUEUE_NAME}:processing:{WORKER_ID}"
 
 r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
 
+# Move up to ARGV[1] jobs from the queue to a processing list in one call
+_TAKE = """
+local jobs = {}
+for i = 1, tonumber(ARGV[1]) do
+  local job = redis.call('LMOVE', KEYS[1], KEYS[2], 'LEFT', 'RIGHT')
+  if not job then break end
+  jobs[#jobs + 1] = job
+end
+return jobs
+"""
+
+# Put a processing list back at the front of the queue (oldest job first) and
+# forget the worker; with ARGV[2], only if its heartbeat is still older
+_REQUEUE = """
+if ARGV[2] ~= '' then
+  local seen = redis.call('ZSCORE', KEYS[3], ARGV[1])
+  if seen and tonumber(seen) >= tonumber(ARGV[2]) then return -1 end
+end
+local n = 0
+while redis.call('LMOVE', KEYS[1], KEYS[2], 'RIGHT', 'LEFT') do n = n + 1 end
+redis.call('ZREM', KEYS[3], ARGV[1])
+return n
+"""
+
+
 def update_job(job_id: str, **fields):
     job_key = f"job:{job_id}"
     fields["updated_at"] = datetime.utcnow().isoformat()
     r.hset(job_key, mapping=fields)
 
+
 def run_wkhtml(job_id: str, html: str) -> str:
     """
-    Run wkhtmltopdf on given HTML string and store as {job_id}.pdf in PDF_OUTPUT_DIR.
-    Returns final pdf path.
+    Render given HTML string with the configured engine and store it as
+    {job_id}.pdf (app/storage.py). Returns its storage location.
     """
     with tempfile.TemporaryDirectory() as td:
         html_path = os.path.join(td, "input.html")
@@ -34,67 +96,185 @@ def run_wkhtml(job_id: str, html: str) -> str:
         with open(html_path, "w", encoding="utf-8") as f:
             f.write(html)
 
-        cmd = [
-            WKHTML_BIN,
-            "--enable-local-file-access",
-            "--image-quality", "100",
-            "--dpi", "150",
-            html_path,
-            pdf_tmp,
-        ]
+        render_pdf(html_path, pdf_tmp)
+        return storage.put(pdf_tmp, f"{job_id}.pdf")
 
-        proc = subprocess.run(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            timeout=300,
-        )
 
-        stdout = proc.stdout.decode("utf-8", errors="ignore")
-        stderr = proc.stderr.decode("utf-8", errors="ignore")
+def process_job(raw: str):
+    """
+    Runs in a pool process: render one queued job and record its outcome.
+    """
+    try:
+        job = json.loads(raw)
+    except ValueError as e:
+        print("Invalid job payload, skipping:", e)
+        return
 
-        if proc.returncode != 0:
-            raise RuntimeError(f"wkhtmltopdf rc={proc.returncode} stderr={stderr[:1000]}")
+    job_id = job.get("job_id") if isinstance(job, dict) else None
+    html = job.get("html") if isinstance(job, dict) else None
+    if not job_id or html is None:
+        print("Job missing job_id or html; skipping.")
+        return
 
-        if not os.path.exists(pdf_tmp):
-            raise RuntimeError("wkhtmltopdf completed but output.pdf not found")
+    attempts = r.hincrby(f"job:{job_id}", "attempts", 1)
+    if attempts > WORKER_MAX_ATTEMPTS:
+        # Took its workers down every time: don't let it block the queue
+        print(f"Job {job_id} failed: gave up after {WORKER_MAX_ATTEMPTS} attempts")
+        update_job(job_id, status="FAILED", error=f"Gave up after {WORKER_MAX_ATTEMPTS} attempts")
+        return
 
-        final_path = os.path.join(PDF_OUTPUT_DIR, f"{job_id}.pdf")
-        os.replace(pdf_tmp, final_path)
-        return final_path
+    print(f"Processing job {job_id}")
+    update_job(job_id, status="RUNNING", error="")
+    try:
+        pdf_path = run_wkhtml(job_id, html)
+        print(f"Job {job_id} completed: {pdf_path}")
+        update_job(job_id, status="DONE", error="", pdf_path=pdf_path)
+    except Exception as e:
+        print(f"Job {job_id} failed:", e)
+        # reason, timeout, limits and usage of a failed render (app/renderer.py)
+        failure = json.dumps(getattr(e, "details", None) or {})
+        update_job(job_id, status="FAILED", error=str(e), failure=failure)
+
+
+def _init_pool_process():
+    # Shutdown is the parent's call: it lets running renders finish
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def take_jobs(count: int, timeout: float) -> list:
+    """
+    Up to count jobs, moved to this worker's processing list; waits up to
+    timeout seconds for the first one.
+    """
+    jobs = r.eval(_TAKE, 2, QUEUE_NAME, PROCESSING_KEY, count)
+    if jobs or timeout <= 0:
+        return jobs
+    job = r.blmove(QUEUE_NAME, PROCESSING_KEY, timeout, "LEFT", "RIGHT")
+    if job is None:
+        return []
+    return [job] + (r.eval(_TAKE, 2, QUEUE_NAME, PROCESSING_KEY, count - 1) if count > 1 else [])
+
+
+def ack(raw: str):
+    r.lrem(PROCESSING_KEY, 1, raw)
 
-def worker_loop():
-    print("Worker started, waiting for jobs...")
-    while True:
-        # BLPOP blocks until a job arrives
-        item = r.blpop(QUEUE_NAME, timeout=5)
-        if item is None:
-            continue  # timeout -> loop again
-
-        _, raw = item
-        try:
-            job = json.loads(raw)
-        except Exception as e:
-            print("Invalid job payload, skipping:", e)
-            continue
 
-        job_id = job.get("job_id")
-        html = job.get("html")
+def release(raw: str):
+    """
+    Give one claimed job back (to the front of the queue).
+    """
+    pipe = r.pipeline()
+    pipe.lrem(PROCESSING_KEY, 1, raw)
+    pipe.lpush(QUEUE_NAME, raw)
+    pipe.execute()
+
 
-        if not job_id or html is None:
-            print("Job missing job_id or html; skipping.")
-            continue
+def requeue(worker_id: str, seen_before: float = None) -> int:
+    """
+    Move worker_id's processing list back to the queue; -1 if it has sent a
+    heartbeat since seen_before (still alive).
+    """
+    processing = f"{QUEUE_NAME}:processing:{worker_id}"
+    since = "" if seen_before is None else seen_before
+    return r.eval(_REQUEUE, 3, processing, QUEUE_NAME, WORKERS_KEY, worker_id, since)
 
-        print(f"Processing job {job_id}")
-        update_job(job_id, status="RUNNING", error="")
 
+def heartbeat(stop: threading.Event):
+    """
+    Announce this worker and requeue the jobs of dead ones, until stop is set.
+    """
+    while not stop.is_set():
+        now = time.time()
         try:
-            pdf_path = run_wkhtml(job_id, html)
-            print(f"Job {job_id} completed: {pdf_path}")
-            update_job(job_id, status="DONE", error="", pdf_path=pdf_path)
-        except Exception as e:
-            print(f"Job {job_id} failed:", e)
-            update_job(job_id, status="FAILED", error=str(e))
+            r.zadd(WORKERS_KEY, {WORKER_ID: now})
+            cutoff = now - WORKER_VISIBILITY_TIMEOUT
+            for dead in r.zrangebyscore(WORKERS_KEY, "-inf", cutoff):
+                if dead == WORKER_ID:
+                    continue  # our own heartbeats failed for a while
+                moved = requeue(dead, cutoff)
+                if moved >= 0:
+                    print(f"Worker {dead} is gone: requeued {moved} job(s)")
+        except redis.RedisError as e:
+            print("Heartbeat failed:", e)
+        stop.wait(WORKER_HEARTBEAT_INTERVAL)
+
+
+def worker_loop():
+    # Jobs this worker id held when it last stopped
+    recovered = requeue(WORKER_ID)
+    if recovered > 0:
+        print(f"Requeued {recovered} unfinished job(s) from a previous run")
+
+    stopping = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stopping.set())
+
+    beat_stop = threading.Event()
+    beat = threading.Thread(target=heartbeat, args=(beat_stop,), daemon=True)
+    beat.start()
+
+    pool = new_pool()
+    running = {}  # future -> raw job
+    print(f"Worker {WORKER_ID} started ({WORKER_CONCURRENCY} processes), waiting for jobs...")
+    try:
+        while not stopping.is_set():
+            free = WORKER_CONCURRENCY - len(running)
+            if free > 0:
+                try:
+                    # Block for new work only when idle; otherwise keep reaping
+                    for raw in take_jobs(free, timeout=0.2 if running else 1):
+                        try:
+                            running[pool.submit(process_job, raw)] = raw
+                        except BrokenProcessPool:
+                            release(raw)
+                            pool = new_pool()
+                except redis.RedisError as e:
+                    print("Dequeue failed:", e)
+                    stopping.wait(1)
+            if running:
+                done, _ = wait(running, timeout=0 if free > 0 else 1, return_when=FIRST_COMPLETED)
+                broken = False
+                for future in done:
+                    broken |= not finish(future, running.pop(future))
+                if broken:
+                    # Its other jobs fail with BrokenProcessPool too and are released
+                    pool.shutdown(wait=False)
+                    pool = new_pool()
+
+        print(f"Stopping: draining {len(running)} running job(s)")
+        done, _ = wait(running, timeout=WORKER_DRAIN_TIMEOUT)
+        for future in done:
+            finish(future, running.pop(future))
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        beat_stop.set()
+        beat.join()
+        # Unfinished jobs go back to the queue for another worker
+        left = requeue(WORKER_ID)
+        if left > 0:
+            print(f"Requeued {left} unfinished job(s)")
+    print("Worker stopped")
+
+
+def new_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=WORKER_CONCURRENCY, initializer=_init_pool_process)
+
+
+def finish(future, raw: str) -> bool:
+    """
+    Ack a completed job. False if the pool broke under it (a render process
+    died, e.g. OOM-killed): the job is queued again, and attempted at most
+    WORKER_MAX_ATTEMPTS times.
+    """
+    error = future.exception()
+    if error is None:
+        ack(raw)
+        return True
+    print("Render process failed:", error)
+    release(raw)
+    return not isinstance(error, BrokenProcessPool)
+
 
 if __name__ == "__main__":
     worker_loop()